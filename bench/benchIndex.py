@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+
+# Benchmarks a slave's index on its own, with plain and with compact main
+# tables: how much memory each takes, how long it takes to build, and the
+# throughput and p50/p99 latency of find_first and find_all at several batch
+# sizes. Queries are near-duplicates of hashes in the index, or random hashes
+# (which almost never have any).
+#
+# Results are written as JSON, like bench/benchMaster.py's
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import gc
+import json
+import time
+import argparse
+import platform
+
+import numpy
+
+from smhcluster.index import Index
+
+def sizes(value):
+    return [int(v) for v in value.split(',')]
+
+parser = argparse.ArgumentParser(description='Benchmark the index')
+parser.add_argument('--hashes', dest='hashes', type=int, default=10000000,
+    help='How many hashes to put in the index')
+parser.add_argument('--blocks', dest='blocks', type=int, default=6,
+    help='How many blocks to divide hashes into')
+parser.add_argument('--diff-bits', dest='differing_bits', type=int, default=3,
+    help='How many bits near-duplicates may differ by')
+parser.add_argument('--compact', dest='compact', type=sizes, default=[64],
+    help='Comma-separated sizes of compact blocks to test')
+parser.add_argument('--batches', dest='batches', type=sizes,
+    default=[1, 100, 10000], help='Comma-separated batch sizes to test')
+parser.add_argument('--queries', dest='queries', type=int, default=2000,
+    help='Roughly how many queries to make for each measurement')
+parser.add_argument('--calls', dest='calls', type=int, default=20,
+    help='The fewest calls to make for each measurement')
+parser.add_argument('--output', dest='output', type=str,
+    default='bench-index.json', help='Where to write the results')
+
+args = parser.parse_args()
+numpy.random.seed(42)
+
+def random_hashes(count):
+    return numpy.random.randint(0, 1 << 62, size=count,
+        dtype=numpy.int64).astype(numpy.uint64) << numpy.uint64(2)
+
+def near(hashes):
+    '''A near-duplicate of each hash, with a couple of bits flipped'''
+    bits = numpy.random.randint(0, 64, size=(2, len(hashes))).astype(
+        numpy.uint64)
+    return hashes ^ (numpy.uint64(1) << bits[0]) ^ (numpy.uint64(1) << bits[1])
+
+def build(hashes, compact):
+    index = Index(args.blocks, args.differing_bits, compact)
+    start = time.time()
+    index.insert(hashes)
+    index.settle()
+    index.merge()
+    return index, time.time() - start
+
+def measure(index, name, method, queries, batch):
+    calls = max(args.calls, args.queries // batch)
+    latencies = []
+    for i in range(calls):
+        offset = (i * batch) % (len(queries) - batch + 1)
+        chunk  = queries[offset:offset + batch]
+        start  = time.time()
+        getattr(index, method)(chunk)
+        latencies.append(time.time() - start)
+    latencies = numpy.array(latencies)
+    result = {
+        'name'      : name,
+        'method'    : method,
+        'batch'     : batch,
+        'calls'     : len(latencies),
+        'throughput': float(batch * len(latencies) / latencies.sum()),
+        'p50'       : float(numpy.percentile(latencies, 50)),
+        'p99'       : float(numpy.percentile(latencies, 99))
+    }
+    print('%-12s %-10s batch %6i: %12.1f per second, '
+        'p50 %9.3fms, p99 %9.3fms' % (name, method, batch,
+        result['throughput'], result['p50'] * 1000, result['p99'] * 1000))
+    return result
+
+hashes  = random_hashes(args.hashes)
+# Enough queries for the largest batch
+count   = max([args.queries] + args.batches)
+queries = numpy.concatenate((near(hashes[:count // 2]),
+    random_hashes(count - count // 2)))
+numpy.random.shuffle(queries)
+
+results = []
+for compact in [None] + args.compact:
+    name = 'compact-%i' % compact if compact else 'plain'
+    index, seconds = build(hashes, compact)
+    summary = {
+        'name'   : name,
+        'hashes' : args.hashes,
+        'tables' : index.tables,
+        'bytes'  : index.nbytes,
+        'per'    : index.nbytes / float(args.hashes * index.tables),
+        'build'  : seconds
+    }
+    print('%-12s %i tables, %.1f MB (%.2f bytes per hash per table), '
+        'built in %.1fs' % (name, index.tables, index.nbytes / 1e6,
+        summary['per'], seconds))
+    summary['lookups'] = [measure(index, name, method, queries, batch)
+        for method in ('find_first', 'find_all') for batch in args.batches]
+    results.append(summary)
+    del index
+    gc.collect()
+
+with open(args.output, 'w') as f:
+    json.dump({
+        'machine': platform.platform(),
+        'python' : platform.python_version(),
+        'args'   : vars(args),
+        'results': results
+    }, f, indent=2)
@@ -1,48 +1,344 @@
 #! /usr/bin/env python
 
+# Benchmarks a master with a number of slaves, talking to each other over
+# loopback zerorpc. The slaves are either served from this process or run as
+# local subprocesses (with bin/simhash-slave). For each corpus size, this times
+# inserts, find_first, find_all and removes at each batch size, in both the list
+# and packed formats. It also times how long it takes to rebalance after a
+# slave registers or deregisters, how many concurrent single-hash writers can
+# manage with and without coalescing, and optionally what the HTTP adapter adds.
+# Each of these can be run with each hash stored in all of its variants' shards
+# (the default, `copies`), or only in its own shard (`probe`), in which case
+# how much memory the slaves' indexes take is worth comparing as well.
+#
+# Results are written as JSON. Given the results of an earlier run with
+# --baseline, anything that got slower by more than --tolerance is reported as
+# a regression (and the exit status is 1). If a measurement fails, everything
+# measured before it is still written out, marked as incomplete
+
 import os
 import sys
 base, name = os.path.split(os.path.abspath(__file__))
 sys.path = [os.path.split(base)[0]] + sys.path
 
-from smhcluster import master
-
-m = master.Master()
-for i in range(4):
-    slave = master.Slave('slave-%i' % i, None)
-    m.accept(slave)
-
-class timer(object):
-    def __init__(self, name):
-        self.name = name
-    
-    def __enter__(self):
-        self.start = -time.time()
-        print 'Starting %s...' % self.name
-    
-    def __exit__(self, t, v, tb):
-        self.start += time.time()
-        print '         %s: %fs' % (self.name, self.start)
+import gevent
+import gevent.monkey
+gevent.monkey.patch_all()
 
+import json
 import time
-import random
+import socket
+import argparse
+import platform
+import subprocess
+
+import numpy
+import zerorpc
+
+from smhcluster import packed
+from smhcluster.master import Master
+from smhcluster.slave import Slave
+
+def sizes(value):
+    return [int(v) for v in value.split(',')]
+
+parser = argparse.ArgumentParser(description='Benchmark a cluster')
+parser.add_argument('--slaves', dest='slaves', type=int, default=4,
+    help='How many slaves to start with')
+parser.add_argument('--subprocess', dest='subprocess', action='store_true',
+    help='Run slaves as local subprocesses rather than in this process')
+parser.add_argument('--corpus', dest='corpus', type=sizes,
+    default=[10000, 100000], help='Comma-separated corpus sizes to test')
+parser.add_argument('--batches', dest='batches', type=sizes,
+    default=[1, 100, 10000], help='Comma-separated batch sizes to test')
+parser.add_argument('--hashes', dest='hashes', type=int, default=20000,
+    help='Roughly how many hashes to send for each measurement')
+parser.add_argument('--calls', dest='calls', type=int, default=20,
+    help='The fewest calls to make for each measurement')
+parser.add_argument('--writers', dest='writers', type=int, default=100,
+    help='How many concurrent single-hash writers to simulate')
+parser.add_argument('--modes', dest='modes', type=lambda v: v.split(','),
+    default=['copies'], help='Comma-separated modes to test (copies, probe)')
+parser.add_argument('--http', dest='http', action='store_true',
+    help='Also measure the overhead of the HTTP adapter')
+parser.add_argument('--port', dest='port', type=int, default=4300,
+    help='The first port to run the master and slaves on')
+parser.add_argument('--output', dest='output', type=str,
+    default='bench-results.json', help='Where to write the results')
+parser.add_argument('--baseline', dest='baseline', type=str, default=None,
+    help='Results from an earlier run to compare against')
+parser.add_argument('--tolerance', dest='tolerance', type=float, default=0.1,
+    help='How much slower something may get before it is a regression')
+
+args = parser.parse_args()
+numpy.random.seed(42)
+
+class Cluster(object):
+    '''A master and its slaves, served over loopback zerorpc'''
+    # The last port used by any cluster, since a stopped cluster's ports may
+    # not be free again right away
+    port = args.port
+    def __init__(self, count, mode):
+        self.master = Master()
+        self.master.config({'probe': mode == 'probe'})
+        self.address = '127.0.0.1:%i' % self.next_port()
+        self.server  = self.serve(self.master, Cluster.port)
+        self.hosts, self.servers, self.processes = [], [], []
+        for i in range(count):
+            self.add()
+        self.settle()
+
+    def next_port(self):
+        Cluster.port += 1
+        return Cluster.port
+
+    def serve(self, obj, port):
+        server = zerorpc.Server(obj)
+        server.bind('tcp://127.0.0.1:%i' % port)
+        gevent.spawn(server.run)
+        return server
+
+    def add(self):
+        '''Start a new slave, and wait for it to register'''
+        port = self.next_port()
+        if args.subprocess:
+            # The slave registers itself as <hostname>:<port>
+            host = '%s:%i' % (socket.gethostname(), port)
+            self.processes.append(subprocess.Popen([sys.executable,
+                os.path.join(os.path.split(base)[0], 'bin', 'simhash-slave'),
+                self.address, '--port', str(port)]))
+            while host not in self.master.slaves:
+                gevent.sleep(0.05)
+        else:
+            host = '127.0.0.1:%i' % port
+            self.servers.append(self.serve(Slave(host), port))
+            self.master.register(host)
+        self.hosts.append(host)
+        return host
+
+    def remove(self):
+        '''Deregister the most recently added slave'''
+        host = self.hosts.pop()
+        self.master.deregister(host)
+        return host
+
+    def settle(self):
+        '''Wait for all the shard moves so far to finish'''
+        self.master.pending.join()
+
+    def stop(self):
+        # Stop checking on the slaves first, so nothing waits on them after
+        for slave in list(self.master.slaves.values()):
+            slave.close()
+        for process in self.processes:
+            process.terminate()
+        for server in self.servers + [self.server]:
+            server.stop()
+
+def random_hashes(count):
+    return numpy.random.randint(0, 1 << 62, size=count,
+        dtype=numpy.int64).astype(numpy.uint64) << numpy.uint64(2)
+
+def near(hashes):
+    '''A near-duplicate of each hash, with a couple of bits flipped'''
+    bits = numpy.random.randint(0, 64, size=(2, len(hashes))).astype(
+        numpy.uint64)
+    return hashes ^ (numpy.uint64(1) << bits[0]) ^ (numpy.uint64(1) << bits[1])
+
+def summarize(name, fmt, corpus, batch, latencies, elapsed=None):
+    # Calls made one after another take as long as their latencies add up to,
+    # but concurrent ones should be given the wall-clock time they took
+    latencies = numpy.array(latencies)
+    elapsed   = latencies.sum() if elapsed is None else elapsed
+    result = {
+        'name'      : name,
+        'mode'      : mode,
+        'format'    : fmt,
+        'corpus'    : corpus,
+        'batch'     : batch,
+        'calls'     : len(latencies),
+        'seconds'   : float(elapsed),
+        'throughput': float(batch * len(latencies) / elapsed),
+        'p50'       : float(numpy.percentile(latencies, 50)),
+        'p99'       : float(numpy.percentile(latencies, 99))
+    }
+    print('%-6s %-12s %-7s corpus %8i batch %6i: %12.1f per second, '
+        'p50 %9.3fms, p99 %9.3fms' % (mode, name, fmt, corpus, batch,
+        result['throughput'], result['p50'] * 1000, result['p99'] * 1000))
+    return result
+
+def timed(method, batches):
+    '''Call method with each batch, returning a list of latencies'''
+    latencies = []
+    for batch in batches:
+        start = time.time()
+        method(batch)
+        latencies.append(time.time() - start)
+    return latencies
+
+def calls(master, fmt):
+    '''Functions to make each kind of call with a batch of hashes'''
+    if fmt == 'packed':
+        return {
+            'insert'    : lambda b: master.insert_packed(packed.pack_hashes(b)),
+            'find_first': lambda b: packed.unpack_hashes(
+                master.find_first_packed(packed.pack_hashes(b))),
+            'find_all'  : lambda b: packed.unpack_sets(
+                master.find_all_packed(packed.pack_hashes(b))),
+            'remove'    : lambda b: master.remove_packed(packed.pack_hashes(b))
+        }
+    return {
+        'insert'    : lambda b: master.insert(*b.tolist()),
+        'find_first': lambda b: master.find_first(*b.tolist()),
+        'find_all'  : lambda b: master.find_all(*b.tolist()),
+        'remove'    : lambda b: master.remove(*b.tolist())
+    }
+
+def operations(cluster, corpus, hashes):
+    results = []
+    for batch in args.batches:
+        count = max(args.calls, args.hashes // batch)
+        for fmt in ('list', 'packed'):
+            methods = calls(cluster.master, fmt)
+            fresh   = random_hashes(count * batch).reshape(count, batch)
+            queries = near(hashes[numpy.random.randint(0, len(hashes),
+                size=count * batch)]).reshape(count, batch)
+            for name, batches in (('insert', fresh), ('find_first', queries),
+                ('find_all', queries), ('remove', fresh)):
+                results.append(summarize(name, fmt, corpus, batch,
+                    timed(methods[name], batches)))
+    return results
+
+def rebalancing(cluster, corpus):
+    results = []
+    for name, method in (('register', cluster.add),
+        ('deregister', cluster.remove)):
+        start = time.time()
+        method()
+        cluster.settle()
+        results.append(summarize(name, 'rpc', corpus, 1,
+            [time.time() - start]))
+    return results
+
+def writers(cluster, corpus):
+    # Lots of clients each inserting one hash at a time, with and without the
+    # master coalescing their writes
+    results = []
+    for fmt, conf in (('single', {}), ('coalesce', {'enabled': True})):
+        cluster.master.config({'coalesce': conf})
+        fresh = random_hashes(max(args.hashes // 10, args.writers)).tolist()
+        latencies = []
+        def writer(hashes):
+            latencies.extend(timed(lambda b: cluster.master.insert(*b), hashes))
+        start = time.time()
+        gevent.joinall([gevent.spawn(writer, [[h] for h in
+            fresh[i::args.writers]]) for i in range(args.writers)],
+            raise_error=True)
+        results.append(summarize('writers', fmt, corpus, 1, latencies,
+            time.time() - start))
+    cluster.master.config({})
+    return results
+
+def http(cluster, corpus, hashes):
+    # The HTTP adapter's overhead over calling the master directly
+    try:
+        import bottle
+        import requests
+        from smhcluster.adapters import http
+    except ImportError as exc:
+        print('Skipping HTTP adapter: %s' % exc)
+        return []
+    # Its workers reach the master the same way slaves do
+    server = http.Server(cluster.master)
+    server.config({'port': 8080, 'master': cluster.address})
+    gevent.spawn(server.listen)
+    gevent.sleep(2)
+    client = http.Client('http://localhost:8080')
+    # The client blocks, so it runs in a thread while the master answers
+    pool   = gevent.get_hub().threadpool
+    def call(method, b):
+        return pool.spawn(getattr(client, method), b, packed=True).get()
+
+    results = []
+    for batch in args.batches:
+        count = max(args.calls, args.hashes // batch)
+        queries = near(hashes[numpy.random.randint(0, len(hashes),
+            size=count * batch)]).reshape(count, batch)
+        results.append(summarize('find_first', 'http', corpus, batch, timed(
+            lambda b: call('find_first_bulk', b), queries)))
+        results.append(summarize('find_all', 'http', corpus, batch, timed(
+            lambda b: call('find_all_bulk', b), queries)))
+    server.stop()
+    return results
 
-with timer('hashes and queries'):
-    hashes  = [random.randint(0, 1 << 63) for i in range(100000)]
-    queries = [random.randint(0, 1 << 63) for i in range(100000)]
+def memory(cluster, corpus, hashes):
+    # How much memory the slaves' indexes take up altogether, once a batch of
+    # queries has had every slave put what it's buffered into its tables
+    cluster.master.find_first_packed(packed.pack_hashes(hashes[:10000]))
+    slaves = cluster.master.metrics(slaves=True)['slaves']
+    total  = sum(m['gauges'].get('index.bytes', 0) for m in slaves.values())
+    print('%-6s %-12s corpus %8i: %12.3f MB' % (
+        mode, 'memory', corpus, total / 1e6))
+    return [{'name': 'memory', 'mode': mode, 'format': 'bytes',
+        'corpus': corpus, 'batch': 0, 'bytes': total}]
 
-with timer('insert %i' % len(hashes)):
-    for h in hashes:
-        m.insert(h)
+def compare(results, baseline):
+    '''Print and return the results that have regressed from the baseline'''
+    key = lambda r: (r['name'], r.get('mode', 'copies'), r['format'],
+        r['corpus'], r['batch'])
+    before = dict((key(r), r) for r in baseline['results'])
+    regressions = []
+    for result in results:
+        old = before.get(key(result))
+        if old is None or 'throughput' not in result:
+            continue
+        slower = old['throughput'] / result['throughput'] - 1
+        p99    = result['p99'] / old['p99'] - 1
+        if slower > args.tolerance or p99 > args.tolerance:
+            regressions.append({'result': key(result),
+                'throughput': slower, 'p99': p99})
+            print('REGRESSION %s: throughput %+.1f%%, p99 %+.1f%%' % (
+                repr(key(result)), -slower * 100, p99 * 100))
+    return regressions
 
-with timer('find_first %i' % len(queries)):
-    for q in queries:
-        m.find_first(q)
+def write(results, complete):
+    output = {
+        'time'    : time.time(),
+        'python'  : platform.python_version(),
+        'numpy'   : numpy.__version__,
+        'args'    : dict((k, v) for k, v in vars(args).items()),
+        'complete': complete,
+        'results' : results
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            output['regressions'] = compare(results, json.load(f))
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print('Wrote %s' % args.output)
+    return output
 
-with timer('find_all %i' % len(queries)):
-    for q in queries:
-        m.find_all(q)
+results = []
+try:
+    for mode in args.modes:
+        for corpus in args.corpus:
+            cluster = Cluster(args.slaves, mode)
+            hashes  = random_hashes(corpus)
+            # Load the corpus in large packed batches
+            for offset in range(0, corpus, 10000):
+                cluster.master.insert_packed(
+                    packed.pack_hashes(hashes[offset:offset + 10000]))
+            results.extend(memory(cluster, corpus, hashes))
+            results.extend(operations(cluster, corpus, hashes))
+            results.extend(writers(cluster, corpus))
+            results.extend(rebalancing(cluster, corpus))
+            if args.http:
+                results.extend(http(cluster, corpus, hashes))
+            cluster.stop()
+except BaseException:
+    # Keep whatever was measured before it went wrong
+    write(results, False)
+    raise
 
-with timer('removes %i' % len(hashes)):
-    for h in hashes:
-        m.remove(h)
+output = write(results, True)
+sys.exit(1 if output.get('regressions') else 0)
@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+
+# Simulates adding and removing nodes from a cluster, and reports how many
+# shards the placement planner moves each time compared to the fewest that
+# could possibly move (the total by which nodes fall short of their targets)
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import random
+import argparse
+
+from smhcluster.placement import Planner
+
+parser = argparse.ArgumentParser(description='Simulate shard placement')
+parser.add_argument('--shards', dest='shards', type=int, default=1024,
+    help='How many shards there are')
+parser.add_argument('--replicas', dest='replicas', type=int, default=1,
+    help='How many replicas of each shard to keep')
+parser.add_argument('--nodes', dest='nodes', type=int, default=8,
+    help='How many nodes to start with')
+parser.add_argument('--steps', dest='steps', type=int, default=4,
+    help='How many nodes to add (and then remove)')
+parser.add_argument('--weighted', dest='weighted', action='store_true',
+    help='Give nodes random weights rather than equal ones')
+
+args = parser.parse_args()
+random.seed(42)
+
+def weight():
+    return random.choice([16, 32, 64]) if args.weighted else 1
+
+def minimum(planner, placement, weights):
+    # Every shard copy that a node is short of its target has to come from
+    # somewhere, and every copy on a departed node has to go somewhere
+    targets = planner.targets(weights)
+    counts  = dict((node, 0) for node in weights)
+    for nodes in placement.values():
+        for node in nodes:
+            if node in counts:
+                counts[node] += 1
+    return sum(max(targets[n] - counts[n], 0) for n in weights)
+
+def step(label, planner, placement, weights):
+    best = minimum(planner, placement, weights)
+    placement, moves = planner.plan(placement, weights)
+    moved = len([m for m in moves if m[2] is not None])
+    print('%-20s %6i nodes %8i moved %8i minimum' % (
+        label, len(weights), moved, best))
+    return placement
+
+planner = Planner(args.shards, args.replicas)
+weights = dict(('node-%i' % i, weight()) for i in range(args.nodes))
+placement = step('initial', planner, {}, weights)
+
+added = []
+for i in range(args.steps):
+    node = 'node-%i' % (args.nodes + i)
+    weights[node] = weight()
+    added.append(node)
+    placement = step('add %s' % node, planner, placement, weights)
+
+for node in added:
+    del weights[node]
+    placement = step('remove %s' % node, planner, placement, weights)
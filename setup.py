@@ -8,20 +8,24 @@ setup(name           = 'smhcluster',
     url              = 'http://github.com/seomoz/simhash-cluster',
     author           = 'Dan Lecocq',
     author_email     = 'dan@seomoz.org',
-    packages         = ['smhcluster', 'smhcluster.adapters'],
+    packages         = ['smhcluster', 'smhcluster.adapters',
+        'smhcluster.storage'],
     package_dir      = {
         'smhcluster': 'smhcluster',
-        'smhcluster.adapters': 'smhcluster/adapters'
+        'smhcluster.adapters': 'smhcluster/adapters',
+        'smhcluster.storage': 'smhcluster/storage'
     },
     scripts          = [
         'bin/simhash-master',
-        'bin/simhash-slave'
+        'bin/simhash-slave',
+        'bin/simhash-bulkload'
     ],
     dependencies     = [
         'simhash',   # For obvious reasons
         'boto',      # For persistence to S3
         'bottle',    # For the HTTP adapter
         'gevent',    # For non-blocking goodness
+        'numpy',     # For routing batches of hashes
         'requests',  # For making real http requests
         'zerorpc'    # For RPC with gevent, zeromq
     ],
@@ -56,4 +56,12 @@ class Client(object):
     
     # Bulk form of remove
     def remove_bulk(self, hashes):
+        pass
+    
+    # Find the first near-duplicate, or insert the hash if there isn't one
+    def find_first_or_insert(self, h):
+        pass
+    
+    # Bulk form of find_first_or_insert
+    def find_first_or_insert_bulk(self, hashes):
         pass
\ No newline at end of file
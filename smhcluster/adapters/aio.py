@@ -0,0 +1,182 @@
+# Provides an asyncio interface to the cluster, speaking the pipelined binary
+# protocol described in smhcluster.aio. The cluster itself runs on gevent, so
+# the asyncio loop runs in a thread of its own, and hands each request over to
+# a greenlet on the gevent hub, getting the answer back once it's ready. That
+# thread must be a real one, so this can't share a process with anything that
+# monkey-patches.
+
+import asyncio
+
+import gevent
+import gevent.monkey
+
+from . import Server as _Server
+from . import Client as _Client
+from .. import aio as _aio
+from .. import logger
+
+class Server(_Server):
+    # How many requests from one connection may be underway at once, beyond
+    # which we stop reading from it
+    max_in_flight = 64
+
+    # Accepts a cluster, which contains all the python objects needed to make
+    # queries
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.port    = 4321
+        self.hub     = None
+        self.loop    = None
+        self.server  = None
+        self.writers = set()
+
+    # Idempotently accept new configurations, raising exceptions when
+    # malconfigured
+    def config(self, config):
+        for key in config.keys():
+            if key not in ('port',):
+                raise KeyError('Unknown configuration option %s' % key)
+
+        self.port = config.get('port', self.port)
+
+    # Serve until we're stopped
+    def listen(self):
+        if gevent.monkey.is_module_patched('threading'):
+            raise RuntimeError('The asyncio adapter needs real threads')
+        self.hub = gevent.get_hub()
+        self.hub.threadpool.spawn(self.serve).get()
+
+    def serve(self):
+        # The asyncio thread
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.server = self.loop.run_until_complete(
+                asyncio.start_server(self.handle, '0.0.0.0', self.port))
+            logger.info('asyncio listening on %i' % self.port)
+            self.loop.run_until_complete(self.server.serve_forever())
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.loop.close()
+
+    # Stop, closing every connection
+    def stop(self):
+        if self.loop is not None and self.server is not None:
+            self.loop.call_soon_threadsafe(self.shutdown)
+
+    def shutdown(self):
+        self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+
+    def call(self, method, body):
+        '''Have a greenlet call one of the cluster's packed methods with body,
+        returning a future for what it returns'''
+        future = self.loop.create_future()
+        def run():
+            try:
+                return _aio.OK, getattr(self.cluster, method + '_packed')(body)
+            except Exception as exc:
+                logger.exception('Failed to %s' % method)
+                return _aio.ERROR, repr(exc).encode('utf-8')
+        def done(greenlet):
+            self.loop.call_soon_threadsafe(self.settle, future, greenlet.value)
+        self.hub.loop.run_callback_threadsafe(
+            lambda: gevent.spawn(run).rawlink(done))
+        return future
+
+    @staticmethod
+    def settle(future, value):
+        if not future.done():
+            future.set_result(value)
+
+    async def handle(self, reader, writer):
+        # Answer each request on a connection as soon as it's ready, but apply
+        # writes one at a time, in the order they arrived
+        self.writers.add(writer)
+        slots  = asyncio.Semaphore(self.max_in_flight)
+        writes = asyncio.Lock()
+        try:
+            while True:
+                await slots.acquire()
+                try:
+                    ident, code, body = await _aio.read_frame(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                asyncio.ensure_future(
+                    self.answer(writer, ident, code, body, writes, slots))
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def answer(self, writer, ident, code, body, writes, slots):
+        try:
+            if code >= len(_aio.METHODS):
+                status, result = _aio.ERROR, b'Unknown method %i' % code
+            elif _aio.METHODS[code] in _aio.WRITES:
+                async with writes:
+                    status, result = await self.call(_aio.METHODS[code], body)
+            else:
+                status, result = await self.call(_aio.METHODS[code], body)
+            if not isinstance(result, bytes):
+                # Writes just answer True
+                result = b''
+            if not writer.is_closing():
+                writer.write(_aio.frame(ident, status, result))
+        finally:
+            slots.release()
+
+class Client(_Client):
+    # A blocking client, for scripts. Code running on an asyncio loop should
+    # use smhcluster.aio.Client, which this wraps
+    def __init__(self, host):
+        self.host   = host
+        self.loop   = asyncio.new_event_loop()
+        self.client = self.run(_aio.Client(host).connect())
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def close(self):
+        self.run(self.client.close())
+        self.loop.close()
+
+    # Check for /any/ near-duplicate documents
+    def find_first(self, query):
+        return self.run(self.client.find_first(query))
+
+    # Check for /all/ near-duplicates
+    def find_all(self, query):
+        return self.run(self.client.find_all(query))
+
+    # Bulk form of find_first
+    def find_first_bulk(self, queries):
+        return self.run(self.client.find_first_bulk(queries))
+
+    # Bulk form of find_all
+    def find_all_bulk(self, queries):
+        return self.run(self.client.find_all_bulk(queries))
+
+    # Insert a hash
+    def insert(self, h):
+        return self.run(self.client.insert(h))
+
+    # Bulk form of insert
+    def insert_bulk(self, hashes):
+        return self.run(self.client.insert_bulk(hashes))
+
+    # Remove a hash
+    def remove(self, h):
+        return self.run(self.client.remove(h))
+
+    # Bulk form of remove
+    def remove_bulk(self, hashes):
+        return self.run(self.client.remove_bulk(hashes))
+
+    # Find the first near-duplicate, or insert the hash if there isn't one
+    def find_first_or_insert(self, h):
+        return self.run(self.client.find_first_or_insert(h))
+
+    # Bulk form of find_first_or_insert
+    def find_first_or_insert_bulk(self, hashes):
+        return self.run(self.client.find_first_or_insert_bulk(hashes))
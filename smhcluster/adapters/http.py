@@ -1,11 +1,24 @@
 # Provides a JSON interface to access the simhash cluster
+#
+# The HTTP side runs in a pool of worker processes, which all accept
+# connections on one listening socket that the master opens and hands to each
+# of them. Each worker passes requests on to the master over zerorpc. That way
+# parsing requests and encoding answers is spread over every core rather than
+# competing with the master for its one. The master process itself never has
+# to be monkey-patched, either; only the workers are.
 
-# We need bottle for the server, and requests for the client
-import gevent.monkey
-gevent.monkey; gevent.monkey.patch_all()
-import bottle
-import requests
-from bottle import run, request, abort, Bottle
+# We need bottle for the workers, and requests for the client, but both are
+# only imported where they're used, since the workers have to monkey-patch
+# before importing bottle
+import os
+import sys
+import zlib
+import socket
+import multiprocessing
+
+import numpy
+import gevent
+from gevent import subprocess
 
 try:
     import simplejson as json
@@ -14,106 +27,443 @@ except ImportError:
 
 from . import Server as _Server
 from . import Client as _Client
+from .. import logger
+from .. import packed as _packed
+from .. import ingest as _ingest
+
+def compressor():
+    '''A zlib compressor that writes gzip'''
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
 
 class Server(_Server):
-    # Accepts a cluster, which contains all the python objects needed to make 
+    # How long (in seconds) to wait before restarting a worker that died
+    backoff = 1
+
+    # Accepts a cluster, which contains all the python objects needed to make
     # queries
     def __init__(self, cluster):
-        self.cluster = cluster
-        self.root    = Bottle()
+        self.cluster   = cluster
+        self.host      = 'localhost'
+        self.port      = 8080
+        self.workers   = multiprocessing.cpu_count()
+        # Where the workers can reach the master's zerorpc interface
+        self.master    = '127.0.0.1:1234'
+        self.options   = {}
+        self.socket    = None
+        self.processes = {}
+        self.supervisors = []
+        self.running   = False
 
-    # Idempotently accept new configurations, raising exceptions when 
+    # Idempotently accept new configurations, raising exceptions when
     # malconfigured
     def config(self, config):
         for key in config.keys():
-            if key not in ('port'):
+            if key not in ('host', 'port', 'workers', 'master', 'gzip',
+                'chunk'):
                 raise KeyError('Unknown configuration option %s' % key)
-        
-        self.port = config.get('port', 8080)
-    
-    def first(self, query=None):
-        if query:
-            return json.dumps(self.cluster.find_first(int(query)))
-        return json.dumps(
-            self.cluster.find_first(*json.load(request.body)))
-    
-    def all(self, query=None):
-        if query:
-            return json.dumps(self.cluster.find_all(int(query)))
-        return json.dumps(
-            self.cluster.find_all(*json.load(request.body)))
 
-    def insert(self, h=None):
-        if h:
-            return json.dumps(self.cluster.insert(int(h)))
-        return json.dumps(
-            self.cluster.insert(*json.load(request.body)))
-    
-    def remove(self, h=None):
-        if h:
-            return json.dumps(self.cluster.remove(int(h)))
-        return json.dumps(
-            self.cluster.remove(*json.load(request.body)))
-    
-    # Serve forever
+        self.host    = config.get('host', self.host)
+        self.port    = config.get('port', self.port)
+        self.workers = config.get('workers', self.workers)
+        self.master  = config.get('master', self.master)
+        # Passed on to each worker's Handler
+        self.options = dict((k, config[k]) for k in ('gzip', 'chunk')
+            if k in config)
+
+    # Serve until we're stopped
     def listen(self):
-        # We're doing this a little oddly, because the server is an instance, so
-        # we have to wait until we have an object so that we can attach the
-        # route to a method bound to this instance.
+        family = socket.getaddrinfo(self.host, self.port)[0][0]
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(1024)
+        self.running = True
+        logger.info('HTTP listening on %s:%i with %i workers' % (
+            self.host, self.port, self.workers))
+        self.supervisors = [gevent.spawn(self.supervise, i)
+            for i in range(self.workers)]
+        gevent.joinall(self.supervisors)
+
+    def supervise(self, number):
+        '''Run a worker, starting it again whenever it exits'''
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__))))] +
+            [p for p in [env.get('PYTHONPATH')] if p])
+        fd = self.socket.fileno()
+        while self.running:
+            process = self.processes[number] = subprocess.Popen(
+                [sys.executable, '-m', 'smhcluster.adapters.http', str(fd),
+                str(int(self.socket.family)), self.master,
+                json.dumps(self.options)], env=env, pass_fds=(fd,))
+            process.wait()
+            if not self.running:
+                break
+            logger.error('HTTP worker %i exited with %s; restarting' % (
+                number, process.returncode))
+            gevent.sleep(self.backoff)
+
+    # Stop
+    def stop(self):
+        self.running = False
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.terminate()
+        gevent.joinall(self.supervisors)
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+class Handler(object):
+    # How many queries to ask the master about at once for streamed answers
+    chunk = 1 << 16
+    # JSON answers smaller than this aren't worth compressing
+    minimum = 1024
+
+    # Accepts a client for the master, and the adapter's options
+    def __init__(self, cluster, options):
+        import bottle
+        self.request  = bottle.request
+        self.response = bottle.response
+        self.cluster  = cluster
+        self.gzip     = options.get('gzip', True)
+        self.chunk    = options.get('chunk', self.chunk)
+        self.root     = bottle.Bottle()
+        self.route()
+
+    # We're doing this a little oddly, because the handler is an instance, so
+    # we have to wait until we have an object so that we can attach the route
+    # to a method bound to this instance.
+    def route(self):
         self.root.get(   '/first/<query>'  )(self.first)   # Single
         self.root.post(  '/first'          )(self.first)   # Bulk
         self.root.get(   '/all/<query>'    )(self.all)     # Single
         self.root.post(  '/all'            )(self.all)     # Bulk
+        self.root.put(   '/first_or_insert/<h>')(self.first_or_insert) # Single
+        self.root.post(  '/first_or_insert')(self.first_or_insert)     # Bulk
+        self.root.put(   '/hashes/stream'  )(self.stream_insert)  # Streaming
+        self.root.delete('/hashes/stream'  )(self.stream_remove)  # Streaming
         self.root.put(   '/hashes/<h>'     )(self.insert)  # Single
         self.root.put(   '/hashes'         )(self.insert)  # Bulk
         self.root.delete('/hashes/<h>'     )(self.remove)  # Single
-        self.root.delete('/hashes/'        )(self.remove)  # Bulk
-        
-        # And run it!
-        run(self.root, host='localhost', port=8080, server='gevent')
-        print 'HTTP listening...'
-    
-    # Stop
-    def stop(self):
-        pass
+        self.root.delete('/hashes'         )(self.remove)  # Bulk
+        self.root.get(   '/metrics'        )(self.metrics)
+
+    # Bulk requests may send a packed body instead of JSON
+    def is_packed(self):
+        return self.request.content_type == _packed.CONTENT_TYPE
+
+    # The request's body, which may be gzipped
+    def body(self):
+        body = self.request.body.read()
+        if self.request.get_header('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 31)
+        return body
+
+    # Whether to gzip the response. Packed hashes are much too random to be
+    # worth it, so only JSON is
+    def compressing(self):
+        return (self.gzip and
+            self.response.content_type != _packed.CONTENT_TYPE and
+            'gzip' in self.request.get_header('Accept-Encoding', ''))
+
+    def reply(self, body):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        if len(body) >= self.minimum and self.compressing():
+            self.response.set_header('Content-Encoding', 'gzip')
+            self.response.set_header('Vary', 'Accept-Encoding')
+            gzip = compressor()
+            body = gzip.compress(body) + gzip.flush()
+        return body
+
+    def streamed(self, chunks):
+        '''A response made of chunks as they come, gzipped if it can be'''
+        if not self.compressing():
+            return chunks
+        self.response.set_header('Content-Encoding', 'gzip')
+        self.response.set_header('Vary', 'Accept-Encoding')
+        def compressed():
+            gzip = compressor()
+            for chunk in chunks:
+                chunk = gzip.compress(chunk)
+                if chunk:
+                    yield chunk
+            yield gzip.flush()
+        return compressed()
+
+    def split(self, queries):
+        return [queries[offset:offset + self.chunk]
+            for offset in range(0, len(queries), self.chunk)]
+
+    def ahead(self, method, calls):
+        '''Call one of the master's methods with each of a list of arguments,
+        yielding each answer while the next is on its way'''
+        method  = getattr(self.cluster, method)
+        pending = [gevent.spawn(method, *args) for args in calls[:1]]
+        for i in range(len(calls)):
+            if i + 1 < len(calls):
+                pending.append(gevent.spawn(method, *calls[i + 1]))
+            yield pending.pop(0).get()
+
+    def first(self, query=None):
+        if query:
+            return self.reply(json.dumps(self.cluster.find_first(int(query))))
+        if self.is_packed():
+            self.response.content_type = _packed.CONTENT_TYPE
+            return self.cluster.find_first_packed(self.body())
+        return self.reply(json.dumps(
+            self.cluster.find_first(*json.loads(self.body()))))
+
+    # Bulk answers can be big, so they're streamed back a chunk at a time, as
+    # the master answers each
+    def all(self, query=None):
+        if query:
+            return self.reply(json.dumps(self.cluster.find_all(int(query))))
+        if self.is_packed():
+            self.response.content_type = _packed.CONTENT_TYPE
+            return self.all_packed(_packed.unpack_hashes(self.body()))
+        return self.streamed(self.all_json(json.loads(self.body())))
+
+    def all_json(self, queries):
+        # The same JSON list as all at once, written out piece by piece
+        yield b'['
+        first = True
+        for results in self.ahead('find_all', self.split(queries)):
+            if results:
+                yield (b'' if first else b', ') + json.dumps(
+                    results)[1:-1].encode('utf-8')
+                first = False
+        yield b']'
+
+    def all_packed(self, queries):
+        # The packed format puts every set's offset before any of the values,
+        # so this waits for every chunk's answer, but then sends the header and
+        # each chunk's values without gathering them into one buffer first
+        answers = [numpy.frombuffer(buf, dtype=_packed.DTYPE)
+            for buf in self.ahead('find_all_packed',
+            [(_packed.pack_hashes(chunk),) for chunk in self.split(queries)])]
+        header  = [numpy.array([0, 0], dtype=_packed.DTYPE)]
+        values, base = [], 0
+        for answer in answers:
+            count = int(answer[0]) if len(answer) else 0
+            if not count:
+                continue
+            offsets = answer[2:count + 2]
+            header[0][0] += count
+            header.append(offsets + numpy.uint64(base))
+            base += int(offsets[-1])
+            values.append(answer[count + 2:])
+        yield numpy.concatenate(header).tobytes()
+        for value in values:
+            yield value.tobytes()
+
+    def insert(self, h=None):
+        if h:
+            return self.reply(json.dumps(self.cluster.insert(int(h))))
+        if self.is_packed():
+            return self.reply(json.dumps(
+                self.cluster.insert_packed(self.body())))
+        return self.reply(json.dumps(
+            self.cluster.insert(*json.loads(self.body()))))
+
+    def remove(self, h=None):
+        if h:
+            return self.reply(json.dumps(self.cluster.remove(int(h))))
+        if self.is_packed():
+            return self.reply(json.dumps(
+                self.cluster.remove_packed(self.body())))
+        return self.reply(json.dumps(
+            self.cluster.remove(*json.loads(self.body()))))
+
+    # Check for a near-duplicate, and insert the hash if there isn't one. The
+    # answer is the near-duplicate found, or 0 if it was inserted
+    def first_or_insert(self, h=None):
+        if h:
+            return self.reply(json.dumps(
+                self.cluster.find_first_or_insert(int(h))))
+        if self.is_packed():
+            self.response.content_type = _packed.CONTENT_TYPE
+            return self.cluster.find_first_or_insert_packed(self.body())
+        return self.reply(json.dumps(
+            self.cluster.find_first_or_insert(*json.loads(self.body()))))
+
+    # Stream in hashes to insert or remove, either packed or one per line. The
+    # body may be (and for large uploads, should be) sent chunked. Hashes are
+    # passed on to the cluster as they arrive, and the response is a line of
+    # JSON for each chunk the slaves finish with, followed by the overall
+    # progress once everything is done. The status has been sent by the time
+    # anything goes wrong, so errors are reported in a line of their own, and
+    # the stream is closed however the response ends
+    def stream(self, method):
+        stream = self.request.environ['wsgi.input']
+        if self.is_packed():
+            arrays = _ingest.read_packed(stream)
+        else:
+            arrays = _ingest.read_lines(stream)
+        key = self.cluster.ingest_open(method)
+        self.response.content_type = 'application/x-ndjson'
+        def reports():
+            closed = False
+            try:
+                try:
+                    for hashes in arrays:
+                        self.cluster.ingest_feed(key,
+                            _packed.pack_hashes(hashes))
+                        for report in self.cluster.ingest_finished(key):
+                            yield json.dumps(report) + '\n'
+                except Exception as exc:
+                    logger.exception('Failed to stream in hashes')
+                    yield json.dumps({'error': repr(exc)}) + '\n'
+                for report in self.cluster.ingest_finished(key, True):
+                    yield json.dumps(report) + '\n'
+                closed = True
+                yield json.dumps(self.cluster.ingest_close(key)) + '\n'
+            finally:
+                if not closed:
+                    self.cluster.ingest_close(key)
+        return reports()
+
+    def stream_insert(self):
+        return self.stream('insert')
+
+    def stream_remove(self):
+        return self.stream('remove')
+
+    # Timings and counts from the master, and optionally each of the slaves
+    def metrics(self):
+        self.response.content_type = 'application/json'
+        return self.reply(json.dumps(self.cluster.metrics(
+            self.request.query.get('slaves') in ('1', 'true'))))
+
+def work(fd, family, master, options):
+    '''Serve HTTP on the listening socket fd as one of the master's workers,
+    until it stops us'''
+    import gevent.monkey
+    gevent.monkey.patch_all()
+    import zerorpc
+    from gevent.pywsgi import WSGIServer
+    listener = socket.fromfd(fd, family, socket.SOCK_STREAM)
+    handler  = Handler(zerorpc.Client('tcp://%s' % master), options)
+    WSGIServer(listener, handler.root, log=None).serve_forever()
 
 class Client(_Client):
-    # Accepts a host to which to speak
-    def __init__(self, host):
-        self.host = host
+    # Headers for sending packed bodies
+    headers = {'Content-Type': _packed.CONTENT_TYPE}
+
+    # Accepts a host to which to speak, like http://localhost:8080. Connections
+    # are kept alive and reused, up to `connections` of them at once. With
+    # gzip, JSON request bodies are sent gzipped (answers are gzipped whenever
+    # the server thinks it's worth it)
+    def __init__(self, host, connections=10, gzip=False):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.host    = host.rstrip('/')
+        self.gzip    = gzip
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, path, body=None, packed=False, **kwargs):
+        headers = {}
+        if packed:
+            headers.update(self.headers)
+        elif body is not None:
+            headers['Content-Type'] = 'application/json'
+            body = json.dumps(body).encode('utf-8')
+            if self.gzip:
+                gzip = compressor()
+                body = gzip.compress(body) + gzip.flush()
+                headers['Content-Encoding'] = 'gzip'
+        r = self.session.request(method, self.host + path, data=body,
+            headers=headers, **kwargs)
+        r.raise_for_status()
+        return r
 
     # Check for /any/ near-duplicate documents
     def find_first(self, query):
-        return json.loads(requests.get(self.host + '/first/' + query).content)
+        return self.request('GET', '/first/%i' % query).json()
 
     # Check for /all/ near-duplicates
     def find_all(self, query):
-        return json.loads(requests.get(self.host + '/all/' + query).content)
-
-    # Bulk form of find_first
-    def find_first_bulk(self, queries):
-        r = requests.post(self.host + '/first', data=json.dumps(queries))
-        return json.loads(r.content)
-    
-    # Bulk form of find_all
-    def find_all_bulk(self, queries):
-        r = requests.post(self.host + '/all', data=json.dumps(queries))
-        return json.loads(r.content)
-    
+        return self.request('GET', '/all/%i' % query).json()
+
+    # Bulk form of find_first. With packed, queries may be a numpy array, and
+    # the result is an array of the first match for each query
+    def find_first_bulk(self, queries, packed=False):
+        if packed:
+            return _packed.unpack_hashes(self.request('POST', '/first',
+                _packed.pack_hashes(queries), packed=True).content)
+        return self.request('POST', '/first', list(queries)).json()
+
+    # Bulk form of find_all. With packed, the result is a list of arrays
+    def find_all_bulk(self, queries, packed=False):
+        if packed:
+            return _packed.unpack_sets(self.request('POST', '/all',
+                _packed.pack_hashes(queries), packed=True).content)
+        return self.request('POST', '/all', list(queries)).json()
+
     # Insert a hash
     def insert(self, h):
-        return json.loads(requests.put(self.host + '/hashes/' + h))
-    
+        return self.request('PUT', '/hashes/%i' % h).json()
+
     # Bulk form of insert
-    def insert_bulk(self, hashes):
-        r = requests.put(self.host + '/hashes', data=json.dumps(hashes))
-        return json.loads(r.content)
-    
+    def insert_bulk(self, hashes, packed=False):
+        if packed:
+            return self.request('PUT', '/hashes',
+                _packed.pack_hashes(hashes), packed=True).json()
+        return self.request('PUT', '/hashes', list(hashes)).json()
+
     # Remove a hash
     def remove(self, h):
-        return json.loads(requests.delete(self.host + '/hashes/' + h))
-    
+        return self.request('DELETE', '/hashes/%i' % h).json()
+
     # Bulk form of remove
-    def remove_bulk(self, hashes):
-        r = requests.delete(self.host + '/hashes', data=json.dumps(hashes))
-        return json.loads(r.content)
+    def remove_bulk(self, hashes, packed=False):
+        if packed:
+            return self.request('DELETE', '/hashes',
+                _packed.pack_hashes(hashes), packed=True).json()
+        return self.request('DELETE', '/hashes', list(hashes)).json()
+
+    # Find the first near-duplicate, or insert the hash if there isn't one
+    def find_first_or_insert(self, h):
+        return self.request('PUT', '/first_or_insert/%i' % h).json()
+
+    # Bulk form of find_first_or_insert. With packed, the result is an array of
+    # the near-duplicate found for each hash, or 0 where it was inserted
+    def find_first_or_insert_bulk(self, hashes, packed=False):
+        if packed:
+            return _packed.unpack_hashes(self.request('POST',
+                '/first_or_insert', _packed.pack_hashes(hashes),
+                packed=True).content)
+        return self.request('POST', '/first_or_insert', list(hashes)).json()
+
+    # Stream in hashes to insert (or with remove, to remove). Hashes may be any
+    # iterable of ints or of arrays of them, and are sent chunked. Yields the
+    # report for each chunk as the cluster finishes with it, and finally the
+    # overall progress
+    def ingest(self, hashes, packed=True, remove=False):
+        def body():
+            for h in hashes:
+                if packed:
+                    yield _packed.pack_hashes(numpy.atleast_1d(h))
+                else:
+                    yield ''.join('%i\n' % i
+                        for i in numpy.atleast_1d(h).tolist()).encode('ascii')
+        r = self.session.request('DELETE' if remove else 'PUT',
+            self.host + '/hashes/stream', data=body(), stream=True,
+            headers=self.headers if packed else {'Content-Type': 'text/plain'})
+        r.raise_for_status()
+        for line in r.iter_lines():
+            if line:
+                yield json.loads(line)
+
+    # Timings and counts from the master, and with slaves, from each slave
+    def metrics(self, slaves=False):
+        return self.request('GET', '/metrics',
+            params={'slaves': '1' if slaves else '0'}).json()
+
+if __name__ == '__main__':
+    work(int(sys.argv[1]), int(sys.argv[2]), sys.argv[3],
+        json.loads(sys.argv[4]))
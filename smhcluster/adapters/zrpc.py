@@ -1,8 +1,11 @@
 # Provides a zerorpc interface to the cluster
 
+import numpy
 import zerorpc
 
 from . import Server as _Server
+from . import Client as _Client
+from .. import packed as _packed
 
 class Server(_Server):
     # Accepts a cluster, which contains all the python objects needed to make 
@@ -32,3 +35,69 @@ class Server(_Server):
     def stop(self):
         self.server.stop()
         del self.server
+
+class Client(_Client):
+    # Accepts a host to which to speak
+    def __init__(self, host):
+        self.host   = host
+        self.client = zerorpc.Client('tcp://%s' % host)
+    
+    # Check for /any/ near-duplicate documents
+    def find_first(self, query):
+        return self.client.find_first(query)
+    
+    # Check for /all/ near-duplicates
+    def find_all(self, query):
+        return self.client.find_all(query)
+    
+    # Bulk form of find_first
+    def find_first_bulk(self, queries):
+        return self.client.find_first(*queries)
+    
+    # Bulk form of find_all
+    def find_all_bulk(self, queries):
+        return self.client.find_all(*queries)
+    
+    # Insert a hash
+    def insert(self, h):
+        return self.client.insert(h)
+    
+    # Bulk form of insert
+    def insert_bulk(self, hashes):
+        return self.client.insert(*hashes)
+    
+    # Remove a hash
+    def remove(self, h):
+        return self.client.remove(h)
+    
+    # Bulk form of remove
+    def remove_bulk(self, hashes):
+        return self.client.remove(*hashes)
+    
+    # Find the first near-duplicate, or insert the hash if there isn't one
+    def find_first_or_insert(self, h):
+        return self.client.find_first_or_insert(h)
+    
+    # Bulk form of find_first_or_insert
+    def find_first_or_insert_bulk(self, hashes):
+        return self.client.find_first_or_insert(*hashes)
+    
+    # Stream in hashes to insert (or with remove, to remove), `chunk` at a time.
+    # Hashes may be any iterable of ints or of arrays of them. Each chunk is
+    # only sent once the master has room for it, and this yields the progress
+    # after each one, and finally once everything has been acknowledged
+    def ingest(self, hashes, remove=False, chunk=1 << 16):
+        key = self.client.ingest_open('remove' if remove else 'insert')
+        buffered, count = [], 0
+        for h in hashes:
+            h = numpy.atleast_1d(numpy.asarray(h, dtype=numpy.uint64))
+            buffered.append(h)
+            count += len(h)
+            if count >= chunk:
+                yield self.client.ingest_feed(
+                    key, _packed.pack_hashes(numpy.concatenate(buffered)))
+                buffered, count = [], 0
+        if buffered:
+            yield self.client.ingest_feed(
+                key, _packed.pack_hashes(numpy.concatenate(buffered)))
+        yield self.client.ingest_close(key)
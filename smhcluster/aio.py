@@ -0,0 +1,252 @@
+#! /usr/bin/env python
+
+# An asyncio client for the cluster, for code that runs on an asyncio loop
+# rather than on gevent. It speaks a small binary protocol to the asyncio
+# adapter (smhcluster.adapters.aio) over one persistent connection:
+#
+#   request : id (uint32) method (uint8) length (uint32) body
+#   response: id (uint32) status (uint8) length (uint32) body
+#
+# Bodies are in the packed format (see smhcluster.packed), except that error
+# responses carry the error instead. Requests are pipelined: any number of them
+# may be sent without waiting, and answers come back as they're ready, matched
+# up by id. Writes on one connection are applied in the order they were sent.
+#
+# Calls made at about the same time (within `window` seconds, or until there
+# are `count` hashes) are gathered up into one request per method, so that many
+# tasks each asking about a single hash cost about as much as one bulk request.
+# Unlike the master's coalescing, nothing is dropped: every call gets its own
+# answer, and writes of one kind are only gathered until a write of another
+# kind comes along, so their order is kept.
+
+import struct
+import asyncio
+
+import numpy
+
+from . import packed
+
+HEADER = struct.Struct('<IBI')
+
+# Methods, by their number on the wire, and which of them write
+METHODS = ('find_first', 'find_all', 'insert', 'remove', 'find_first_or_insert')
+WRITES  = ('insert', 'remove', 'find_first_or_insert')
+
+# Response statuses
+OK, ERROR = 0, 1
+
+def frame(ident, code, body):
+    '''A request or response, ready to send'''
+    return HEADER.pack(ident, code, len(body)) + body
+
+async def read_frame(reader):
+    '''Read a request or response, as a tuple of (id, method or status, body).
+    Raises asyncio.IncompleteReadError if the connection is closed first'''
+    ident, code, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return ident, code, await reader.readexactly(length)
+
+class Batch(object):
+    '''Calls of one method, gathered up to be sent as one request'''
+    def __init__(self, method):
+        self.method  = method
+        self.arrays  = []
+        self.futures = []
+
+    def add(self, hashes, future):
+        self.arrays.append(hashes)
+        self.futures.append(future)
+
+    def body(self):
+        return packed.pack_hashes(numpy.concatenate(self.arrays))
+
+    def resolve(self, body):
+        '''Give each call its part of the answer'''
+        if self.method == 'find_all':
+            results = packed.unpack_sets(body)
+        elif self.method in ('find_first', 'find_first_or_insert'):
+            results = packed.unpack_hashes(body)
+        else:
+            results = None
+        offset = 0
+        for hashes, future in zip(self.arrays, self.futures):
+            if not future.done():
+                future.set_result(True if results is None else
+                    results[offset:offset + len(hashes)])
+            offset += len(hashes)
+
+    def fail(self, exc):
+        for future in self.futures:
+            if not future.done():
+                future.set_exception(exc)
+
+class Client(object):
+    # Raised for calls on a connection that's closed, or that was lost before
+    # they were answered
+    class Closed(Exception):
+        def __init__(self, value):
+            Exception.__init__(self, value)
+
+    # Raised for calls the cluster failed to answer, with its reason
+    class Failed(Exception):
+        def __init__(self, value):
+            Exception.__init__(self, value)
+
+    # Accepts a host:port to which to speak
+    def __init__(self, host, window=0.001, count=1 << 14):
+        self.host     = host
+        # How long (in seconds) to gather calls for, and how many hashes to
+        # gather before sending them early
+        self.window   = window
+        self.count    = count
+        self.reader   = None
+        self.writer   = None
+        self.receiver = None
+        self.ident    = 0
+        # Requests that have been sent, by id
+        self.waiting  = {}
+        # Reads being gathered, by method, and writes, in order
+        self.reads    = {}
+        self.writes   = []
+        self.gathered = 0
+        self.timer    = None
+
+    async def connect(self):
+        host, port = self.host.rsplit(':', 1)
+        self.reader, self.writer = await asyncio.open_connection(
+            host, int(port))
+        self.receiver = asyncio.ensure_future(self.receive())
+        return self
+
+    async def close(self):
+        '''Send anything that's been gathered, wait for every answer, and then
+        close the connection'''
+        if self.writer is None:
+            return
+        self.flush()
+        futures = [f for batch in list(self.waiting.values())
+            for f in batch.futures]
+        if futures:
+            await asyncio.wait(futures)
+        writer, self.writer = self.writer, None
+        writer.close()
+        self.receiver.cancel()
+        try:
+            await self.receiver
+        except asyncio.CancelledError:
+            pass
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def next_ident(self):
+        self.ident = (self.ident + 1) & 0xFFFFFFFF
+        return self.ident
+
+    async def receive(self):
+        '''Hand each answer to the calls waiting on it, until the connection is
+        closed'''
+        try:
+            while True:
+                ident, status, body = await read_frame(self.reader)
+                batch = self.waiting.pop(ident, None)
+                if batch is None:
+                    continue
+                if status == OK:
+                    batch.resolve(body)
+                else:
+                    batch.fail(Client.Failed(body.decode('utf-8')))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            # Nothing more is coming, so everyone still waiting has lost out
+            self.writer = None
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            exc = Client.Closed('Lost connection to %s' % self.host)
+            for batch in (list(self.waiting.values()) + self.writes +
+                list(self.reads.values())):
+                batch.fail(exc)
+            self.waiting, self.reads, self.writes = {}, {}, []
+
+    def flush(self):
+        '''Send everything that's been gathered so far'''
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batches = self.writes + list(self.reads.values())
+        self.reads, self.writes, self.gathered = {}, [], 0
+        for batch in batches:
+            ident = self.next_ident()
+            self.waiting[ident] = batch
+            self.writer.write(
+                frame(ident, METHODS.index(batch.method), batch.body()))
+
+    async def call(self, method, hashes):
+        '''Gather up a call to be sent with any others made at about the same
+        time, and return its part of the answer'''
+        if self.writer is None:
+            raise Client.Closed('Not connected to %s' % self.host)
+        hashes = numpy.atleast_1d(numpy.asarray(hashes, dtype=packed.DTYPE))
+        loop   = asyncio.get_event_loop()
+        future = loop.create_future()
+        if method in WRITES:
+            if not self.writes or self.writes[-1].method != method:
+                self.writes.append(Batch(method))
+            batch = self.writes[-1]
+        else:
+            batch = self.reads.get(method)
+            if batch is None:
+                batch = self.reads[method] = Batch(method)
+        batch.add(hashes, future)
+        self.gathered += len(hashes)
+        if self.gathered >= self.count:
+            self.flush()
+            await self.writer.drain()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self.flush)
+        return await future
+
+    # Check for /any/ near-duplicate documents
+    async def find_first(self, query):
+        return int((await self.call('find_first', query))[0])
+
+    # Check for /all/ near-duplicates
+    async def find_all(self, query):
+        return (await self.call('find_all', query))[0].tolist()
+
+    # Bulk form of find_first, returning an array of the first match for each
+    async def find_first_bulk(self, queries):
+        return await self.call('find_first', queries)
+
+    # Bulk form of find_all, returning a list of arrays
+    async def find_all_bulk(self, queries):
+        return await self.call('find_all', queries)
+
+    # Insert a hash
+    async def insert(self, h):
+        return await self.call('insert', h)
+
+    # Bulk form of insert
+    async def insert_bulk(self, hashes):
+        return await self.call('insert', hashes)
+
+    # Remove a hash
+    async def remove(self, h):
+        return await self.call('remove', h)
+
+    # Bulk form of remove
+    async def remove_bulk(self, hashes):
+        return await self.call('remove', hashes)
+
+    # Find the first near-duplicate, or insert the hash if there isn't one
+    async def find_first_or_insert(self, h):
+        return int((await self.call('find_first_or_insert', h))[0])
+
+    # Bulk form of find_first_or_insert, returning an array of the
+    # near-duplicate found for each hash, or 0 where it was inserted
+    async def find_first_or_insert_bulk(self, hashes):
+        return await self.call('find_first_or_insert', hashes)
@@ -0,0 +1,269 @@
+#! /usr/bin/env python
+
+# Offline bulk loading. Rather than sending every hash (and every one of its
+# variants) through the master, this builds every shard's snapshot straight
+# from dumps of hashes, to be put wherever the slaves keep their snapshots.
+#
+# It happens in two passes, both spread over a pool of processes:
+#
+#   1. Each input is split into pieces of whole records by byte range, and the
+#      pieces are shared out between the processes, so that even a single
+#      large dump keeps them all busy. Each piece is read in chunks, and each
+#      hash (and each of its variants, unless the cluster probes) is routed to
+#      its shard just like `Master.insert` would. Each process appends what it
+#      routes to a spill file per shard on local disk.
+#   2. Each shard's spill files are sorted and deduplicated, in memory if they
+#      fit within the budget, and otherwise as sorted runs merged together, and
+#      the result is saved as that shard's snapshot.
+
+import os
+import shutil
+import tempfile
+import multiprocessing
+
+import numpy
+import gevent
+
+from . import logger
+from .routing import Router
+from .ingest import read_lines, read_packed
+
+DTYPE = numpy.dtype('<u8')
+
+def ranges(shards):
+    '''The (start, end) of each shard, just as the master divides them'''
+    return [(i * (1 << 64) // shards, (i + 1) * (1 << 64) // shards - 1)
+        for i in range(shards)]
+
+def detect(path, fmt='auto'):
+    '''The format of a dump: either packed little-endian uint64s, or one hash
+    per line for text dumps (by default, those whose names end in .txt)'''
+    if fmt == 'auto':
+        return 'text' if path.endswith('.txt') else 'packed'
+    return fmt
+
+class Section(object):
+    '''The bytes of a file from start up to end, as a file-like object'''
+    def __init__(self, f, start, end):
+        f.seek(start)
+        self.f         = f
+        self.remaining = end - start
+
+    def read(self, size):
+        data = self.f.read(min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+def pieces(path, fmt='auto', size=1 << 28):
+    '''Split a dump into (path, fmt, start, end) byte ranges of roughly `size`
+    bytes, each starting and ending between records'''
+    fmt    = detect(path, fmt)
+    total  = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for offset in range(size, total, size):
+            if fmt == 'text':
+                # Move on to the start of the next line
+                f.seek(offset - 1)
+                f.readline()
+                offset = f.tell()
+            else:
+                offset -= offset % 8
+            if bounds[-1] < offset < total:
+                bounds.append(offset)
+    bounds.append(total)
+    return [(path, fmt, start, end) for start, end in zip(bounds, bounds[1:])]
+
+def read(path, fmt='auto', size=1 << 24, start=0, end=None):
+    '''Read a dump of hashes (or the piece of it from byte start up to end),
+    yielding arrays of them'''
+    fmt = detect(path, fmt)
+    end = os.path.getsize(path) if end is None else end
+    with open(path, 'rb') as f:
+        section = Section(f, start, end)
+        if fmt == 'text':
+            for hashes in read_lines(section, size):
+                yield hashes
+        else:
+            for hashes in read_packed(section, size):
+                yield hashes
+
+def fresh():
+    '''Run in each of the pool's processes first. They're forked from one that
+    may be using gevent itself (storage backends yield to it as they save), so
+    they start their own hub rather than using one still watching the parent's
+    sockets'''
+    gevent.get_hub().destroy(destroy_loop=True)
+
+def partition(args):
+    '''Route the hashes in some pieces of dumps to their shards, appending them
+    to the spill files in a directory of our own. Returns how many hashes we
+    read'''
+    pieces, directory, shards, differing_bits, memory, probe = args
+    router = Router(differing_bits, shards)
+    # With a power-of-two number of shards, a hash's shard is its top bits
+    shift  = numpy.uint64(64 - (shards.bit_length() - 1))
+    os.makedirs(directory)
+    # Hashes routed to each shard that haven't been written out yet
+    buffered, size, count = {}, 0, 0
+
+    def spill():
+        for shard, arrays in buffered.items():
+            with open(os.path.join(directory, '%i.bin' % shard), 'ab') as f:
+                for array in arrays:
+                    f.write(array.astype(DTYPE).tobytes())
+        buffered.clear()
+
+    for path, fmt, start, end in pieces:
+        for hashes in read(path, fmt, start=start, end=end):
+            count += len(hashes)
+            if probe:
+                queries = hashes
+            else:
+                queries, hashes = router.variants(hashes)
+            shard = (queries >> shift).astype(numpy.intp)
+            order = numpy.argsort(shard, kind='stable')
+            shard, hashes = shard[order], hashes[order]
+            # Where each shard's hashes start and end in this chunk
+            bounds = (numpy.flatnonzero(numpy.diff(shard)) + 1).tolist()
+            for s, e in zip([0] + bounds, bounds + [len(shard)]):
+                if e > s:
+                    buffered.setdefault(int(shard[s]), []).append(hashes[s:e])
+            size += hashes.nbytes
+            if size >= memory:
+                spill()
+                size = 0
+        logger.info('Partitioned %s (bytes %i to %i)' % (path, start, end))
+    spill()
+    return count
+
+def merge(runs, block):
+    '''Merge sorted, deduplicated arrays (usually memory-mapped), yielding
+    sorted, deduplicated arrays of at most about `block` hashes from each'''
+    positions = [0] * len(runs)
+    last = None
+    while True:
+        heads = [(i, run[positions[i]:positions[i] + block])
+            for i, run in enumerate(runs) if positions[i] < len(run)]
+        if not heads:
+            break
+        # Everything up to the smallest of the last hashes we've read from each
+        # run is as small as anything we haven't read yet
+        cutoff = min(head[-1] for i, head in heads)
+        parts  = []
+        for i, head in heads:
+            take = int(numpy.searchsorted(head, cutoff, side='right'))
+            parts.append(head[:take])
+            positions[i] += take
+        merged = numpy.unique(numpy.concatenate(parts))
+        if last is not None and len(merged) and merged[0] == last:
+            merged = merged[1:]
+        if len(merged):
+            last = merged[-1]
+            yield merged
+
+def build(args):
+    '''Sort and deduplicate all the spill files for one shard, and save the
+    result as its snapshot. Returns how many hashes are in it'''
+    shard, (start, end), spills, storage, directory, memory = args
+    paths = [p for p in spills if os.path.exists(p)]
+    total = sum(os.path.getsize(p) for p in paths) // 8
+    if total * DTYPE.itemsize <= memory:
+        if paths:
+            hashes = numpy.unique(numpy.concatenate(
+                [numpy.fromfile(p, dtype=DTYPE) for p in paths]))
+        else:
+            hashes = numpy.empty(0, dtype=DTYPE)
+        storage.save(start, end, hashes)
+        for path in paths:
+            os.remove(path)
+        return len(hashes)
+
+    # Too big to sort in one go, so sort it in runs that are, and merge them
+    runs, budget = [], max(memory // DTYPE.itemsize, 1)
+    for path in paths:
+        data = numpy.memmap(path, dtype=DTYPE, mode='r')
+        for offset in range(0, len(data), budget):
+            run = os.path.join(directory, '%i-run-%i.bin' % (shard, len(runs)))
+            numpy.unique(data[offset:offset + budget]).tofile(run)
+            runs.append(run)
+        del data
+    runs = [numpy.memmap(run, dtype=DTYPE, mode='r') for run in runs]
+    merged = os.path.join(directory, '%i-merged.bin' % shard)
+    count  = 0
+    with open(merged, 'wb') as f:
+        for hashes in merge(runs, max(budget // (len(runs) + 1), 1)):
+            f.write(hashes.tobytes())
+            count += len(hashes)
+    # Done with the spill files and runs, which could be using a lot of disk
+    for path in paths + [run.filename for run in runs]:
+        os.remove(path)
+    del runs
+    hashes = numpy.memmap(merged, dtype=DTYPE, mode='r') if count else (
+        numpy.empty(0, dtype=DTYPE))
+    storage.save(start, end, hashes)
+    del hashes
+    os.remove(merged)
+    return count
+
+class Loader(object):
+    def __init__(self, storage, shards=1024, differing_bits=3,
+        processes=None, memory=1 << 28, tmp=None, fmt='auto', probe=False,
+        piece=None):
+        # Where to save snapshots, as a storage backend (like Disk)
+        self.storage        = storage
+        self.shards         = shards
+        self.differing_bits = differing_bits
+        if shards & (shards - 1):
+            raise ValueError('The number of shards must be a power of two')
+        self.processes      = processes or multiprocessing.cpu_count()
+        # Roughly how much memory (in bytes) each process may use for buffering
+        # and sorting
+        self.memory         = memory
+        # Where to keep spill files while we work
+        self.tmp            = tmp
+        self.fmt            = fmt
+        # Whether each hash is stored only in its own shard (see Master.probe)
+        self.probe          = probe
+        # Roughly how many bytes of input to give a process at a time. By
+        # default, enough for each process to get a few pieces
+        self.piece          = piece
+
+    def load(self, paths):
+        '''Build every shard's snapshot from these dumps. Returns a tuple of how
+        many hashes were read, and a mapping of shard number -> how many
+        distinct hashes it has'''
+        directory = tempfile.mkdtemp(prefix='simhash-bulkload-', dir=self.tmp)
+        pool = multiprocessing.Pool(self.processes, fresh)
+        try:
+            # Split the inputs into pieces, and spread them over the
+            # processes, biggest first onto whichever has the least so far
+            total = sum(os.path.getsize(path) for path in paths)
+            size  = self.piece or max(total // (self.processes * 4), 1 << 20)
+            split = sorted((p for path in paths
+                for p in pieces(path, self.fmt, size)),
+                key=lambda p: p[3] - p[2], reverse=True)
+            groups, loads = [[] for i in range(self.processes)], (
+                [0] * self.processes)
+            for p in split:
+                i = loads.index(min(loads))
+                groups[i].append(p)
+                loads[i] += p[3] - p[2]
+            spills = [os.path.join(directory, 'spill-%i' % i)
+                for i in range(len(groups))]
+            read = sum(pool.map(partition, [(group, spill,
+                self.shards, self.differing_bits, self.memory, self.probe)
+                for group, spill in zip(groups, spills)]))
+            logger.info('Partitioned %i hashes' % read)
+
+            counts = pool.map(build, [(shard, bounds,
+                [os.path.join(spill, '%i.bin' % shard) for spill in spills],
+                self.storage, directory, self.memory)
+                for shard, bounds in enumerate(ranges(self.shards))])
+            logger.info('Built %i shards with %i hashes' % (
+                self.shards, sum(counts)))
+            return read, dict(enumerate(counts))
+        finally:
+            pool.close()
+            pool.join()
+            shutil.rmtree(directory)
@@ -0,0 +1,170 @@
+#! /usr/bin/env python
+
+# A cache of query results on the master. The same hashes get checked over and
+# over, and each check is a round trip to a slave, so answers are kept (in LRU
+# order, up to a memory budget) until a write could have changed them.
+#
+# An insert or remove of h can only change the answer for a query q if h is
+# within `differing_bits` of q. To find those queries without looking at every
+# one, we use the same trick as the index: split hashes into differing_bits + 1
+# blocks, and any two hashes that close must agree exactly on at least one of
+# them. So cached queries are also filed under each of their blocks.
+#
+# A query that's in flight when a write lands could come back with an answer
+# from before the write. To keep from caching that, each miss leaves a token
+# in the cache, which a write will clear out like any other entry, and a result
+# is only kept if its token is still there when it arrives.
+
+import time
+from collections import OrderedDict
+
+class Cache(object):
+    # Roughly how many bytes each cached query costs, besides the hashes in its
+    # results: the entry, its place in the LRU order and in the block index
+    overhead = 400
+
+    def __init__(self, differing_bits=3, metrics=None):
+        self.metrics  = metrics
+        self.enabled  = False
+        # How much memory (in bytes) the cache may use
+        self.memory   = 1 << 26
+        # Whether to keep answers of 'no near-duplicates'
+        self.negative = True
+        # How long (in seconds) answers may be kept at all, if not forever
+        self.ttl      = None
+        self.hits     = 0
+        self.misses   = 0
+        self.reset(differing_bits)
+
+    # Idempotently accept new configurations
+    def config(self, config):
+        for key in config.keys():
+            if key not in ('enabled', 'memory', 'negative', 'ttl'):
+                raise KeyError('Unknown configuration option %s' % key)
+        self.enabled  = config.get('enabled', bool(config))
+        self.memory   = config.get('memory', self.memory)
+        self.negative = config.get('negative', self.negative)
+        self.ttl      = config.get('ttl', self.ttl)
+        if not self.enabled:
+            self.reset(self.differing_bits)
+        self.evict()
+
+    def reset(self, differing_bits):
+        '''Forget everything, and file queries by blocks for differing_bits'''
+        self.differing_bits = differing_bits
+        # The (shift, mask) of each block
+        blocks = differing_bits + 1
+        self.blocks = []
+        for i in range(blocks):
+            start = i * 64 // blocks
+            end   = (i + 1) * 64 // blocks
+            self.blocks.append((start, (1 << (end - start)) - 1))
+        # A mapping of query -> {method: (result, time) or token}, in LRU order
+        self.entries = OrderedDict()
+        # A mapping of (block, value) -> set of queries
+        self.index   = {}
+        self.bytes   = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self, h):
+        return [(i, (h >> shift) & mask)
+            for i, (shift, mask) in enumerate(self.blocks)]
+
+    def size(self, entry):
+        return self.overhead + sum(8 * len(value[0])
+            for value in entry.values() if isinstance(value, tuple) and
+            isinstance(value[0], list))
+
+    def hit_rate(self):
+        return self.hits / float(self.hits + self.misses or 1)
+
+    def lookup(self, method, queries):
+        '''Look up each of an array of queries. Returns (indices of hits,
+        their results, indices of misses, token) where the token should be
+        passed along to `store` with the answers to the misses'''
+        token, now = object(), time.time()
+        hits, results, misses = [], [], []
+        for i, q in enumerate(queries.tolist()):
+            entry = self.entries.pop(q, None)
+            if entry is None:
+                entry = {}
+                for key in self.keys(q):
+                    self.index.setdefault(key, set()).add(q)
+                self.bytes += self.size(entry)
+            value = entry.get(method)
+            if isinstance(value, tuple) and (
+                self.ttl is None or now - value[1] < self.ttl):
+                hits.append(i)
+                results.append(value[0])
+                if self.metrics is not None and not value[0]:
+                    self.metrics.incr(('cache', 'negative', method))
+            else:
+                misses.append(i)
+                entry[method] = token
+            # This is now the most recently used
+            self.entries[q] = entry
+        self.hits   += len(hits)
+        self.misses += len(misses)
+        if self.metrics is not None:
+            self.metrics.incr(('cache', 'hits', method), len(hits))
+            self.metrics.incr(('cache', 'misses', method), len(misses))
+        self.evict()
+        return hits, results, misses, token
+
+    def store(self, method, queries, results, token):
+        '''Keep the results of queries that missed, unless a write has come
+        along since'''
+        now = time.time()
+        if hasattr(results, 'tolist'):
+            results = results.tolist()
+        for q, result in zip(queries.tolist(), results):
+            entry = self.entries.get(q)
+            if entry is None or entry.get(method) is not token:
+                continue
+            if hasattr(result, 'tolist'):
+                result = result.tolist()
+            elif method == 'find_all':
+                result = list(result)
+            if not result and not self.negative:
+                del entry[method]
+                continue
+            self.bytes -= self.size(entry)
+            entry[method] = (result, now)
+            self.bytes += self.size(entry)
+        self.evict()
+
+    def drop(self, q):
+        entry = self.entries.pop(q)
+        self.bytes -= self.size(entry)
+        for key in self.keys(q):
+            queries = self.index[key]
+            queries.discard(q)
+            if not queries:
+                del self.index[key]
+
+    def evict(self):
+        '''Drop the least recently used queries until we're within budget'''
+        evicted = 0
+        while self.entries and self.bytes > self.memory:
+            self.drop(next(iter(self.entries)))
+            evicted += 1
+        if evicted and self.metrics is not None:
+            self.metrics.incr(('cache', 'evicted'), evicted)
+
+    def invalidate(self, hashes):
+        '''Forget every query whose answer writes to these hashes might have
+        changed, that is every query within differing_bits of one of them'''
+        if not self.entries:
+            return
+        stale = set()
+        for h in set(hashes.tolist()):
+            for key in self.keys(h):
+                for q in self.index.get(key, ()):
+                    if bin(q ^ h).count('1') <= self.differing_bits:
+                        stale.add(q)
+        for q in stale:
+            self.drop(q)
+        if stale and self.metrics is not None:
+            self.metrics.incr(('cache', 'invalidated'), len(stale))
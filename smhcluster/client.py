@@ -0,0 +1,290 @@
+#! /usr/bin/env python
+
+# A client that routes requests itself, sending each batch straight to the
+# slaves responsible for it rather than through the master, which is then only
+# needed to say where everything is. It fetches the master's routing table
+# (see Master.routing), and keeps using it until a slave turns a request away
+# for having been routed with an old one, at which point it fetches the new one
+# and tries again.
+#
+# Reads go to one replica of each range, hedged just as the master does it.
+# Writes go to every replica (and to any slave a range is being copied to), and
+# wait to hear from all of them rather than just a quorum, since a replica that
+# turns a write away is how we find out that the table has changed under us.
+# Inserts and removes are safe to send again, but a find_first_or_insert that's
+# tried again may find the hashes it inserted the first time around. On a retry
+# those are taken to have been inserted, so a hash that was already there
+# exactly as it is comes back as 0 rather than itself.
+#
+# The master's cache only hears about writes that go through the master, so it
+# won't hand out a routing table while the cache is enabled (see
+# Master.Cached), and enabling it turns away every table handed out before.
+
+import numpy
+
+from . import logger
+from . import packed
+from .util import RangeMap
+from .scatter import Scatter
+from .routing import Router, Fence
+from .replication import Replication
+
+class Client(object):
+    # Raised when the routing table has no slave for some of the hashes
+    class RangeUnassigned(Exception):
+        def __init__(self, value):
+            Exception.__init__(self, value)
+
+    # How many times to fetch a new routing table and try again when a slave
+    # turns a request away
+    retries = 5
+
+    # Accepts the host:port of the master, or the master itself
+    def __init__(self, master, max_in_flight=4):
+        if hasattr(master, 'routing'):
+            self.master = master
+        else:
+            import zerorpc
+            self.master = zerorpc.Client('tcp://%s' % master)
+        # Our clients for each of the slaves, by hostname
+        self.connections = {}
+        self.replication = Replication()
+        self.scatter     = Scatter(max_in_flight)
+        self.epoch       = None
+        self.refreshes   = 0
+        self.refresh()
+
+    def connect(self, hostname):
+        '''Our client for the slave at hostname, made the first time we need
+        it'''
+        import zerorpc
+        client = self.connections.get(hostname)
+        if client is None:
+            client = self.connections[hostname] = zerorpc.Client(
+                'tcp://%s' % hostname)
+        return client
+
+    def close(self):
+        for client in self.connections.values():
+            client.close()
+        self.connections = {}
+
+    def refresh(self):
+        '''Fetch the master's current routing table'''
+        table = self.master.routing()
+        self.replication.config(
+            {'hedge': table['hedge'], 'writes': table['writes']})
+        self.probe    = table['probe']
+        self.router   = Router(table['differing_bits'], table['shards'])
+        self.migrator = Router(table['differing_bits'])
+        rangemap, migrating = RangeMap(), RangeMap()
+        for start, end, hostnames in table['ranges']:
+            rangemap.insert(start, end, self.replication.replicas(
+                [self.connect(hostname) for hostname in hostnames]))
+        for start, end, hostname in table['migrating']:
+            migrating.insert(start, end, self.connect(hostname))
+        self.rangemap, self.migrating = rangemap, migrating
+        self.epoch = table['epoch']
+        self.refreshes += 1
+        logger.info('Routing with table %i' % self.epoch)
+
+    @staticmethod
+    def stale(exc):
+        '''Whether a slave turned a request away for being routed with an old
+        table. Over zerorpc, the slave's exception arrives as a RemoteError'''
+        return (isinstance(exc, Fence.Stale) or
+            getattr(exc, 'name', None) == 'Stale')
+
+    def retry(self, attempt):
+        '''Call attempt (with whether or not this is a retry), fetching a new
+        table and trying again each time a slave turns it away'''
+        for tries in range(self.retries + 1):
+            try:
+                return attempt(tries > 0)
+            except Scatter.PartialFailure as exc:
+                if tries == self.retries or not any(
+                    self.stale(e) for e in exc.failures.values()):
+                    raise
+            self.refresh()
+
+    def route(self, queries):
+        # Group the queries by the replicas responsible for them. Returns a
+        # mapping of replica set -> array of indices into queries
+        destinations = self.router.route(queries, self.rangemap)
+        if None in destinations:
+            raise Client.RangeUnassigned('%i unavailable' %
+                queries[destinations[None][0]])
+        return destinations
+
+    def probes(self, queries):
+        # Group the queries by the replicas of every shard one of their
+        # variants falls in, for when each hash is stored only in its own
+        variants, _ = self.router.variants(queries)
+        owners = numpy.arange(len(variants)) // len(self.router.flips)
+        return dict((replicas, numpy.unique(owners[indices]))
+            for replicas, indices in self.route(variants).items())
+
+    def query(self, method, queries):
+        '''Send each replica set the queries it's responsible for, and put
+        their answers together'''
+        queries = numpy.asarray(queries, dtype=packed.DTYPE)
+        def attempt(retried):
+            destinations = (self.probes if self.probe else self.route)(queries)
+            responses = self.scatter.gather_calls(dict((replicas, ('read', (
+                'direct', self.epoch, method, packed.pack_hashes(queries[i]))))
+                for replicas, i in destinations.items()))
+            return destinations, responses
+        destinations, responses = self.retry(attempt)
+
+        # With probe, a query may have gone to several slaves, and its answer
+        # is made up of all of theirs
+        if method == 'find_first':
+            results = numpy.zeros(len(queries), dtype=packed.DTYPE)
+            for replicas, response in responses.items():
+                indices  = destinations[replicas]
+                response = packed.unpack_hashes(response)
+                current  = results[indices]
+                better   = (response != 0) & (
+                    (current == 0) | (response < current))
+                results[indices] = numpy.where(better, response, current)
+            return results
+        results = [None] * len(queries)
+        for replicas, response in responses.items():
+            for i, result in zip(destinations[replicas].tolist(),
+                packed.unpack_sets(response)):
+                results[i] = result if results[i] is None else (
+                    numpy.union1d(results[i], result))
+        empty = numpy.zeros(0, dtype=packed.DTYPE)
+        return [empty if r is None else r for r in results]
+
+    def send(self, method, queries, hashes, replicas=True, migrating=True):
+        '''Send (q, h) pairs to every replica of the range each q falls in,
+        and with migrating, to any slave that range is being copied to. Raises
+        Scatter.PartialFailure if any slave turned them away, or if fewer
+        than a quorum of any range's replicas took them. Returns a mapping of
+        replica set -> (indices, the answer of one of its replicas, and where
+        in that answer each of the indices' is)'''
+        destinations = self.route(queries) if replicas else {}
+        targets = {}
+        for members, indices in destinations.items():
+            for slave in members:
+                targets[slave] = indices if slave not in targets else (
+                    numpy.union1d(targets[slave], indices))
+        if migrating and len(self.migrating):
+            for slave, indices in self.migrator.route(
+                queries, self.migrating).items():
+                if slave is None:
+                    continue
+                targets[slave] = indices if slave not in targets else (
+                    numpy.union1d(targets[slave], indices))
+
+        calls = dict((slave, ('direct', (self.epoch, method,
+            packed.pack_pairs(queries[i], hashes[i]))))
+            for slave, i in targets.items())
+        try:
+            responses, failures = self.scatter.gather_calls(calls), {}
+        except Scatter.PartialFailure as exc:
+            responses, failures = exc.results, exc.failures
+        if any(self.stale(e) for e in failures.values()):
+            raise Scatter.PartialFailure(failures, {})
+
+        results = {}
+        for members, indices in destinations.items():
+            acked = [slave for slave in members if slave in responses]
+            if len(acked) < self.replication.quorum(len(members)):
+                raise Scatter.PartialFailure(failures, {})
+            # Pick out this range's part of what the slave was sent
+            sent = targets[acked[0]]
+            results[members] = (indices,
+                responses[acked[0]], numpy.searchsorted(sent, indices))
+        if any(slave not in responses for slave in targets
+            if not any(slave in members for members in destinations)):
+            # A slave that a range is being copied to missed out
+            raise Scatter.PartialFailure(failures, {})
+        return results
+
+    def mutate(self, method, hashes):
+        hashes = numpy.asarray(hashes, dtype=packed.DTYPE)
+        if self.probe:
+            queries, variants = hashes, hashes
+        else:
+            queries, variants = self.router.variants(hashes)
+        self.retry(lambda retried: self.send(method, queries, variants))
+        return True
+
+    def claim(self, hashes):
+        '''The first near-duplicate of each hash, or 0 where there wasn't one
+        and it's been inserted. Claims go to the slaves just as the master
+        sends them (see Master._claim)'''
+        hashes = numpy.asarray(hashes, dtype=packed.DTYPE)
+        def attempt(retried):
+            found = numpy.zeros(len(hashes), dtype=packed.DTYPE)
+            claim = numpy.arange(len(hashes))
+            if self.probe:
+                found = self.query('find_first', hashes)
+                if retried:
+                    found[found == hashes] = 0
+                claim  = numpy.flatnonzero(found == 0)
+                queries, variants = hashes[claim], hashes[claim]
+                stride = 1
+            else:
+                queries, variants = self.router.variants(hashes)
+                stride = len(self.router.flips)
+
+            results = numpy.zeros(len(queries), dtype=packed.DTYPE)
+            for indices, response, positions in self.send(
+                'find_first_or_insert', queries, variants,
+                migrating=False).values():
+                results[indices] = packed.unpack_hashes(response)[positions]
+            if retried:
+                # What we inserted the first time around
+                results[results == variants] = 0
+            # Ranges being copied only see the hashes that were inserted
+            if len(self.migrating):
+                inserted = numpy.flatnonzero(results == 0)
+                self.send('insert', queries[inserted], variants[inserted],
+                    replicas=False)
+            found[claim] = results[::stride]
+            return found
+        return self.retry(attempt)
+
+    # Check for /any/ near-duplicate documents
+    def find_first(self, query):
+        return int(self.query('find_first', [query])[0])
+
+    # Check for /all/ near-duplicates
+    def find_all(self, query):
+        return self.query('find_all', [query])[0].tolist()
+
+    # Bulk form of find_first, returning an array of the first match for each
+    def find_first_bulk(self, queries):
+        return self.query('find_first', queries)
+
+    # Bulk form of find_all, returning a list of arrays
+    def find_all_bulk(self, queries):
+        return self.query('find_all', queries)
+
+    # Insert a hash
+    def insert(self, h):
+        return self.mutate('insert', [h])
+
+    # Bulk form of insert
+    def insert_bulk(self, hashes):
+        return self.mutate('insert', hashes)
+
+    # Remove a hash
+    def remove(self, h):
+        return self.mutate('remove', [h])
+
+    # Bulk form of remove
+    def remove_bulk(self, hashes):
+        return self.mutate('remove', hashes)
+
+    # Find the first near-duplicate, or insert the hash if there isn't one
+    def find_first_or_insert(self, h):
+        return int(self.claim([h])[0])
+
+    # Bulk form of find_first_or_insert, returning an array of the
+    # near-duplicate found for each hash, or 0 where it was inserted
+    def find_first_or_insert_bulk(self, hashes):
+        return self.claim(hashes)
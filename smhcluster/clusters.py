@@ -0,0 +1,180 @@
+#! /usr/bin/env python
+
+# Grouping the whole corpus into clusters of near-duplicates, as a batch job.
+# Rather than a find_all for every hash, it goes:
+#
+#   1. Each slave joins every table of its index with itself (Index.pairs) to
+#      find every pair of near-duplicates among its shards, and groups them
+#      into connected components. Only one replica of each range is asked.
+#   2. The master fetches each slave's (hash, cluster) pairs in chunks. A hash
+#      held by several slaves may be in a different cluster on each, so these
+#      are taken as edges and grouped into components once more.
+#   3. Which cluster each hash is in is written out to files, sorted by hash.
+#
+# A cluster is named after the smallest hash in it, and hashes with no
+# near-duplicates are left out. Each hash is paired with the near-duplicates it
+# shares a slave with, which (just as for find_all) means every shard has to
+# hold every hash that has a variant in it, so this can't be used with probe.
+# Slaves don't answer anything else while they join, so this is best run when
+# things are quiet.
+
+import os
+import time
+
+import numpy
+import gevent
+
+from . import logger
+from . import packed
+from .connections import Connection
+
+def components(lefts, rights):
+    '''The connected components of the graph with edges (lefts[i], rights[i]),
+    as a tuple of arrays (hashes, clusters): every hash in an edge, sorted, and
+    the smallest hash in the same component'''
+    lefts  = numpy.asarray(lefts , dtype=numpy.uint64)
+    rights = numpy.asarray(rights, dtype=numpy.uint64)
+    hashes = numpy.unique(numpy.concatenate((lefts, rights)))
+    a = numpy.searchsorted(hashes, lefts)
+    b = numpy.searchsorted(hashes, rights)
+    # A union-find over positions in `hashes`, where everything points at
+    # something no greater than itself, so each root is its component's least
+    parent = numpy.arange(len(hashes))
+    while len(a):
+        # Hook each edge's larger root onto the smaller one. Edges whose ends
+        # are already together stay that way, so they can be dropped
+        low  = numpy.minimum(parent[a], parent[b])
+        high = numpy.maximum(parent[a], parent[b])
+        apart = low != high
+        a, b = a[apart], b[apart]
+        numpy.minimum.at(parent, high[apart], low[apart])
+        # And then jump pointers until everything points straight at a root
+        while True:
+            grandparent = parent[parent]
+            if numpy.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+    return hashes, hashes[parent]
+
+class Clustering(object):
+    '''A slave's clusters, waiting to be fetched in chunks'''
+    def __init__(self, hashes, clusters):
+        self.hashes   = hashes
+        self.clusters = clusters
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def chunk(self, offset, count):
+        return packed.pack_pairs(self.hashes[offset:offset + count],
+            self.clusters[offset:offset + count])
+
+class Job(object):
+    # How many (hash, cluster) pairs to fetch from a slave at a time
+    chunk   = 1 << 20
+    # How many (hash, cluster) pairs to write to each file
+    part    = 1 << 24
+    # How long (in seconds) a slave may take to find its clusters
+    timeout = 3600
+
+    def __init__(self, master, path, fmt='packed', config=None):
+        for key in (config or {}).keys():
+            if key not in ('chunk', 'part', 'timeout'):
+                raise KeyError('Unknown configuration option %s' % key)
+        for key, value in (config or {}).items():
+            setattr(self, key, value)
+        if fmt not in ('packed', 'text'):
+            raise ValueError('Unknown format %s' % fmt)
+        self.master = master
+        # The directory to write to, and whether to write packed little-endian
+        # (hash, cluster) uint64 pairs, or a line of `hash cluster` for each
+        self.path   = path
+        self.fmt    = fmt
+
+    def slaves(self):
+        '''Slaves that between them hold every range, preferring those that
+        hold the most, so that as little as possible is joined twice'''
+        if self.master.probe:
+            raise ValueError('Cannot find clusters when probing')
+        counts = self.master.rangemap.counts()
+        if None in counts:
+            raise self.master.RangeUnassigned('Some ranges are unassigned')
+        held = {}
+        for replicas, count in counts.items():
+            for slave in replicas:
+                held[slave] = held.get(slave, 0) + count
+        chosen = set()
+        for replicas in counts:
+            if any(slave in chosen for slave in replicas):
+                continue
+            capable = [slave for slave in replicas
+                if 'cluster' in self.master.features.get(slave, ())]
+            if not capable:
+                raise ValueError('None of %s can find clusters' % (
+                    repr(replicas)))
+            chosen.add(max(capable, key=held.get))
+        return chosen
+
+    def call(self, slave, method, *args):
+        # Finding clusters takes far longer than connections usually allow
+        if isinstance(slave, Connection):
+            return slave.call(method, *args, timeout=self.timeout)
+        return getattr(slave, method)(*args)
+
+    def fetch(self, slave):
+        '''Have a slave find its clusters, and then fetch them, as a tuple of
+        arrays (hashes, clusters)'''
+        count = self.call(slave, 'cluster')
+        hashes, clusters = [], []
+        for offset in range(0, count, self.chunk):
+            h, c = packed.unpack_pairs(
+                self.call(slave, 'clustered', offset, self.chunk))
+            hashes.append(h)
+            clusters.append(c)
+        logger.info('Fetched %i clustered hashes from %s' % (
+            count, repr(slave)))
+        empty = numpy.empty(0, dtype=numpy.uint64)
+        return (numpy.concatenate([empty] + hashes),
+            numpy.concatenate([empty] + clusters))
+
+    def write(self, hashes, clusters):
+        '''Write out which cluster each hash is in, returning the paths'''
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        paths = []
+        for part, offset in enumerate(range(0, len(hashes), self.part)):
+            path = os.path.join(self.path, 'clusters-%05i.%s' % (
+                part, 'bin' if self.fmt == 'packed' else 'txt'))
+            pairs = numpy.column_stack((hashes[offset:offset + self.part],
+                clusters[offset:offset + self.part]))
+            with open(path, 'wb') as f:
+                if self.fmt == 'packed':
+                    f.write(pairs.astype(packed.DTYPE).tobytes())
+                else:
+                    for h, c in pairs.tolist():
+                        f.write(('%i %i\n' % (h, c)).encode('ascii'))
+            paths.append(path)
+        return paths
+
+    def run(self):
+        '''Find the clusters, write them out, and return a summary'''
+        start = time.time()
+        greenlets = [gevent.spawn(self.fetch, slave) for slave in self.slaves()]
+        gevent.joinall(greenlets, raise_error=True)
+        fetched = time.time()
+        results = [greenlet.value for greenlet in greenlets]
+        empty   = numpy.empty(0, dtype=numpy.uint64)
+        hashes, clusters = components(
+            numpy.concatenate([empty] + [h for h, c in results]),
+            numpy.concatenate([empty] + [c for h, c in results]))
+        paths = self.write(hashes, clusters)
+        count = len(numpy.unique(clusters))
+        logger.info('Wrote %i hashes in %i clusters to %s' % (
+            len(hashes), count, self.path))
+        return {
+            'hashes'  : len(hashes),
+            'clusters': count,
+            'paths'   : paths,
+            'join'    : fetched - start,
+            'merge'   : time.time() - fetched
+        }
@@ -0,0 +1,100 @@
+#! /usr/bin/env python
+
+# Coalescing of small writes. Each insert or remove costs 2 ** differing_bits
+# routing lookups and a round trip to every slave those land on, which is a lot
+# for a single hash. Instead, writes from every client are gathered up for a
+# short window (or until there are `count` of them), and then sent on together,
+# one batch per slave. Since inserts and removes are idempotent, only the last
+# write to each hash in a batch matters, so the rest are dropped.
+#
+# Flushes happen one at a time, in order, so a later write to a hash can never
+# overtake an earlier one. Writes that arrive while a flush is underway just
+# make the next batch bigger.
+
+import gevent
+from gevent.event import AsyncResult
+from gevent.lock import Semaphore
+
+from . import logger
+
+class Coalescer(object):
+    def __init__(self, send, metrics=None):
+        # Called with ('insert' or 'remove', list of hashes) for each flush
+        self.send    = send
+        self.metrics = metrics
+        # Whether plain inserts and removes should be coalesced
+        self.enabled = False
+        # How long (in seconds) to gather writes for, and how many to gather
+        # before flushing early
+        self.window  = 0.005
+        self.count   = 1 << 14
+        # The batch being gathered, as a mapping of hash -> 'insert' or
+        # 'remove', and the result that's set once it's been flushed
+        self.batch   = {}
+        self.result  = AsyncResult()
+        self.timer   = None
+        self.lock    = Semaphore()
+        # How many writes we've been given since the last flush
+        self.received = 0
+
+    # Idempotently accept new configurations
+    def config(self, config):
+        for key in config.keys():
+            if key not in ('enabled', 'window', 'count'):
+                raise KeyError('Unknown configuration option %s' % key)
+        self.enabled = config.get('enabled', bool(config))
+        self.window  = config.get('window', self.window)
+        self.count   = config.get('count', self.count)
+        if not self.enabled:
+            # Don't leave anything that's been gathered behind
+            self.flush()
+
+    def __len__(self):
+        return len(self.batch)
+
+    def add(self, method, hashes, wait=True):
+        '''Add inserts or removes of these hashes to the current batch. If
+        `wait`, return once they've been flushed (raising whatever the flush
+        did), and otherwise return straight away'''
+        if not len(hashes):
+            # Nothing to wait for, and no flush would ever set the result
+            return True
+        result = self.result
+        for h in hashes:
+            self.batch[int(h)] = method
+        self.received += len(hashes)
+        if len(self.batch) >= self.count:
+            gevent.spawn(self.flush)
+        elif self.timer is None:
+            self.timer = gevent.spawn_later(self.window, self.flush)
+        if wait:
+            return result.get()
+        return True
+
+    def flush(self):
+        '''Send everything gathered so far, waiting for any flush already
+        underway to finish first'''
+        with self.lock:
+            if self.timer is not None and self.timer is not gevent.getcurrent():
+                self.timer.kill(block=False)
+            self.timer = None
+            batch, result = self.batch, self.result
+            if not batch:
+                return
+            self.batch, self.result = {}, AsyncResult()
+            if self.metrics is not None and self.metrics.enabled:
+                self.metrics.observe(('coalesce', 'batch'), len(batch))
+                self.metrics.incr(('coalesce', 'received'), self.received)
+            self.received = 0
+            try:
+                for method in ('insert', 'remove'):
+                    hashes = [h for h, m in batch.items() if m == method]
+                    if hashes:
+                        self.send(method, hashes)
+            except Exception as exc:
+                logger.exception('Failed to flush %i writes' % len(batch))
+                if self.metrics is not None:
+                    self.metrics.incr(('coalesce', 'failures'))
+                result.set_exception(exc)
+            else:
+                result.set(True)
@@ -0,0 +1,155 @@
+#! /usr/bin/env python
+
+# A compact form of a sorted table of uint64s, for the index's main tables.
+# Neighbouring entries in a big sorted table share most of their leading bits,
+# so storing each in full wastes most of its 8 bytes. Instead, the table is
+# split into blocks of `size` entries. Each block keeps its first entry in full
+# (its head), and every entry as its difference from the head, bit-packed at the
+# width of the largest (its last).
+#
+# Rather than the gaps between consecutive entries (which would be a little
+# smaller), differences from the head can be read one at a time. So finding the
+# entries within a range means finding the block its start falls in from the
+# heads, then a binary search within that block, decoding only the entries it
+# looks at and those within the range.
+
+import numpy
+
+ONE = numpy.uint64(1)
+TWO = numpy.uint64(2)
+
+def bit_length(values):
+    '''The number of bits needed for each of an array of uint64s'''
+    values  = numpy.array(values, dtype=numpy.uint64)
+    lengths = numpy.zeros(len(values), dtype=numpy.uint64)
+    for bits in (32, 16, 8, 4, 2, 1):
+        big = values >= numpy.uint64(1 << bits)
+        lengths[big] += numpy.uint64(bits)
+        values[big] >>= numpy.uint64(bits)
+    lengths += (values > 0).astype(numpy.uint64)
+    return lengths
+
+class Compact(object):
+    def __init__(self, table, size=64):
+        table = numpy.asarray(table, dtype=numpy.uint64)
+        if size < 2:
+            raise ValueError('Blocks need at least 2 entries')
+        self.size   = size
+        self.count  = len(table)
+        blocks      = (len(table) + size - 1) // size
+        self.heads  = table[::size].copy()
+        # Where each block ends, and so how many entries it has
+        ends  = numpy.minimum(numpy.arange(1, blocks + 1) * size, len(table))
+        sizes = ends - numpy.arange(blocks) * size
+        # The width of each block's differences (at least one bit, which keeps
+        # decoding simple), and where its bits start
+        self.widths  = numpy.maximum(bit_length(
+            table[ends - 1] - self.heads), 1).astype(numpy.uint8)
+        self.offsets = numpy.zeros(blocks, dtype=numpy.int64)
+        numpy.cumsum((self.widths * sizes)[:-1], out=self.offsets[1:])
+        bits = 0
+        if blocks:
+            bits = int(self.offsets[-1]) + int(self.widths[-1]) * int(sizes[-1])
+        # One word of padding, so that decoding can always read the next word
+        self.words = numpy.zeros((bits + 63) // 64 + 1, dtype=numpy.uint64)
+        positions  = numpy.arange(len(table))
+        self.pack(positions, table - self.heads[positions // size])
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        return (self.heads.nbytes + self.widths.nbytes + self.offsets.nbytes +
+            self.words.nbytes)
+
+    def locate(self, positions):
+        '''The block, word, bit and width of each of an array of positions'''
+        block  = positions // self.size
+        width  = self.widths[block].astype(numpy.int64)
+        offset = self.offsets[block] + (positions - block * self.size) * width
+        return (block, offset >> 6, (offset & 63).astype(numpy.uint64),
+            width.astype(numpy.uint64))
+
+    def pack(self, positions, differences):
+        if not len(positions):
+            return
+        block, word, bit, width = self.locate(positions)
+        # These are in order, so every word's low parts are next to each other
+        starts = numpy.flatnonzero(numpy.diff(word)) + 1
+        starts = numpy.concatenate(([0], starts))
+        self.words[word[starts]] |= numpy.bitwise_or.reduceat(
+            differences << bit, starts)
+        # And differences that don't fit in what's left of their word spill
+        # into the next one, which nothing else spills into
+        spill = bit + width > numpy.uint64(64)
+        self.words[word[spill] + 1] |= differences[spill] >> (
+            numpy.uint64(64) - bit[spill])
+
+    def get(self, positions):
+        '''The entries at an array of positions in the table'''
+        block, word, bit, width = self.locate(positions)
+        # Shifting by 64 isn't defined, so the next word's part is shifted in
+        # two steps (which leaves nothing of it when it starts on a word)
+        values = (self.words[word] >> bit) | (
+            (self.words[word + 1] << (numpy.uint64(63) - bit)) << ONE)
+        # Everything past the width belongs to the next entry
+        values &= (TWO << (width - ONE)) - ONE
+        return self.heads[block] + values
+
+    def array(self, chunk=1 << 20):
+        '''The whole table as a sorted array, decoded `chunk` at a time'''
+        parts = [numpy.empty(0, dtype=numpy.uint64)]
+        for start in range(0, self.count, chunk):
+            parts.append(self.get(
+                numpy.arange(start, min(start + chunk, self.count))))
+        return numpy.concatenate(parts)
+
+    def search(self, values):
+        '''Like numpy.searchsorted, for an array of values'''
+        # The first entry at or after each value is in the last block whose
+        # head is before it, or is the next head
+        block  = numpy.searchsorted(self.heads, values) - 1
+        before = block < 0
+        block[before] = 0
+        base   = block * self.size
+        length = numpy.minimum(self.count - base, self.size)
+        # The last entry in the block before the value, found by binary search
+        last   = numpy.zeros(len(values), dtype=numpy.int64)
+        step   = 1 << (self.size - 1).bit_length()
+        while step > 1:
+            step //= 2
+            probe = last + step
+            inside = probe < length
+            probe[~inside] = 0
+            below = inside & (self.get(base + probe) < values)
+            last[below] = probe[below]
+        positions = base + last + 1
+        positions[before] = 0
+        return positions
+
+    def scan(self, low, high):
+        '''Every entry between low and high (inclusive) for each of a pair of
+        arrays of bounds, as a tuple of arrays (indices into low, entries)'''
+        if not self.count:
+            return numpy.empty(0, dtype=numpy.intp), numpy.empty(
+                0, dtype=numpy.uint64)
+        # Ranges rarely hold more than an entry or two, so rather than search
+        # for where each ends, read on from where it starts until past it
+        owners, found = [], []
+        owner = numpy.arange(len(low))
+        positions = self.search(low)
+        while len(owner):
+            inside = positions < self.count
+            owner, positions = owner[inside], positions[inside]
+            entries = self.get(positions)
+            inside = entries <= high[owner]
+            owner, positions = owner[inside], positions[inside]
+            owners.append(owner)
+            found.append(entries[inside])
+            positions = positions + 1
+        owners = numpy.concatenate(owners)
+        found  = numpy.concatenate(found)
+        # In order of the bounds, as a plain scan would give them
+        order  = numpy.argsort(owners, kind='stable')
+        return owners[order], found[order]
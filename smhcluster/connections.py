@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+
+# Connections from the master to each slave. Rather than one zerorpc client
+# with zerorpc's 30 second default timeout, each slave gets a small pool of
+# clients (so a slow call doesn't hold up every other call to that slave), a
+# deadline on every call, and a heartbeat that keeps track of whether it's up.
+#
+# After `threshold` failures in a row, the circuit breaker opens: calls fail
+# straight away rather than waiting out their deadlines, and replica sets send
+# reads elsewhere. The heartbeat keeps checking in, and the first one that's
+# answered closes the breaker again. If it stays open for `grace` seconds, the
+# slave is given up on and its shards are reassigned.
+#
+# Loading, copying and saving whole shards can take much longer than any
+# other call, and keep the slave too busy to answer heartbeats meanwhile. Those
+# calls get a client of their own with a much longer deadline (`patience`), and
+# neither they nor heartbeats missed while they're underway count as failures.
+
+import time
+import functools
+
+import gevent
+from gevent.queue import Queue
+
+from . import logger
+
+class Connection(object):
+    # Raised instead of making calls while the circuit breaker is open
+    class Unavailable(Exception):
+        def __init__(self, value):
+            Exception.__init__(self, value)
+
+    # How many clients to keep for each slave
+    size      = 2
+    # How long (in seconds) any one call may take
+    deadline  = 10
+    # How long (in seconds) a call that loads, copies or saves a whole shard
+    # may take
+    patience  = 3600
+    # The calls that do that
+    slow      = ('load', 'prepare', 'transfer', 'finish')
+    # How often (in seconds) to check in with each slave, and how long to wait
+    # for it to answer
+    heartbeat = 1
+    # How many failures in a row open the circuit breaker
+    threshold = 3
+    # How long (in seconds) the breaker may stay open before we give up on the
+    # slave, if at all
+    grace     = 30
+
+    def __init__(self, hostname, options=None, lost=None):
+        import zerorpc
+        self.hostname = hostname
+        self.configure(options or {})
+        # Called with this connection when we give up on the slave
+        self.lost     = lost
+        self.clients  = [zerorpc.Client('tcp://%s' % hostname,
+            timeout=self.deadline) for i in range(self.size)]
+        # The clients not in use at the moment
+        self.idle     = Queue()
+        for client in self.clients:
+            self.idle.put(client)
+        # Heartbeats get a client of their own, so that they aren't stuck
+        # behind calls that are taking a while
+        self.pulse    = zerorpc.Client('tcp://%s' % hostname)
+        # As do slow calls, without zerorpc's own heartbeats (which a slave
+        # busy loading a shard may not answer either), and a count of how many
+        # of them are underway
+        self.patient  = zerorpc.Client('tcp://%s' % hostname,
+            timeout=self.patience, heartbeat=None)
+        self.busy     = 0
+        # How many calls in a row have failed, and when the breaker opened
+        self.failures = 0
+        self.opened   = None
+        self.closed   = False
+        self.monitor  = gevent.spawn(self.heartbeats)
+
+    def __repr__(self):
+        return '<Connection %s>' % self.hostname
+
+    def __getattr__(self, method):
+        # Everything else is a call to the slave
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return functools.partial(self.call, method)
+
+    # Accept new options. The pool is sized when the connection is made
+    def configure(self, options):
+        for key in options.keys():
+            if key not in ('size', 'deadline', 'patience', 'heartbeat',
+                'threshold', 'grace'):
+                raise KeyError('Unknown configuration option %s' % key)
+        for key, value in options.items():
+            setattr(self, key, value)
+
+    @property
+    def healthy(self):
+        return self.opened is None
+
+    def call(self, method, *args, **kwargs):
+        '''Call a method on the slave, with one of our clients'''
+        import zerorpc
+        if self.opened is not None:
+            raise Connection.Unavailable('%s is down' % self.hostname)
+        if method in self.slow:
+            return self.wait(method, *args, **kwargs)
+        client = self.idle.get()
+        try:
+            result = client(method, *args,
+                timeout=kwargs.get('timeout', self.deadline))
+        except (zerorpc.TimeoutExpired, zerorpc.LostRemote) as exc:
+            self.failed(exc)
+            raise
+        finally:
+            self.idle.put(client)
+        # Errors raised by the slave itself (which zerorpc passes along as
+        # RemoteError) say nothing about whether it's up
+        self.succeeded()
+        return result
+
+    def wait(self, method, *args, **kwargs):
+        '''Make a slow call, which doesn't count against the slave if it fails'''
+        self.busy += 1
+        try:
+            result = self.patient(method, *args,
+                timeout=kwargs.get('timeout', self.patience))
+        finally:
+            self.busy -= 1
+        self.succeeded()
+        return result
+
+    def succeeded(self):
+        if self.opened is not None:
+            logger.info('%s is back up' % self.hostname)
+        self.failures = 0
+        self.opened   = None
+
+    def failed(self, exc):
+        self.failures += 1
+        if self.opened is None and self.failures >= self.threshold:
+            logger.error('%s is down after %i failures: %s' % (
+                self.hostname, self.failures, repr(exc)))
+            self.opened = time.time()
+
+    def heartbeats(self):
+        import zerorpc
+        while not self.closed:
+            gevent.sleep(self.heartbeat)
+            busy = self.busy
+            try:
+                self.pulse('capabilities', timeout=self.heartbeat)
+                self.succeeded()
+            except (zerorpc.TimeoutExpired, zerorpc.LostRemote) as exc:
+                if not (busy or self.busy):
+                    self.failed(exc)
+            except Exception:
+                logger.exception('Heartbeat to %s failed' % self.hostname)
+            if (self.opened is not None and self.grace is not None and
+                time.time() - self.opened > self.grace and self.lost):
+                logger.error('Giving up on %s' % self.hostname)
+                gevent.spawn(self.lost, self)
+                return
+
+    def close(self):
+        self.closed = True
+        if self.monitor is not gevent.getcurrent():
+            self.monitor.kill(block=False)
+        for client in self.clients + [self.pulse, self.patient]:
+            client.close()
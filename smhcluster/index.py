@@ -0,0 +1,325 @@
+#! /usr/bin/env python
+
+# The near-duplicate index a slave serves its shards from. Two hashes within
+# `differing_bits` bits of each other must agree on at least
+# `blocks - differing_bits` of the `blocks` blocks of bits they're divided into.
+# So for each way of choosing that many blocks, we keep a table of every hash
+# with its bits permuted so that those blocks come first, sorted. Finding the
+# near-duplicates of a query is then a range scan over the hashes sharing its
+# prefix in each table, which we do for whole batches of queries at once.
+#
+# Tables are plain sorted uint64 arrays (about 8 bytes per hash per table), or
+# with `compact`, the main tables are kept delta-encoded in blocks of that many
+# hashes (see compact.py), which saves memory at some cost to lookups and
+# merges. New hashes land in a much smaller set of delta tables first, which are merged in
+# once they grow past `buffer` hashes. Removed hashes are counted off until the
+# next merge. The index is a multiset: a hash inserted for two shards is kept
+# twice, and is found until it has been removed from both.
+
+import itertools
+
+import numpy
+
+from .compact import Compact
+
+if hasattr(numpy, 'bitwise_count'):
+    popcount = numpy.bitwise_count
+else:
+    _POPCOUNT = numpy.array(
+        [bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+
+    def popcount(values):
+        values = numpy.ascontiguousarray(values, dtype=numpy.uint64)
+        return _POPCOUNT[values.view(numpy.uint8)].reshape(-1, 8).sum(axis=1)
+
+def scan(table, low, high):
+    '''Every hash in a table between low and high (inclusive) for each of a
+    pair of arrays of bounds, as a tuple of arrays (indices into low, hashes)'''
+    if isinstance(table, Compact):
+        return table.scan(low, high)
+    # Searching is much faster with the bounds in order
+    order  = numpy.argsort(low)
+    lo     = numpy.empty(len(low), dtype=numpy.intp)
+    counts = numpy.empty(len(low), dtype=numpy.intp)
+    lo[order] = numpy.searchsorted(table, low[order], side='left')
+    counts[order] = numpy.searchsorted(
+        table, high[order], side='right') - lo[order]
+    # The position of every hash in the table, and the bounds it's within
+    owner = numpy.repeat(numpy.arange(len(low)), counts)
+    positions = numpy.arange(len(owner)) - numpy.repeat(
+        numpy.cumsum(counts) - counts - lo, counts)
+    return owner, table[positions]
+
+def plain(table):
+    '''A table as a plain sorted array'''
+    if isinstance(table, Compact):
+        return table.array()
+    return table
+
+class Index(object):
+    # How many new hashes to buffer before merging them into the main tables
+    buffer = 1 << 16
+    # Compact tables are costly to re-encode, so with them the delta tables may
+    # also grow to 1 / `ratio` the size of the main tables before merging
+    ratio  = 16
+
+    def __init__(self, blocks=6, differing_bits=3, compact=None):
+        if not 0 <= differing_bits < blocks <= 64:
+            raise ValueError('Need 0 <= differing bits < blocks <= 64')
+        self.blocks         = blocks
+        self.differing_bits = differing_bits
+        # How many hashes to a block in the compact main tables, if they're
+        # compact at all
+        self.compact        = compact or None
+        # The widths of each block, from the most significant, and where each
+        # one starts (as a shift from the least significant bit)
+        widths = [64 // blocks + (1 if i < 64 % blocks else 0)
+            for i in range(blocks)]
+        shifts = [64 - sum(widths[:i + 1]) for i in range(blocks)]
+
+        # For each table, how to permute hashes into it: a list of (shift, mask,
+        # shift) for each block, and the mask for the prefix it's sorted on,
+        # both as permuted and in its original place
+        self.permutations, self.prefixes, self.chosen = [], [], []
+        for chosen in itertools.combinations(range(blocks),
+            blocks - differing_bits):
+            order = list(chosen) + [b for b in range(blocks) if b not in chosen]
+            steps, position = [], 64
+            for b in order:
+                position -= widths[b]
+                steps.append((numpy.uint64(shifts[b]),
+                    numpy.uint64((1 << widths[b]) - 1), numpy.uint64(position)))
+            self.permutations.append(steps)
+            prefix = sum(widths[b] for b in chosen)
+            self.prefixes.append(numpy.uint64(
+                ((1 << prefix) - 1) << (64 - prefix)))
+            self.chosen.append(numpy.uint64(sum(
+                ((1 << widths[b]) - 1) << shifts[b] for b in chosen)))
+
+        empty = numpy.empty(0, dtype=numpy.uint64)
+        self.main  = [empty] * len(self.permutations)
+        self.delta = [empty] * len(self.permutations)
+        # Hashes inserted or removed that haven't made it into the tables yet
+        self.inserts  = []
+        self.removals = []
+        self.pending  = 0
+        # Hashes that are still in the tables but have since been removed,
+        # sorted, with how many copies of each have been removed
+        self.removed  = empty
+        self.counts   = numpy.empty(0, dtype=numpy.intp)
+
+    @property
+    def tables(self):
+        return len(self.permutations)
+
+    @property
+    def nbytes(self):
+        '''How much memory the tables (and what's waiting to go into them)
+        take up'''
+        return sum(t.nbytes for t in
+            self.main + self.delta + self.inserts + self.removals)
+
+    def __len__(self):
+        self.settle()
+        return len(self.main[0]) + len(self.delta[0]) - int(self.counts.sum())
+
+    def permute(self, hashes, table):
+        '''Permute the bits of hashes into the order for this table'''
+        results = numpy.zeros(len(hashes), dtype=numpy.uint64)
+        for shift, mask, position in self.permutations[table]:
+            results |= ((hashes >> shift) & mask) << position
+        return results
+
+    def unpermute(self, permuted, table):
+        '''Undo `permute`'''
+        results = numpy.zeros(len(permuted), dtype=numpy.uint64)
+        for shift, mask, position in self.permutations[table]:
+            results |= ((permuted >> position) & mask) << shift
+        return results
+
+    def insert(self, hashes):
+        '''Add hashes to the index'''
+        hashes = numpy.asarray(hashes, dtype=numpy.uint64)
+        self.inserts.append(hashes)
+        self.pending += len(hashes)
+        if self.pending >= self.buffer:
+            self.settle()
+
+    def remove(self, hashes):
+        '''Remove one copy each of hashes that are in the index'''
+        hashes = numpy.asarray(hashes, dtype=numpy.uint64)
+        self.removals.append(hashes)
+        self.pending += len(hashes)
+        if self.pending >= self.buffer:
+            self.settle()
+
+    def settle(self):
+        '''Move pending inserts into the delta tables, and pending removals
+        into the removed counts, merging everything in if there's enough'''
+        self.pending = 0
+        if self.inserts:
+            hashes = numpy.concatenate(self.inserts)
+            self.inserts = []
+            for t in range(self.tables):
+                self.delta[t] = self.merged(
+                    self.delta[t], numpy.sort(self.permute(hashes, t)))
+        if self.removals:
+            hashes = numpy.concatenate(
+                [numpy.repeat(self.removed, self.counts)] + self.removals)
+            self.removals = []
+            self.removed, self.counts = numpy.unique(hashes, return_counts=True)
+        threshold = self.buffer
+        if self.compact:
+            threshold = max(threshold, len(self.main[0]) // self.ratio)
+        if len(self.delta[0]) + len(self.removed) >= threshold:
+            self.merge()
+
+    def merged(self, table, hashes):
+        '''Merge a sorted array of permuted hashes into a table'''
+        if not len(table):
+            return hashes
+        return numpy.insert(table, numpy.searchsorted(table, hashes), hashes)
+
+    def copies(self, hashes):
+        '''How many copies of each of these hashes the tables hold'''
+        permuted = self.permute(hashes, 0)
+        counts = numpy.zeros(len(permuted), dtype=numpy.intp)
+        for table in (self.main[0], self.delta[0]):
+            owner, found = scan(table, permuted, permuted)
+            counts += numpy.bincount(owner, minlength=len(permuted))
+        return counts
+
+    def merge(self):
+        '''Merge the delta tables into the main tables, and drop everything
+        that's been removed'''
+        removed, counts = self.removed, self.counts
+        if len(removed):
+            # We can't remove more copies than there are
+            counts = numpy.minimum(counts, self.copies(removed))
+        for t in range(self.tables):
+            if not len(self.delta[t]) and not len(removed) and (
+                isinstance(self.main[t], Compact)):
+                # Nothing to do, and re-encoding would be a waste
+                continue
+            table = self.merged(plain(self.main[t]), self.delta[t])
+            if len(removed):
+                permuted = numpy.repeat(self.permute(removed, t), counts)
+                # The positions of the first copy of each, then the next, ...
+                starts = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+                offsets = numpy.arange(len(permuted)) - starts
+                table = numpy.delete(table,
+                    numpy.searchsorted(table, permuted) + offsets)
+            if self.compact:
+                table = Compact(table, self.compact)
+            self.main[t] = table
+            self.delta[t] = self.delta[t][:0]
+        self.removed = self.removed[:0]
+        self.counts  = self.counts[:0]
+
+    def search(self, queries):
+        '''All the (query, hash) pairs of near-duplicates in the index, as a
+        tuple of arrays (indices into queries, hashes), sorted and unique'''
+        self.settle()
+        queries = numpy.asarray(queries, dtype=numpy.uint64)
+        k = self.differing_bits
+        owners, matches = [], []
+        for t in range(self.tables):
+            permuted = self.permute(queries, t)
+            prefix = self.prefixes[t]
+            low  = permuted & prefix
+            high = permuted | ~prefix
+            for table in (self.main[t], self.delta[t]):
+                if not len(table):
+                    continue
+                # Every hash sharing a query's prefix, and the query it's a
+                # candidate for
+                owner, candidates = scan(table, low, high)
+                if not len(owner):
+                    continue
+                close = popcount(candidates ^ permuted[owner]) <= k
+                owners.append(owner[close])
+                matches.append(self.unpermute(candidates[close], t))
+
+        if not owners:
+            empty = numpy.empty(0, dtype=numpy.uint64)
+            return numpy.empty(0, dtype=numpy.intp), empty
+        owners  = numpy.concatenate(owners)
+        matches = numpy.concatenate(matches)
+
+        # The same match turns up in several tables, and maybe several times
+        order = numpy.lexsort((matches, owners))
+        owners, matches = owners[order], matches[order]
+        keep = numpy.ones(len(owners), dtype=bool)
+        keep[1:] = (owners[1:] != owners[:-1]) | (matches[1:] != matches[:-1])
+        owners, matches = owners[keep], matches[keep]
+
+        # Drop anything that's had every copy removed
+        if len(self.removed):
+            i = numpy.searchsorted(self.removed, matches)
+            i[i == len(self.removed)] = 0
+            suspect = numpy.flatnonzero(self.removed[i] == matches)
+            if len(suspect):
+                gone = self.copies(matches[suspect]) <= self.counts[i[suspect]]
+                keep = numpy.ones(len(owners), dtype=bool)
+                keep[suspect[gone]] = False
+                owners, matches = owners[keep], matches[keep]
+        return owners, matches
+
+    def pairs(self):
+        '''Every pair of near-duplicates in the index, as a tuple of arrays
+        (lefts, rights) with lefts[i] < rights[i], sorted. Rather than
+        searching for each hash, each table is joined with itself: hashes
+        sharing its prefix sit next to each other, so each hash only needs to
+        be compared with those after it until the prefix changes'''
+        self.settle()
+        if len(self.delta[0]) or len(self.removed):
+            self.merge()
+        k = self.differing_bits
+        lefts, rights = [], []
+        for t in range(self.tables):
+            table = plain(self.main[t])
+            # A hash held for several shards is only paired up once
+            if len(table):
+                table = table[numpy.concatenate(
+                    ([True], table[1:] != table[:-1]))]
+            keys  = table & self.prefixes[t]
+            # The hashes whose prefix is shared by the one `offset` after them.
+            # Once it isn't, it won't be by any further along either
+            same, offset = numpy.arange(len(table)), 1
+            while len(same):
+                same = same[same + offset < len(table)]
+                same = same[keys[same + offset] == keys[same]]
+                close = same[popcount(table[same] ^ table[same + offset]) <= k]
+                left  = self.unpermute(table[close], t)
+                right = self.unpermute(table[close + offset], t)
+                # A pair turns up in every table whose prefix it agrees on, so
+                # we only keep it from the first of them
+                differ = left ^ right
+                first  = numpy.ones(len(close), dtype=bool)
+                for chosen in self.chosen[:t]:
+                    first &= (differ & chosen) != 0
+                lefts.append(numpy.minimum(left[first], right[first]))
+                rights.append(numpy.maximum(left[first], right[first]))
+                offset += 1
+
+        empty  = numpy.empty(0, dtype=numpy.uint64)
+        lefts  = numpy.concatenate([empty] + lefts)
+        rights = numpy.concatenate([empty] + rights)
+        order  = numpy.lexsort((rights, lefts))
+        return lefts[order], rights[order]
+
+    def find_first(self, queries):
+        '''For each query, the smallest near-duplicate, or 0 if it has none'''
+        owners, matches = self.search(queries)
+        results = numpy.zeros(len(queries), dtype=numpy.uint64)
+        # Matches are sorted within each query, so the first is the smallest
+        first = numpy.ones(len(owners), dtype=bool)
+        first[1:] = owners[1:] != owners[:-1]
+        results[owners[first]] = matches[first]
+        return results
+
+    def find_all(self, queries):
+        '''For each query, a sorted array of all its near-duplicates'''
+        owners, matches = self.search(queries)
+        bounds = numpy.searchsorted(owners, numpy.arange(len(queries) + 1))
+        return [matches[bounds[i]:bounds[i + 1]] for i in range(len(queries))]
@@ -0,0 +1,136 @@
+#! /usr/bin/env python
+
+# Streaming bulk inserts and removes. Rather than having a whole backfill arrive
+# (and be held in memory) as one request, hashes are fed in as they arrive, in
+# arrays of any size. They're cut into chunks of `chunk` hashes, and each chunk
+# is routed and sent on to the slaves as soon as it's full. At most `window`
+# chunks are in flight at once; feeding in more blocks until one of them is
+# done, which is how backpressure makes its way back to whoever is sending.
+
+import time
+
+import numpy
+from gevent.pool import Pool
+from gevent.queue import Queue
+
+from . import logger
+from . import packed
+
+class Ingest(object):
+    def __init__(self, send, chunk=1 << 16, window=4):
+        # Called with each chunk, as an array of hashes
+        self.send     = send
+        self.chunk    = chunk
+        self.pool     = Pool(window)
+        # Hashes that haven't made up a whole chunk yet
+        self.buffer   = []
+        self.buffered = 0
+        # How many hashes we've been given, how many have been sent on in
+        # chunks, and how many of those the slaves have acknowledged
+        self.received = 0
+        self.sent     = 0
+        self.acked    = 0
+        self.chunks   = 0
+        # A report for each chunk that's finished, as it finishes
+        self.reports  = Queue()
+        self.errors   = []
+        self.closed   = False
+        self.touched  = time.time()
+
+    def feed(self, hashes):
+        '''Add an array of hashes, sending on any chunks that fill up. This
+        blocks while there are already `window` chunks in flight'''
+        if self.closed:
+            raise ValueError('Ingest already closed')
+        self.touched = time.time()
+        hashes = numpy.asarray(hashes, dtype=numpy.uint64)
+        self.received += len(hashes)
+        self.buffer.append(hashes)
+        self.buffered += len(hashes)
+        if self.buffered >= self.chunk:
+            hashes = numpy.concatenate(self.buffer)
+            whole = len(hashes) - len(hashes) % self.chunk
+            for offset in range(0, whole, self.chunk):
+                self.forward(hashes[offset:offset + self.chunk])
+            self.buffer   = [hashes[whole:]]
+            self.buffered = len(hashes) - whole
+        return self.progress()
+
+    def forward(self, hashes):
+        chunk, offset = self.chunks, self.sent
+        self.chunks += 1
+        self.sent   += len(hashes)
+        # Blocks until there's room in the pool
+        self.pool.spawn(self.deliver, chunk, offset, hashes)
+
+    def deliver(self, chunk, offset, hashes):
+        report = {'chunk': chunk, 'offset': offset, 'count': len(hashes),
+            'error': None}
+        try:
+            self.send(hashes)
+            self.acked += len(hashes)
+        except Exception as exc:
+            logger.exception('Failed to ingest chunk %i' % chunk)
+            report['error'] = repr(exc)
+            self.errors.append(report)
+        self.reports.put(report)
+
+    def close(self):
+        '''Send whatever's left, and wait for every chunk to finish'''
+        if not self.closed:
+            self.closed = True
+            if self.buffered:
+                self.forward(numpy.concatenate(self.buffer))
+            self.buffer, self.buffered = [], 0
+            self.pool.join()
+        return self.progress()
+
+    def progress(self):
+        return {
+            'received': self.received,
+            'sent'    : self.sent,
+            'acked'   : self.acked,
+            'chunks'  : self.chunks,
+            'errors'  : list(self.errors),
+            'done'    : self.closed and not len(self.pool)
+        }
+
+    def finished(self):
+        '''The reports of chunks that have finished since we last asked'''
+        results = []
+        while not self.reports.empty():
+            results.append(self.reports.get())
+        return results
+
+def read_lines(stream, size=1 << 16):
+    '''Read newline-delimited hashes from a file-like object, yielding arrays
+    of them as they arrive'''
+    tail = b''
+    while True:
+        data = stream.read(size)
+        if not data:
+            break
+        data = tail + data
+        cut  = data.rfind(b'\n') + 1
+        data, tail = data[:cut], data[cut:]
+        if data:
+            yield numpy.array([int(l) for l in data.split()],
+                dtype=numpy.uint64)
+    if tail.strip():
+        yield numpy.array([int(l) for l in tail.split()], dtype=numpy.uint64)
+
+def read_packed(stream, size=1 << 16):
+    '''Read packed uint64 hashes from a file-like object, yielding arrays of
+    them as they arrive'''
+    tail = b''
+    while True:
+        data = stream.read(size)
+        if not data:
+            break
+        data = tail + data
+        cut  = len(data) - len(data) % 8
+        data, tail = data[:cut], data[cut:]
+        if data:
+            yield packed.unpack_hashes(data)
+    if tail:
+        raise ValueError('Packed stream ended mid-hash')
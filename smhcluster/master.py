@@ -2,125 +2,274 @@
 
 from . import logger
 from .util import RangeMap
+from .scatter import Scatter
+from .routing import Router
+from .placement import Planner
+from .replication import Replication, ReplicaSet
+from .metrics import Metrics
+from .ingest import Ingest
+from .coalesce import Coalescer
+from .cache import Cache
+from .connections import Connection
+from .clusters import Job
+from . import packed
 
-from collections import defaultdict
+import time
+import itertools
+import gevent
+import numpy
+from gevent.queue import JoinableQueue
+from gevent.lock import Semaphore
 
 # This is the master node object. It talks to slave nodes to determine both
 # their availability and health and to answer queries.
 class Master(object):
     # The number of shards 
     shards          = 1024
-    max_node_shards = 256
     differing_bits  = 3
     blocks          = 6
+    # By default, each hash is stored in every shard that one of its variants
+    # falls in, so that each query only has to go to one. With `probe`, each
+    # hash is stored once, in its own shard, and queries go to every shard a
+    # near-duplicate could be stored in instead
+    probe           = False
+    # What answers merged from every shard a query probed come back as
+    PROBES          = 'probes'
+    # How many requests may be outstanding to a single slave at once
+    max_in_flight   = 4
+    # When moving shards between slaves, how many hashes to send at a time and
+    # how many hashes per second to limit each move to
+    move_chunk      = 1 << 16
+    move_rate       = 1 << 20
+    # When streaming in hashes, how many to send to the slaves at a time, how
+    # many of those chunks may be in flight at once, and how long (in seconds)
+    # a stream may sit idle before it's abandoned
+    ingest_chunk    = 1 << 16
+    ingest_window   = 4
+    ingest_idle     = 600
     
     class RangeUnassigned(Exception):
         def __init__(self, value):
             Exception.__init__(self, value)
     
+    # Raised for a client asking for the routing table while we're caching
+    # answers, since writes it sent straight to the slaves wouldn't clear them
+    class Cached(Exception):
+        def __init__(self, value):
+            Exception.__init__(self, value)
+    
     def __init__(self):
         self.rangemap = RangeMap()
-        for start, end in self.ranges():
-            self.rangemap.insert(start, end, None)
+        self.rangemap.assign_many(self.ranges(), None)
         
         # A mapping of hostnames to slave objects
         self.slaves = {}
+        # The slaves that understand the packed wire format
+        self.packed = set()
+        # A mapping of slave -> the set of things it supports, from capabilities
+        self.features = {}
+        # A mapping of hostname -> how much of the cluster it should hold
+        self.weights = {}
+        # Decides where each shard should be, and our current plan for that as
+        # a mapping of shard number -> list of hostnames
+        self.planner    = Planner(self.shards)
+        self.assignment = {}
+        # Each range is held by a set of replicas, which this keeps track of
+        # (along with how quickly each slave has been answering)
+        self.replication = Replication()
         # Our current configuration
         self._config = {}
+        # Timings and counts of what we've been up to
+        self._metrics = Metrics()
+        # Used to fan requests out to all the relevant slaves at once
+        self.scatter = Scatter(self.max_in_flight, self._metrics)
+        # Used to map batches of hashes onto the slaves responsible for them
+        self.router  = Router(self.differing_bits, self.shards)
+        # Ranges that are being copied, mapped to the slave they're being copied
+        # to. Writes to these ranges go to both the replicas and the new slave
+        self.migrating = RangeMap()
+        self.migrator  = Router(self.differing_bits)
+        # Moves waiting to happen, as (start, end, source, destination), and the
+        # greenlet that works through them one at a time. Join `pending` to wait
+        # for every move so far to be done
+        self.pending   = JoinableQueue()
+        self.mover     = None
+        # Answers to recent queries, until a write might change them
+        self.cache     = Cache(self.differing_bits, self._metrics)
+        # Gathers up small inserts and removes to send on together
+        self.coalescer = Coalescer(self._mutate, self._metrics)
+        # Streaming inserts and removes that are underway, by id
+        self.ingests   = {}
+        self.ingest_id = itertools.count()
+        # The routing table we publish for clients that send requests straight
+        # to the slaves: its epoch, and what it was made from (see `publish`)
+        self.epoch      = 0
+        self.published  = None
+        self.publishing = Semaphore()
+        
+        self._metrics.gauge(('moves', 'pending'), self.pending.qsize)
+        self._metrics.gauge(('moves', 'migrating'),
+            lambda: len(self.migrating))
+        self._metrics.gauge('in_flight', self.scatter.in_flight)
+        self._metrics.gauge('shards', self.stats)
+        self._metrics.gauge('ingests', lambda: len(self.ingests))
+        self._metrics.gauge(('coalesce', 'pending'),
+            lambda: len(self.coalescer))
+        self._metrics.gauge(('connections', 'failures'), lambda: dict(
+            (s, getattr(s, 'failures', 0)) for s in self.slaves.values()))
+        self._metrics.gauge(('connections', 'down'), lambda: dict(
+            (s, int(not getattr(s, 'healthy', True)))
+            for s in self.slaves.values()))
+        self._metrics.gauge(('cache', 'entries'), lambda: len(self.cache))
+        self._metrics.gauge(('cache', 'bytes'), lambda: self.cache.bytes)
+        self._metrics.gauge(('cache', 'hit_rate'), self.cache.hit_rate)
+        self._metrics.gauge('latency',
+            lambda: dict(self.replication.tracker.averages))
     
     def ranges(self):
         # Return a list of tuples (start, end) that we need
         results = []
         for i in range(self.shards):
-            start =  i      * (1 << 64) / self.shards
-            end   = (i + 1) * (1 << 64) / self.shards
+            start =  i      * (1 << 64) // self.shards
+            end   = (i + 1) * (1 << 64) // self.shards
             results.append((start, end-1))
         return results
     
     def unassigned(self):
         # Get a list of tuples (start, end) of ranges that are unassigned
-        return [(s, e) for s, e, i in self.rangemap if i == None]
+        return self.rangemap.ranges_of(None)
         
     def register(self, hostname):
-        # Accept a new slave. First, determine how many shards we're going to
-        # give to each node once we add this new one
-        count = min(self.max_node_shards, self.shards / (len(self.slaves) + 1))
-        assign = self.unassigned()[0:count]
-        if (len(assign) < count):
-            # We need to actually steal shards from some of the existing slaves
-            # so we should figure out where to take them from
-            slaves = defaultdict(list)
-            for s, e, i in self.rangemap:
-                if i != None:
-                    slaves[i].append((s, e))
-            
-            # Now make a list of tuples based on this
-            slaves = [(len(v), s, v) for s, v in slaves.items()]
-            slaves.sort()
-            slaves.reverse()
-            for l, slave, shards in slaves:
-                # Take up to l-count from this guy
-                ct = min(l - count, count - len(assign))
-                nw = shards[0:ct]
-                assign.extend(nw)
-                for start, end in nw:
-                    slave.unload(start, end)
-                    logger.info('Reassigning [%i, %i) from %s to %s' % (start, end, repr(slave), hostname))
-        
-        import zerorpc
-        logger.info('Assigning %i to %s' % (count, hostname))
-        slave = zerorpc.Client('tcp://%s' % hostname)
+        # Accept a new slave, and give it its share of the shards
+        slave = Connection(hostname, self._config.get('connections', {}),
+            self.lost)
         self.slaves[hostname] = slave
-        for start, end in assign:
-            slave.load(start, end)
-            self.rangemap.insert(start, end, slave)
-        
-        # Send it its updated configuration
+        self.negotiate(slave)
+        # Send it its configuration before anything else, since that tells it
+        # where to find its snapshots and log
         slave.config(self._config)
+        self.fence([slave])
+        self.weights[hostname] = self.weigh(slave)
+        logger.info('Registered %s with weight %f' % (
+            hostname, self.weights[hostname]))
+        self.rebalance()
     
     def deregister(self, hostname):
         # When deregistering a node, we should redistribute all the keys
         # associated with this particular host
-        if isinstance(hostname, basestring):
-            slave = self.slaves.pop(hostname)
-        else:
-            slave = hostname
-            for k, v in self.slaves.items():
-                if slave == v:
-                    o = self.slaves.pop(k)
+        if not isinstance(hostname, str):
+            hostname = [k for k, v in self.slaves.items() if v == hostname][0]
+        slave = self.slaves.pop(hostname)
+        self.weights.pop(hostname, None)
+        self.packed.discard(slave)
+        self.features.pop(slave, None)
         
-        assign = [(s, e) for s, e, i in self.rangemap if i == slave]
-        count  = min(self.max_node_shards, self.shards / (len(self.slaves)) + 1)
-        # Alright, assign these ranges to the remaining slaves. Keep filling up
-        # slaves until they're full
-        for slave in self.slaves.values():
-            ct = len([(s, e) for s, e, i in self.rangemap if i == slave])
-            for i in range(count - ct):
-                if not assign:
-                    break
-                s, e = assign.pop(0)
-                slave.load(s, e)
-                self.rangemap.insert(s, e, slave)
-                logger.info('Reassigning [%i, %i) to %s' % (s, e, repr(slave)))
+        # Take it out of every replica set it was in. Ranges for which it was
+        # the only replica are now unassigned
+        for replicas in list(self.rangemap.counts().keys()):
+            if replicas is not None and slave in replicas:
+                self.rangemap.assign_many(self.rangemap.ranges_of(replicas),
+                    self.replicas([s for s in replicas if s is not slave]))
+        self.replication.forget(slave)
+        self.scatter.forget(slave)
+        self.rebalance()
+        if isinstance(slave, Connection):
+            slave.close()
+    
+    def lost(self, slave):
+        # A slave hasn't answered for long enough that we've given up on it
+        if self.slaves.get(slave.hostname) is slave:
+            self.deregister(slave.hostname)
+    
+    def weigh(self, slave):
+        # How much of the cluster this slave should hold, as a combination of
+        # its resources (memory in GB, and cores). Slaves that can't tell us
+        # about their resources all get the same weight
+        if 'resources' not in self.features.get(slave, ()):
+            return 1.0
+        resources = slave.resources()
+        weights = self._config.get('weights', {'memory': 1.0})
+        weight  = sum(weights[k] * resources.get(k, 0) for k in weights)
+        return float(weight) or 1.0
+    
+    def replicas(self, slaves):
+        # The replica set made up of these slaves, or None if there are none
+        return self.replication.replicas(slaves,
+            all(slave in self.packed for slave in slaves))
+    
+    def rebalance(self):
+        # Work out where each shard should be, and then start getting them there.
+        # Shards with nowhere to be copied from are loaded right away, while
+        # those that are being copied from another replica are streamed over
+        # in the background
+        ranges = self.ranges()
+        self.assignment, moves = self.planner.plan(
+            self.assignment, self.weights)
+        for shard, source, destination in moves:
+            start, end = ranges[shard]
+            if destination is None:
+                logger.info('Dropping [%i, %i] from %s' % (start, end, source))
+                self.pending.put((start, end, self.slaves[source], None))
+                continue
+            slave = self.slaves[destination]
+            if source is None and self.rangemap[start][1] is None:
+                logger.info('Assigning [%i, %i] to %s' % (
+                    start, end, destination))
+                slave.load(start, end)
+                self.rangemap.insert(start, end, self.replicas([slave]))
+            else:
+                logger.info('Copying [%i, %i] from %s to %s' % (
+                    start, end, source or 'a replica', destination))
+                self.pending.put((start, end,
+                    None if source is None else self.slaves[source], slave))
+        self.publish()
         
-        # Unassign all the remaining shards
-        for s, e in assign:
-            self.rangemap.insert(s, e, None)
+        if not self.pending.empty() and not self.mover:
+            self.mover = gevent.spawn(self.moves)
+        return len(moves)
     
     def stats(self):
-        # Return the distribution of the shards
-        slaves = defaultdict(list)
-        for s, e, i in self.rangemap:
-            if i != None:
-                slaves[i].append((s, e))
-        
-        return dict(((repr(s), len(shards)) for s, shards in slaves.items()))
+        # Return the distribution of the shards, counting each replica
+        results = {}
+        for replicas, count in self.rangemap.counts().items():
+            for slave in replicas or ():
+                results[repr(slave)] = results.get(repr(slave), 0) + count
+        return results
     
     def config(self, config):
         self._config = config
+        # Slaves build their indexes from the same `blocks` and `diff_bits`
+        self.blocks = config.get('blocks', self.blocks)
+        # Hashes already stored one way won't be found the other, so this has
+        # to be decided before anything is inserted
+        self.probe  = config.get('probe', self.probe)
+        differing_bits = config.get('diff_bits', self.differing_bits)
+        if differing_bits != self.differing_bits:
+            self.differing_bits = differing_bits
+            self.router   = Router(differing_bits, self.shards)
+            self.migrator = Router(differing_bits)
+            self.cache.reset(differing_bits)
+        self.scatter.config(config.get('max_in_flight', self.max_in_flight))
+        self._metrics.config(config.get('metrics', {}))
+        self.coalescer.config(config.get('coalesce', {}))
+        self.cache.config(config.get('cache', {}))
+        for slave in self.slaves.values():
+            if isinstance(slave, Connection):
+                slave.configure(config.get('connections', {}))
+        replication = config.get('replication', {})
+        self.replication.config(replication)
         # Propagate the configuration to all the slaves
         for slave in self.slaves.values():
             slave.config(config)
+        # Clients placing hashes themselves need to know if that's changed
+        self.publish()
+        # A change in the number of replicas means shards have to be copied
+        # or dropped
+        replicas = replication.get('replicas', 1)
+        if replicas != self.planner.replicas:
+            self.planner.replicas = replicas
+            if self.slaves:
+                self.rebalance()
     
     def listen(self):
         # Listen for nodes trying to connect
@@ -129,35 +278,325 @@ class Master(object):
         self.server.bind('tcp://0.0.0.0:1234')
         self.server.run()
     
+    def moves(self):
+        # Work through the pending moves, one at a time
+        while True:
+            start, end, source, slave = self.pending.get()
+            try:
+                self.move(start, end, source, slave)
+            except Exception:
+                logger.exception('Failed to move [%i, %i] from %s to %s' % (
+                    start, end, repr(source), repr(slave)))
+            finally:
+                self.pending.task_done()
+    
+    def move(self, start, end, source, new):
+        # Add the slave `new` to the replicas of [start, end], copying it from
+        # `source` (or any replica, if None), and then take it off `source`.
+        # Either of `source` and `new` may be None, to only add or only drop
+        # a replica. The last replica of a range is never dropped
+        members = list(self.rangemap[start][1] or ())
+        release = source if source in members else None
+        changed = False
+        if new is not None and new not in members and new in self.features:
+            donors = [s for s in [release] + members
+                if s is not None and 'transfer' in self.features.get(s, ())]
+            if donors:
+                self.copy(start, end, donors[0], new)
+            else:
+                # Nothing to copy from, so it'll just have to start from scratch
+                new.load(start, end)
+            # The replicas may have changed while we were copying
+            members = list(self.rangemap[start][1] or ()) + [new]
+            changed = True
+        if release is not None and release in members and len(members) > 1:
+            members.remove(release)
+            changed = True
+        else:
+            release = None
+        
+        if changed:
+            self.rangemap.insert(start, end, self.replicas(members))
+            self.migrating.remove(start, end)
+            self.publish()
+        if release is not None:
+            release.unload(start, end)
+            logger.info('Released [%i, %i] from %s' % (
+                start, end, repr(release)))
+    
+    def copy(self, start, end, old, new):
+        # Copy the range [start, end] from the slave `old` to the slave `new`.
+        # The replicas keep serving it while its hashes are streamed over in
+        # chunks, and writes to the range go to the new slave too in the
+        # meantime. The caller adds it to the replicas once it has everything
+        config = self._config.get('migration', {})
+        chunk  = config.get('chunk', self.move_chunk)
+        rate   = config.get('rate' , self.move_rate)
+        
+        new.prepare(start, end)
+        self.migrating.insert(start, end, new)
+        # Clients writing to the slaves themselves need to know about it, too
+        self.publish()
+        try:
+            # Writes are already going to both, so anything the old slave gets
+            # after it takes stock here will also make it to the new one
+            count = old.transfer(start, end)
+            for offset in range(0, count, chunk):
+                new.receive(start, old.stream(start, offset, chunk))
+                gevent.sleep(float(min(chunk, count - offset)) / rate)
+            new.finish(start)
+        except Exception:
+            self.migrating.remove(start, end)
+            self.publish()
+            try:
+                new.unload(start, end)
+            except Exception:
+                logger.exception('Failed to unload [%i, %i] from %s' % (
+                    start, end, repr(new)))
+            raise
+        logger.info('Copied [%i, %i] from %s to %s' % (
+            start, end, repr(old), repr(new)))
+    
+    def label(self, thing, names):
+        # A readable name for a slave (or replica set) in metrics
+        if isinstance(thing, ReplicaSet):
+            return '+'.join(self.label(slave, names) for slave in thing)
+        return names.get(thing) or str(thing)
+    
+    def metrics(self, slaves=False):
+        # Our metrics and, with `slaves`, those of each slave by hostname
+        names = dict((slave, hostname)
+            for hostname, slave in self.slaves.items())
+        results = self._metrics.snapshot(lambda t: self.label(t, names))
+        if slaves:
+            targets = dict((slave, ()) for slave in self.slaves.values()
+                if 'metrics' in self.features.get(slave, ()))
+            try:
+                responses = self.scatter.gather(targets, 'metrics')
+            except Scatter.PartialFailure as exc:
+                responses = exc.results
+            results['slaves'] = dict(
+                (names[slave], response) for slave, response in responses.items())
+        return results
+    
+    def capabilities(self):
+        # The wire formats we understand, beyond lists of ints
+        return [packed.PACKED]
+    
+    def negotiate(self, slave):
+        # Find out what this slave supports, like whether or not it can speak
+        # the packed format. Slaves from before `capabilities` support nothing
+        try:
+            self.features[slave] = set(slave.capabilities())
+        except Exception:
+            self.features[slave] = set()
+        if packed.PACKED in self.features[slave]:
+            self.packed.add(slave)
+        else:
+            logger.info('%s does not support the packed format' % repr(slave))
+    
+    # Clients may route requests themselves, and send them straight to the
+    # slaves (see smhcluster.client). They ask us for the routing table, and
+    # each time it changes, it gets a new epoch, which every slave is told
+    # about before anything else happens. Slaves turn away requests routed
+    # with an older table, and the client fetches the new one and tries again.
+    # Writes that go straight to the slaves don't clear our cached answers, so
+    # while the cache is enabled, we won't hand out a table at all
+    def routing(self):
+        # The current routing table: where each range's replicas are (by
+        # hostname), where ranges being copied are going, and how hashes are
+        # placed in them
+        self.publish()
+        if self.cache.enabled:
+            raise Master.Cached('Clients must go through the master while '
+                'its cache is enabled')
+        return {
+            'epoch'         : self.epoch,
+            'shards'        : self.shards,
+            'differing_bits': self.differing_bits,
+            'probe'         : self.probe,
+            'hedge'         : self.replication.hedge,
+            'writes'        : self.replication.writes,
+            'ranges'        : [(start, end, [s.hostname for s in replicas or ()])
+                for start, end, replicas in self.rangemap],
+            'migrating'     : [(start, end, slave.hostname)
+                for start, end, slave in self.migrating]
+        }
+    
+    def publish(self):
+        # Start a new routing table if anything in it has changed since the
+        # last one, fencing every slave before returning. Callers publish
+        # after changing the ranges and before acting on it (taking stock of
+        # a range to copy, or unloading one), so nothing routed the old way
+        # can get to a slave after that. Enabling the cache starts a new table
+        # too, so that tables handed out before it are turned away
+        with self.publishing:
+            state = (self.rangemap.version, self.migrating.version,
+                self.differing_bits, self.probe, self.cache.enabled)
+            if state != self.published:
+                # Epochs carry on from the clock, so that they keep going up
+                # even if we're restarted
+                self.epoch = max(self.epoch + 1, int(time.time() * 1000))
+                self.published = state
+                self.fence(list(self.slaves.values()))
+        return self.epoch
+    
+    def fence(self, slaves):
+        # Tell these slaves the current epoch. One that doesn't hear it will
+        # keep taking requests from out-of-date clients until it does, but
+        # those clients hear about it from the others it shares ranges with
+        calls = dict((slave, ('fence', (self.epoch,))) for slave in slaves
+            if 'direct' in self.features.get(slave, ()))
+        try:
+            self.scatter.gather_calls(calls)
+        except Scatter.PartialFailure:
+            pass
+    
     def find(self, h):
         slave = self.rangemap.find(h)
         if not slave:
             raise Master.RangeUnassigned('%i unavailable' % h)
         return slave
     
-    def find_first(self, *hashes):
-        destinations = defaultdict(list)
-        for h in hashes:
-            destinations[self.find(h)].append(h)
-        
-        results = []
-        for k, queries in destinations.items():
-            results.extend(zip(queries, k.find_first(*queries)))
-            logger.info('Finished querying %s' % k)
-        return results
+    def route(self, queries):
+        # Group the queries by the slave responsible for them. Returns a mapping
+        # of slave -> array of indices into queries
+        destinations = self.router.route(queries, self.rangemap)
+        if None in destinations:
+            raise Master.RangeUnassigned('%i unavailable' %
+                queries[destinations[None][0]])
+        return destinations
     
-    def find_all(self, *hashes):
-        destinations = defaultdict(list)
-        for h in hashes:
-            destinations[self.find(h)].append(h)
+    def probes(self, queries):
+        # Group the queries by every slave responsible for a variant of them,
+        # for when each hash is stored only in its own shard. Returns a mapping
+        # of slave -> array of indices into queries
+        variants, _ = self.router.variants(queries)
+        owners = numpy.arange(len(variants)) // len(self.router.flips)
+        # A slave answers for all of its shards at once, so it only needs to
+        # be sent each query once
+        return dict((slave, numpy.unique(owners[indices]))
+            for slave, indices in self.route(variants).items())
+    
+    def placements(self, hashes):
+        # Where to store each of the hashes, as a tuple of arrays (queries,
+        # hashes) where the shard for queries[i] gets hashes[i]
+        if self.probe:
+            hashes = numpy.asarray(hashes, dtype=numpy.uint64)
+            return hashes, hashes
+        return self.router.variants(hashes)
+    
+    def merge(self, method, count, destinations, responses, failures):
+        # Combine the answers each slave gave for the queries it was sent. Only
+        # queries that every slave they were sent to answered are answered
+        answered = numpy.zeros(count, dtype=bool)
+        for slave, indices in destinations.items():
+            answered[indices] = True
+        for slave in failures:
+            answered[destinations[slave]] = False
+        if method == 'find_first':
+            results = numpy.zeros(count, dtype=numpy.uint64)
+            for slave, response in responses.items():
+                indices  = destinations[slave]
+                response = numpy.asarray(response, dtype=numpy.uint64)
+                current  = results[indices]
+                # The smallest match from any of them
+                better   = (response != 0) & (
+                    (current == 0) | (response < current))
+                results[indices] = numpy.where(better, response, current)
+            results = results.tolist()
+        else:
+            results = [set() for i in range(count)]
+            for slave, response in responses.items():
+                for i, result in zip(destinations[slave].tolist(), response):
+                    results[i].update(numpy.asarray(result).tolist())
+            results = [sorted(r) for r in results]
+        answered = numpy.flatnonzero(answered)
+        return ({self.PROBES: answered},
+            {self.PROBES: [results[i] for i in answered.tolist()]})
+    
+    def is_packed(self, target):
+        # Whether this slave (or every slave in this replica set) understands
+        # the packed format
+        if isinstance(target, ReplicaSet):
+            return target.packed
+        return target in self.packed
+    
+    def _call(self, slave, method, queries, hashes=None):
+        # The (method, arguments) with which to send this slave its batch, in
+        # whichever format it understands
+        if self.is_packed(slave):
+            if hashes is None:
+                return method + '_packed', (packed.pack_hashes(queries),)
+            return method + '_packed', (packed.pack_pairs(queries, hashes),)
+        if hashes is None:
+            return method, queries.tolist()
+        return method, list(zip(queries.tolist(), hashes.tolist()))
+    
+    def _scatter(self, method, queries):
+        # Send each slave the queries it's responsible for, and return a tuple
+        # of (destinations, responses, failures). With probe, answers from
+        # every slave a query went to come back merged, as though from one
+        start = time.time()
+        route = self.probes if self.probe else self.route
+        if self.cache.enabled:
+            # Only the queries we don't have answers for go anywhere. The rest
+            # come back as though from one more slave, the cache
+            hits, cached, misses, token = self.cache.lookup(method, queries)
+            misses = numpy.array(misses, dtype=numpy.intp)
+            destinations = dict((slave, misses[indices]) for slave, indices
+                in route(queries[misses]).items()) if len(misses) else {}
+        else:
+            destinations = route(queries)
+        calls = dict((slave, self._call(slave, method, queries[indices]))
+            for slave, indices in destinations.items())
+        routed = time.time()
+        try:
+            responses, failures = self.scatter.gather_calls(calls), {}
+        except Scatter.PartialFailure as exc:
+            responses, failures = exc.results, exc.failures
+        self.record(method, len(queries), start, routed, failures)
         
-        results = []
-        for k, queries in destinations.items():
-            results.extend(zip(queries, k.find_all(*queries)))
-            logger.info('Finished querying %s' % k)
-        return results
+        for slave, response in responses.items():
+            if self.is_packed(slave):
+                if method == 'find_first':
+                    responses[slave] = packed.unpack_hashes(response)
+                else:
+                    responses[slave] = packed.unpack_sets(response)
+        if self.probe:
+            destinations, responses = self.merge(
+                method, len(queries), destinations, responses, failures)
+        if self.cache.enabled:
+            for slave, response in responses.items():
+                self.cache.store(
+                    method, queries[destinations[slave]], response, token)
+            if hits:
+                destinations[self.cache] = numpy.array(hits, dtype=numpy.intp)
+                responses[self.cache] = cached
+        return destinations, responses, failures
     
-    def insert(self, *hashes):
+    def _query(self, method, hashes):
+        # Group the queries by the slave responsible for them, remembering the
+        # position of each one so that we can put the answers back in order
+        destinations, responses, failures = self._scatter(
+            method, numpy.array(hashes, dtype=numpy.uint64))
+
+        # Queries belonging to a slave that failed are left as None
+        results = [None] * len(hashes)
+        for slave, response in responses.items():
+            if self.is_packed(slave):
+                if method == 'find_first':
+                    response = response.tolist()
+                else:
+                    response = [r.tolist() for r in response]
+            for i, result in zip(destinations[slave].tolist(), response):
+                results[i] = (hashes[i], result)
+
+        if failures:
+            raise Scatter.PartialFailure(failures, results)
+        return results
+
+    def _mutate(self, method, hashes):
         # Because we map each query onto a range, we have to make sure that each
         # conceivable match for any query in that range is available. So for a 
         # query for 0110100101101101, we'd map it onto a range, and return the
@@ -169,30 +608,260 @@ class Master(object):
         # In particular, if we are configured to use 3 differing bits, then we 
         # need to insert it into each of the ranges indicated by flipping the 
         # 3 MSBs of the hash to insert by 0, 1, 2, 3, 4, 5, 6 and 7.
-        #
-        # This is a map of destinations to the queries
-        destinations = defaultdict(list)        
-        for h in hashes:
-            for i in range(1 << self.differing_bits):
-                q = h ^ (i << (64 - self.differing_bits))
-                logger.debug('Looking up %s (%i)' % (bin(q), q))
-                destinations[self.find(q)].append((q, h))
+        start = time.time()
+        try:
+            return self._write(method, hashes, start)
+        finally:
+            # Whether or not every slave took the write, cached answers near
+            # these hashes may no longer be right
+            if self.cache.enabled:
+                self.cache.invalidate(numpy.asarray(hashes, dtype=numpy.uint64))
+    
+    def _write(self, method, hashes, start):
+        # The router produces all of the variants for the whole batch at once
+        # (unless with probe, each hash only goes to its own shard)
+        queries, hashes = self.placements(hashes)
+        destinations = self.route(queries)
+        if len(self.migrating):
+            # Writes to ranges that are being copied go to the new slave, too
+            for slave, indices in self.migrator.route(
+                queries, self.migrating).items():
+                if slave is None:
+                    continue
+                if slave in destinations:
+                    indices = numpy.union1d(destinations[slave], indices)
+                destinations[slave] = indices
         
-        for k, insertions in destinations.items():
-            k.insert(*insertions)
-            logger.info('Finished inserting %s' % k)
+        calls = dict(
+            (slave, self._call(slave, method, queries[i], hashes[i]))
+            for slave, i in destinations.items())
+        routed = time.time()
+
+        # Every slave gets its batch at the same time. If any of them fail, the
+        # others have still applied theirs, which the exception reflects
+        try:
+            self.scatter.gather_calls(calls)
+        except Scatter.PartialFailure as exc:
+            self.record(method, len(hashes), start, routed, exc.failures)
+            raise
+        self.record(method, len(hashes), start, routed)
         return True
     
+    def _claim(self, hashes):
+        # Check for a near-duplicate of each hash and insert it if there isn't
+        # one, in a single round trip. Every variant of each hash goes to its
+        # slave, just like an insert, and each slave inserts it only if there's
+        # no near-duplicate in that shard. Every shard holding a variant of h
+        # holds the same candidates, so they all make the same call; we answer
+        # with what the shard h itself belongs to said. Returns (results,
+        # failures, missing): an array of the near-duplicate found for each
+        # hash (or 0 where it was inserted), the slaves that failed, and if any
+        # did, which of the hashes we have no answer for
+        #
+        # With probe, each hash is only stored in its own shard, but its
+        # near-duplicates could be in any of the shards a query for it probes.
+        # So we look there first, and then claim only those with none in their
+        # own shard. That takes two round trips, and near-duplicates claimed at
+        # the same time in different shards could both be inserted
+        start = time.time()
+        hashes = numpy.asarray(hashes, dtype=numpy.uint64)
+        try:
+            found    = numpy.zeros(len(hashes), dtype=numpy.uint64)
+            missing  = numpy.zeros(len(hashes), dtype=bool)
+            failures = {}
+            claim    = numpy.arange(len(hashes))
+            if self.probe:
+                destinations, responses, failures = self._scatter(
+                    'find_first', hashes)
+                missing[:] = True
+                for key, indices in destinations.items():
+                    found[indices]   = responses[key]
+                    missing[indices] = False
+                claim = numpy.flatnonzero((found == 0) & ~missing)
+            
+            queries, variants = self.placements(hashes[claim])
+            destinations = self.route(queries)
+            calls = dict((slave, self._call(
+                slave, 'find_first_or_insert', queries[i], variants[i]))
+                for slave, i in destinations.items())
+            routed = time.time()
+            try:
+                responses, failed = self.scatter.gather_calls(calls), {}
+            except Scatter.PartialFailure as exc:
+                responses, failed = exc.results, exc.failures
+            self.record('find_first_or_insert', len(hashes), start, routed,
+                failed)
+            failures.update(failed)
+            
+            results = numpy.zeros(len(queries), dtype=numpy.uint64)
+            for slave, response in responses.items():
+                if self.is_packed(slave):
+                    response = packed.unpack_hashes(response)
+                results[destinations[slave]] = response
+            
+            # Ranges being copied only see the hashes that were inserted. The
+            # copy will bring along the rest
+            if len(self.migrating):
+                inserted = numpy.flatnonzero(results == 0)
+                calls = dict((slave, self._call(slave, 'insert',
+                    queries[inserted[i]], variants[inserted[i]]))
+                    for slave, i in self.migrator.route(
+                        queries[inserted], self.migrating).items()
+                    if slave is not None)
+                try:
+                    self.scatter.gather_calls(calls)
+                except Scatter.PartialFailure as exc:
+                    failures.update(exc.failures)
+            
+            # The variant with nothing flipped is the hash itself
+            stride = 1 if self.probe else len(self.router.flips)
+            found[claim] = results[::stride]
+            if failures:
+                # We don't know the answer for hashes whose shard didn't answer
+                unanswered = numpy.zeros(len(queries), dtype=bool)
+                for slave in failed:
+                    if slave in destinations:
+                        unanswered[destinations[slave]] = True
+                missing[claim] |= unanswered[::stride]
+                return found, failures, missing
+            return found, failures, None
+        finally:
+            if self.cache.enabled:
+                self.cache.invalidate(hashes)
+    
+    def record(self, method, count, start, routed, failures=None):
+        # Record how long a request spent being routed, and then waiting on
+        # slaves, and how big it was
+        if not self._metrics.enabled:
+            return
+        self._metrics.incr(('requests', method))
+        self._metrics.observe(('batch', method), count)
+        self._metrics.observe(('route', method), routed - start)
+        self._metrics.observe(('scatter', method), time.time() - routed)
+        if failures:
+            self._metrics.incr(('failures', method), len(failures))
+
+    def find_first(self, *hashes):
+        return self._query('find_first', hashes)
+    
+    def find_all(self, *hashes):
+        return self._query('find_all', hashes)
+    
+    def insert(self, *hashes):
+        if self.coalescer.enabled:
+            return self.coalescer.add('insert', hashes)
+        return self._mutate('insert', hashes)
+    
     def remove(self, *hashes):
-        # See the note in `insert`
-        destinations = defaultdict(list)        
-        for h in hashes:
-            for i in range(1 << self.differing_bits):
-                q = h ^ (i << (64 - self.differing_bits))
-                logger.debug('Looking up %s (%i)' % (bin(q), q))
-                destinations[self.find(q)].append((q, h))
+        # See the note in `_mutate`
+        if self.coalescer.enabled:
+            return self.coalescer.add('remove', hashes)
+        return self._mutate('remove', hashes)
+    
+    # Fire-and-forget forms of insert and remove. These return as soon as the
+    # hashes have been added to the next coalesced batch (whether or not
+    # coalescing is enabled for plain inserts and removes), so failures only
+    # show up in the logs and the `coalesce` metrics. Call `flush` to wait for
+    # everything sent so far to be applied
+    def insert_nowait(self, *hashes):
+        return self.coalescer.add('insert', hashes, wait=False)
+    
+    def remove_nowait(self, *hashes):
+        return self.coalescer.add('remove', hashes, wait=False)
+    
+    def flush(self):
+        self.coalescer.flush()
+        return True
+    
+    def find_first_or_insert(self, *hashes):
+        # The first near-duplicate of each hash if there is one, or 0 if there
+        # wasn't and the hash has now been inserted, as (hash, result) pairs
+        results, failures, missing = self._claim(hashes)
+        results = list(zip(hashes, results.tolist()))
+        if failures:
+            for i in numpy.flatnonzero(missing).tolist():
+                results[i] = None
+            raise Scatter.PartialFailure(failures, results)
+        return results
+    
+    # Packed forms of the above. These accept a packed buffer of hashes, and
+    # the queries return packed buffers of results in the same order
+    def find_first_packed(self, buf):
+        queries = packed.unpack_hashes(buf)
+        destinations, responses, failures = self._scatter('find_first', queries)
+        if failures:
+            raise Scatter.PartialFailure(failures, {})
         
-        for k, removals in destinations.items():
-            k.remove(*removals)
-            logger.info('Finished inserting %s' % k)
-        return True
\ No newline at end of file
+        results = numpy.zeros(len(queries), dtype=packed.DTYPE)
+        for slave, response in responses.items():
+            results[destinations[slave]] = response
+        return packed.pack_hashes(results)
+    
+    def find_all_packed(self, buf):
+        queries = packed.unpack_hashes(buf)
+        destinations, responses, failures = self._scatter('find_all', queries)
+        if failures:
+            raise Scatter.PartialFailure(failures, {})
+        
+        results = [()] * len(queries)
+        for slave, response in responses.items():
+            for i, result in zip(destinations[slave].tolist(), response):
+                results[i] = result
+        return packed.pack_sets(results)
+    
+    def insert_packed(self, buf):
+        return self._mutate('insert', packed.unpack_hashes(buf))
+    
+    def remove_packed(self, buf):
+        return self._mutate('remove', packed.unpack_hashes(buf))
+    
+    def find_first_or_insert_packed(self, buf):
+        results, failures, missing = self._claim(packed.unpack_hashes(buf))
+        if failures:
+            raise Scatter.PartialFailure(failures, {})
+        return packed.pack_hashes(results)
+    
+    def clusters(self, path, fmt='packed'):
+        # Group every hash that has near-duplicates into clusters, writing out
+        # which cluster each one is in to files under path, and return a
+        # summary. Each slave does most of the work (see smhcluster.clusters)
+        return Job(self, path, fmt, self._config.get('clusters', {})).run()
+    
+    def ingest(self, method='insert'):
+        # Start streaming in hashes to insert (or remove). Feed arrays of them
+        # to the Ingest this returns, and then close it
+        if method not in ('insert', 'remove'):
+            raise ValueError('Can only ingest inserts or removes')
+        config = self._config.get('ingest', {})
+        return Ingest(lambda hashes: self._mutate(method, hashes),
+            config.get('chunk', self.ingest_chunk),
+            config.get('window', self.ingest_window))
+    
+    # The streaming form of insert_packed and remove_packed over RPC. Open a
+    # stream, feed it packed buffers of hashes (each call returns once there's
+    # room for more, along with the progress so far), and then close it to wait
+    # for everything to be acknowledged
+    def ingest_open(self, method='insert'):
+        # Anything that's been abandoned has had long enough
+        idle = self._config.get('ingest', {}).get('idle', self.ingest_idle)
+        for key, ingest in list(self.ingests.items()):
+            if time.time() - ingest.touched > idle:
+                logger.warning('Abandoning idle ingest %s' % key)
+                self.ingests.pop(key).close()
+        key = '%i' % next(self.ingest_id)
+        self.ingests[key] = self.ingest(method)
+        return key
+    
+    def ingest_feed(self, key, buf):
+        return self.ingests[key].feed(packed.unpack_hashes(buf))
+
+    # The reports of the stream's chunks that have finished since we last
+    # asked. With wait, first send whatever's left and wait for it to finish
+    def ingest_finished(self, key, wait=False):
+        ingest = self.ingests[key]
+        if wait:
+            ingest.close()
+        return ingest.finished()
+
+    def ingest_close(self, key):
+        return self.ingests.pop(key).close()
@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+
+# Counters and latency histograms for the hot paths of the master and slaves.
+# Recording has to be cheap, so nothing is formatted until someone asks for a
+# snapshot: metrics are keyed by tuples (like ('rpc', 'find_first', slave)),
+# counters are plain ints, and histograms just bump a bucket count. Things like
+# queue depths and shard sizes are gauges, which are only computed on demand.
+
+import math
+
+class Histogram(object):
+    # Each power of two is split into this many buckets, so recorded values are
+    # accurate to within about 1 / (2 * buckets) of what they were
+    buckets = 16
+    # The bucket for zero (and anything less)
+    zero    = -(1 << 30)
+
+    def __init__(self):
+        # A mapping of bucket -> how many values landed in it
+        self.counts = {}
+        self.count  = 0
+        self.total  = 0.0
+        self.min    = None
+        self.max    = None
+
+    def bucket(self, value):
+        if value <= 0:
+            return self.zero
+        # value = mantissa * 2 ** exponent, with 0.5 <= mantissa < 1
+        mantissa, exponent = math.frexp(value)
+        return exponent * self.buckets + int(
+            (mantissa - 0.5) * 2 * self.buckets)
+
+    def value(self, bucket):
+        '''The value in the middle of a bucket'''
+        if bucket == self.zero:
+            return 0.0
+        exponent, i = divmod(bucket, self.buckets)
+        return math.ldexp(0.5 + (i + 0.5) / (2.0 * self.buckets), exponent)
+
+    def record(self, value):
+        bucket = self.bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentiles(self, percentiles):
+        '''The values at each of the provided percentiles (0 to 100)'''
+        seen    = 0
+        buckets = sorted(self.counts.items())
+        targets = sorted((p * self.count / 100.0, i)
+            for i, p in enumerate(percentiles))
+        values  = [None] * len(percentiles)
+        for bucket, count in buckets:
+            seen += count
+            while targets and targets[0][0] <= seen:
+                values[targets.pop(0)[1]] = min(self.value(bucket), self.max)
+        for target, i in targets:
+            values[i] = self.max
+        return values
+
+    def summary(self):
+        p50, p90, p99, p999 = self.percentiles([50, 90, 99, 99.9])
+        return {
+            'count': self.count,
+            'sum'  : self.total,
+            'mean' : self.total / self.count if self.count else 0.0,
+            'min'  : self.min,
+            'max'  : self.max,
+            'p50'  : p50,
+            'p90'  : p90,
+            'p99'  : p99,
+            'p999' : p999
+        }
+
+class Metrics(object):
+    def __init__(self):
+        self.enabled    = True
+        self.counters   = {}
+        self.histograms = {}
+        # A mapping of name -> function returning either a number or a mapping
+        # of key -> number
+        self.gauges     = {}
+
+    # Idempotently accept new configurations
+    def config(self, config):
+        for key in config.keys():
+            if key not in ('enabled',):
+                raise KeyError('Unknown configuration option %s' % key)
+        self.enabled = config.get('enabled', True)
+
+    def incr(self, key, count=1):
+        if self.enabled:
+            self.counters[key] = self.counters.get(key, 0) + count
+
+    def observe(self, key, value):
+        if self.enabled:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.record(value)
+
+    def gauge(self, key, function):
+        self.gauges[key] = function
+
+    def reset(self):
+        self.counters   = {}
+        self.histograms = {}
+
+    def name(self, key, label=str):
+        '''Turn a key into a dotted name, using `label` to name anything in it
+        that isn't a string'''
+        if not isinstance(key, tuple):
+            key = (key,)
+        return '.'.join(
+            part if isinstance(part, str) else label(part) for part in key)
+
+    def snapshot(self, label=str):
+        '''Everything recorded so far, as a dictionary of plain values'''
+        gauges = {}
+        for key, function in self.gauges.items():
+            value = function()
+            if isinstance(value, dict):
+                value = dict((self.name(k, label), v) for k, v in value.items())
+            gauges[self.name(key, label)] = value
+        return {
+            'enabled'   : self.enabled,
+            'counters'  : dict((self.name(k, label), v)
+                for k, v in self.counters.items()),
+            'histograms': dict((self.name(k, label), h.summary())
+                for k, h in self.histograms.items()),
+            'gauges'    : gauges
+        }
@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+
+# A packed binary format for batches of hashes. Rather than sending lists of
+# Python ints (each of which gets boxed and varint-encoded by msgpack or written
+# out as JSON text), batches are sent as buffers of little-endian uint64s, which
+# go to and from numpy arrays without any per-element work:
+#
+#   hashes: h0 h1 h2 ...
+#   pairs : q0 h0 q1 h1 ...           (for inserts and removes)
+#   sets  : n o0 o1 ... on v0 v1 ...  (for find_all results, where the values
+#                                      for set i are v[o(i)] ... v[o(i+1)-1])
+#
+# Whether or not a peer understands this format is negotiated through its
+# `capabilities` method; peers that don't have one get the old format.
+
+import numpy
+
+# The name of this format, as it appears in capabilities
+PACKED = 'packed'
+
+# The content type to use when sending this over HTTP
+CONTENT_TYPE = 'application/octet-stream'
+
+DTYPE = numpy.dtype('<u8')
+
+def pack_hashes(hashes):
+    '''Pack a sequence of hashes into a buffer'''
+    return numpy.asarray(hashes, dtype=DTYPE).tobytes()
+
+def unpack_hashes(buf):
+    '''Unpack a buffer into an array of hashes. The array refers to the buffer
+    itself, and so is read-only'''
+    return numpy.frombuffer(buf, dtype=DTYPE)
+
+def pack_pairs(queries, hashes):
+    '''Pack parallel sequences of queries and hashes into a buffer of pairs'''
+    pairs = numpy.empty((len(queries), 2), dtype=DTYPE)
+    pairs[:, 0] = queries
+    pairs[:, 1] = hashes
+    return pairs.tobytes()
+
+def unpack_pairs(buf):
+    '''Unpack a buffer of pairs into a tuple of arrays (queries, hashes)'''
+    pairs = numpy.frombuffer(buf, dtype=DTYPE).reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1]
+
+def pack_sets(sets):
+    '''Pack a sequence of sequences of hashes into a buffer'''
+    lengths = numpy.fromiter(
+        (len(s) for s in sets), dtype=DTYPE, count=len(sets))
+    header  = numpy.empty(len(sets) + 2, dtype=DTYPE)
+    header[0] = len(sets)
+    header[1] = 0
+    numpy.cumsum(lengths, out=header[2:])
+    values  = numpy.concatenate([numpy.empty(0, dtype=DTYPE)] +
+        [numpy.asarray(s, dtype=DTYPE) for s in sets])
+    return header.tobytes() + values.tobytes()
+
+def unpack_sets(buf):
+    '''Unpack a buffer into a list of arrays of hashes'''
+    data    = numpy.frombuffer(buf, dtype=DTYPE)
+    count   = int(data[0])
+    if not count:
+        return []
+    offsets = data[1:count + 2].astype(numpy.intp)
+    values  = data[count + 2:]
+    return numpy.split(values, offsets[1:-1])
@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+
+# Decides which nodes should hold which shards. Given the current placement and
+# a weight for each node (how much of the cluster it should hold), the planner
+# works out a target placement that's proportional to the weights while moving
+# as few shards as possible, and the ordered list of moves to get there.
+#
+# Shards stay where they are unless their node is gone or holds more than its
+# share. Which shards a node gives up, and which node picks up a shard, are
+# decided by rendezvous hashing, so the same inputs always give the same plan.
+
+import zlib
+from collections import defaultdict
+
+class Planner(object):
+    def __init__(self, shards, replicas=1):
+        self.shards   = shards
+        self.replicas = replicas
+
+    def score(self, shard, node):
+        '''How attached this node is to this shard'''
+        return zlib.crc32(('%s/%i' % (node, shard)).encode('utf-8'))
+
+    def targets(self, weights):
+        '''How many shards each node should hold, in proportion to its weight.
+        No node can hold more than one replica of a shard, so anything that
+        would put more than `shards` on a node is spread across the rest'''
+        targets   = dict((node, 0) for node in weights)
+        active    = sorted(weights)
+        remaining = self.shards * min(self.replicas, len(active))
+        while remaining and active:
+            total  = float(sum(weights[node] for node in active))
+            shares = dict(
+                (node, remaining * weights[node] / total) for node in active)
+            counts = dict((node, int(shares[node])) for node in active)
+            # Hand out what's left over to those with the largest remainders
+            leftover = remaining - sum(counts.values())
+            for node in sorted(active,
+                key=lambda node: counts[node] - shares[node])[0:leftover]:
+                counts[node] += 1
+
+            full = set()
+            for node in active:
+                add = min(counts[node], self.shards - targets[node])
+                targets[node] += add
+                remaining -= add
+                if targets[node] == self.shards:
+                    full.add(node)
+            if not full:
+                break
+            active = [node for node in active if node not in full]
+        return targets
+
+    def plan(self, current, weights):
+        '''Given the current placement as a mapping of shard -> list of nodes,
+        and a mapping of node -> weight, return a tuple (placement, moves).
+        The placement is the new mapping of shard -> list of nodes, and moves is
+        an ordered list of (shard, source, destination):
+
+            (shard, None, node)   -- node should load shard from scratch
+            (shard, old, node)    -- node should copy shard from old, which
+                                     then no longer holds it
+            (shard, old, None)    -- old no longer needs to hold shard
+
+        Nodes that aren't in `weights` are considered gone, and so aren't
+        used as sources'''
+        targets  = self.targets(weights)
+        replicas = min(self.replicas, len(weights))
+        load     = dict((node, 0) for node in weights)
+        placement = dict((shard, []) for shard in range(self.shards))
+        # A mapping of shard -> nodes that are giving it up
+        released = defaultdict(list)
+
+        # First, keep everything we can. Nodes with more than their share give
+        # up the shards they're least attached to
+        holdings = defaultdict(list)
+        for shard, nodes in current.items():
+            for node in nodes:
+                if node in weights:
+                    holdings[node].append(shard)
+        for node in sorted(holdings,
+            key=lambda node: (len(holdings[node]) - targets[node], node)):
+            # Prefer keeping the shards that others have already given up, so
+            # that we don't end up with shards that lose every replica
+            shards = holdings[node]
+            shards.sort(key=lambda shard: (
+                len(released[shard]), self.score(shard, node)), reverse=True)
+            for shard in shards:
+                if load[node] < targets[node] and (
+                    len(placement[shard]) < replicas):
+                    placement[shard].append(node)
+                    load[node] += 1
+                else:
+                    released[shard].append(node)
+
+        # Now fill in the missing replicas, preferring the nodes that are the
+        # furthest below their targets
+        loads, moves = [], []
+        for shard in range(self.shards):
+            holders = placement[shard]
+            while len(holders) < replicas:
+                candidates = [node for node in weights if node not in holders]
+                under = [node for node in candidates
+                    if load[node] < targets[node]]
+                node = max(under or candidates, key=lambda node: (
+                    targets[node] - load[node], self.score(shard, node)))
+                holders.append(node)
+                load[node] += 1
+                if released[shard]:
+                    moves.append((shard, released[shard].pop(), node))
+                else:
+                    loads.append((shard, None, node))
+
+        # Any remaining released copies are simply dropped
+        drops = [(shard, node, None)
+            for shard, nodes in sorted(released.items()) for node in nodes]
+        return placement, loads + self.interleave(moves) + drops
+
+    def interleave(self, moves):
+        '''Order moves round-robin by source, so that no one node is asked to
+        send all of its shards before anyone else sends any'''
+        by_source = defaultdict(list)
+        for move in moves:
+            by_source[move[1]].append(move)
+        queues = [by_source[source] for source in sorted(by_source)]
+        results = []
+        while queues:
+            results.extend(queue.pop(0) for queue in queues)
+            queues = [queue for queue in queues if queue]
+        return results
+
+    def movement(self, current, weights):
+        '''How many shard copies would have to be created to rebalance'''
+        placement, moves = self.plan(current, weights)
+        return len([move for move in moves if move[2] is not None])
@@ -0,0 +1,230 @@
+#! /usr/bin/env python
+
+# Each shard may be served by several slaves (replicas). The master treats the
+# replicas of a shard as a single ReplicaSet, which has the same query and write
+# methods as a slave:
+#
+#   - reads go to the replica with the lowest (exponentially-weighted moving
+#     average) latency. If it hasn't answered by the time most of its requests
+#     would have (a configurable percentile of its recent latencies), the read
+#     is hedged by sending it to the next-best replica too, and whichever answers
+#     first wins. Replicas that fail are skipped right away.
+#   - writes go to every replica, and return once a quorum of them has
+#     acknowledged the write.
+
+import time
+
+import gevent
+
+from . import logger
+
+class Tracker(object):
+    # How heavily to weight the newest sample in the moving average
+    alpha   = 0.2
+    # How many recent samples to keep for percentiles
+    samples = 256
+    # How long to wait before hedging when we know nothing about a slave
+    default = 0.01
+    # The latency to charge a slave for a failed request
+    penalty = 1.0
+
+    def __init__(self):
+        # A mapping of slave -> moving average of its latency
+        self.averages = {}
+        # A mapping of slave -> list of recent latencies, as a ring buffer
+        self.recent   = {}
+        self.cursors  = {}
+
+    def observe(self, slave, seconds):
+        average = self.averages.get(slave)
+        if average is None:
+            self.averages[slave] = seconds
+        else:
+            self.averages[slave] = average + self.alpha * (seconds - average)
+        recent = self.recent.setdefault(slave, [])
+        if len(recent) < self.samples:
+            recent.append(seconds)
+        else:
+            cursor = self.cursors.get(slave, 0)
+            recent[cursor] = seconds
+            self.cursors[slave] = (cursor + 1) % self.samples
+
+    def failed(self, slave):
+        self.observe(slave, self.penalty)
+
+    def latency(self, slave):
+        '''The moving average of this slave's latency. Slaves we haven't heard
+        from yet are assumed to be fast, so that they get tried'''
+        return self.averages.get(slave, 0)
+
+    def percentile(self, slave, percentile):
+        recent = self.recent.get(slave)
+        if not recent or len(recent) < 16:
+            return self.default
+        ordered = sorted(recent)
+        return ordered[min(len(ordered) - 1,
+            int(len(ordered) * percentile / 100.0))]
+
+    def forget(self, slave):
+        for table in (self.averages, self.recent, self.cursors):
+            table.pop(slave, None)
+
+class ReplicaSet(object):
+    def __init__(self, slaves, replication, packed=False):
+        self.slaves      = tuple(slaves)
+        self.replication = replication
+        # Whether every one of these slaves understands the packed format
+        self.packed      = packed
+
+    def __repr__(self):
+        return '<ReplicaSet %s>' % ', '.join(repr(s) for s in self.slaves)
+
+    def __iter__(self):
+        return iter(self.slaves)
+
+    def __len__(self):
+        return len(self.slaves)
+
+    def __contains__(self, slave):
+        return slave in self.slaves
+
+    def timed(self, slave, method, args):
+        start = time.time()
+        try:
+            result = getattr(slave, method)(*args)
+        except Exception:
+            self.replication.tracker.failed(slave)
+            raise
+        self.replication.tracker.observe(slave, time.time() - start)
+        return result
+
+    def read(self, method, *args):
+        '''Send a read to the best replica, hedging to the next best if it
+        takes longer than usual, and return the first answer'''
+        tracker = self.replication.tracker
+        if len(self.slaves) == 1:
+            return self.timed(self.slaves[0], method, args)
+
+        # Slaves whose connections are down go last, so that we only wait on
+        # them (and they fail fast) if nothing else answers
+        candidates = sorted(self.slaves, key=lambda slave: (
+            not getattr(slave, 'healthy', True), tracker.latency(slave)))
+        waiting, last = [], None
+        while candidates or waiting:
+            timeout = None
+            if candidates:
+                slave = candidates.pop(0)
+                waiting.append(gevent.spawn(self.timed, slave, method, args))
+                if candidates:
+                    timeout = tracker.percentile(
+                        slave, self.replication.hedge)
+            for greenlet in gevent.wait(waiting, timeout=timeout, count=1):
+                waiting.remove(greenlet)
+                if greenlet.successful():
+                    gevent.killall(waiting, block=False)
+                    return greenlet.value
+                last = greenlet.exception
+        raise last
+
+    def write(self, method, *args):
+        '''Send a write to every replica, and return once a quorum of them
+        have acknowledged it'''
+        if len(self.slaves) == 1:
+            return self.timed(self.slaves[0], method, args)
+
+        quorum  = self.replication.quorum(len(self.slaves))
+        waiting = [gevent.spawn(self.timed, slave, method, args)
+            for slave in self.slaves]
+        acks, failures, result = 0, [], None
+        while waiting:
+            for greenlet in gevent.wait(waiting, count=1):
+                waiting.remove(greenlet)
+                if greenlet.successful():
+                    acks += 1
+                    result = greenlet.value
+                else:
+                    failures.append(greenlet.exception)
+            if acks >= quorum:
+                # The rest carry on without us, but we want to hear if they fail
+                for greenlet in waiting:
+                    greenlet.link_exception(self.straggler)
+                return result
+            if len(failures) > len(self.slaves) - quorum:
+                raise failures[-1]
+        return result
+
+    def straggler(self, greenlet):
+        logger.error('Write to a replica in %s failed after quorum: %s' % (
+            repr(self), repr(greenlet.exception)))
+
+    def find_first(self, *hashes):
+        return self.read('find_first', *hashes)
+
+    def find_all(self, *hashes):
+        return self.read('find_all', *hashes)
+
+    def find_first_packed(self, buf):
+        return self.read('find_first_packed', buf)
+
+    def find_all_packed(self, buf):
+        return self.read('find_all_packed', buf)
+
+    def insert(self, *insertions):
+        return self.write('insert', *insertions)
+
+    def remove(self, *removals):
+        return self.write('remove', *removals)
+
+    def insert_packed(self, buf):
+        return self.write('insert_packed', buf)
+
+    def remove_packed(self, buf):
+        return self.write('remove_packed', buf)
+
+    def find_first_or_insert(self, *pairs):
+        return self.write('find_first_or_insert', *pairs)
+
+    def find_first_or_insert_packed(self, buf):
+        return self.write('find_first_or_insert_packed', buf)
+
+class Replication(object):
+    def __init__(self):
+        self.tracker  = Tracker()
+        # The percentile of a replica's latency after which to hedge reads
+        self.hedge    = 95
+        # How many replicas must acknowledge a write: 'all', 'majority' or a
+        # number
+        self.writes   = 'majority'
+        # One ReplicaSet for each distinct group of slaves
+        self.sets     = {}
+
+    # Idempotently accept new configurations
+    def config(self, config):
+        for key in config.keys():
+            if key not in ('replicas', 'hedge', 'writes'):
+                raise KeyError('Unknown configuration option %s' % key)
+        self.hedge  = config.get('hedge', 95)
+        self.writes = config.get('writes', 'majority')
+
+    def quorum(self, count):
+        if self.writes == 'all':
+            return count
+        if self.writes == 'majority':
+            return count // 2 + 1
+        return max(1, min(int(self.writes), count))
+
+    def replicas(self, slaves, packed=False):
+        '''The ReplicaSet for this group of slaves, or None if it's empty'''
+        if not slaves:
+            return None
+        key = frozenset(slaves)
+        existing = self.sets.get(key)
+        if existing is None or existing.packed != packed:
+            existing = self.sets[key] = ReplicaSet(slaves, self, packed)
+        return existing
+
+    def forget(self, slave):
+        '''Drop everything we know about a slave that's gone'''
+        self.tracker.forget(slave)
+        for key in [key for key in self.sets if slave in key]:
+            del self.sets[key]
@@ -0,0 +1,119 @@
+#! /usr/bin/env python
+
+# Batched routing of hashes onto shards. Rather than doing a bisect and a dict
+# lookup per hash (and per flipped variant of each hash), we take whole batches
+# as uint64 arrays and map them onto shards with a handful of numpy calls.
+
+import numpy
+
+class Router(object):
+    def __init__(self, differing_bits, shards=None):
+        self.differing_bits = differing_bits
+        # The masks to xor each hash with to get all of its variants. These are
+        # all the combinations of the `differing_bits` most significant bits
+        self.flips = (numpy.arange(1 << differing_bits, dtype=numpy.uint64) <<
+            numpy.uint64(64 - differing_bits))
+        # When there are a power-of-two number of equally-sized shards, the
+        # shard a hash belongs to is just its top bits
+        self.shards = shards
+        self.shift  = None
+        if shards and shards > 1 and (shards & (shards - 1)) == 0:
+            self.shift = numpy.uint64(64 - (shards.bit_length() - 1))
+        # The version of the rangemap that our arrays reflect
+        self.version = None
+
+    def refresh(self, rangemap):
+        '''Take a snapshot of the rangemap's arrays, if it has changed'''
+        if rangemap.version == self.version:
+            return
+        self.starts = numpy.array(rangemap.starts, dtype=numpy.uint64)
+        self.ends   = numpy.array(rangemap.ends  , dtype=numpy.uint64)
+        self.owners = numpy.array(rangemap.owners, dtype=numpy.intp)
+        self.items  = list(rangemap.items)
+        # We can only use the top bits as the index into our arrays if every
+        # shard is present, and they are the shards we expect
+        self.uniform = (self.shift is not None and
+            len(self.starts) == self.shards and
+            numpy.array_equal(self.starts, numpy.arange(self.shards,
+                dtype=numpy.uint64) << self.shift))
+        self.version = rangemap.version
+
+    def variants(self, hashes):
+        '''For each of the hashes, produce all of the variants with their top
+        `differing_bits` flipped. Returns a tuple of arrays (queries, hashes),
+        where hashes[i] is the hash that queries[i] is a variant of'''
+        hashes = numpy.asarray(hashes, dtype=numpy.uint64)
+        queries = (hashes[:, numpy.newaxis] ^ self.flips).ravel()
+        return queries, numpy.repeat(hashes, len(self.flips))
+
+    def positions(self, queries):
+        '''The position in the rangemap of the range each query belongs to, or
+        -1 if it doesn't belong to any range'''
+        if self.uniform:
+            return (queries >> self.shift).astype(numpy.intp)
+        i = numpy.searchsorted(self.starts, queries, side='right') - 1
+        # Anything before the first range, or past the end of the range whose
+        # start is just before it, isn't covered
+        missing = i < 0
+        missing[~missing] = self.ends[i[~missing]] < queries[~missing]
+        i[missing] = -1
+        return i
+
+    def route(self, queries, rangemap):
+        '''Group the provided queries by the item in the rangemap responsible
+        for them. Returns a dictionary of item -> array of indices into queries.
+        Queries that aren't covered by any range are grouped under None'''
+        self.refresh(rangemap)
+        queries = numpy.asarray(queries, dtype=numpy.uint64)
+        if not len(queries):
+            return {}
+        if not len(self.starts):
+            return {None: numpy.arange(len(queries))}
+
+        positions = self.positions(queries)
+        # Owner indices for each query, with -1 for those that aren't covered
+        owners = numpy.where(positions >= 0, self.owners[positions], -1)
+        # There are only ever a handful of owners, so rather than sorting, we
+        # make one pass per owner that's actually present in this batch
+        present = numpy.flatnonzero(numpy.bincount(owners + 1)) - 1
+
+        results = {}
+        for owner in present.tolist():
+            indices = numpy.flatnonzero(owners == owner)
+            item    = self.items[owner] if owner >= 0 else None
+            if item in results:
+                # Possible when an uncovered query meets a range owned by None
+                indices = numpy.sort(numpy.concatenate((results[item], indices)))
+            results[item] = indices
+        return results
+
+class Fence(object):
+    '''What a slave knows about the routing table clients route with when they
+    send requests straight to it (see smhcluster.client). The master tells it
+    each time the table changes, and from then on, requests routed with an
+    older table are turned away, so the client fetches the new one and tries
+    again'''
+    # Raised for a request that was routed with an out-of-date table
+    class Stale(Exception):
+        def __init__(self, value):
+            Exception.__init__(self, value)
+
+    # The methods that may be called this way, in their packed forms
+    methods = ('find_first', 'find_all', 'insert', 'remove',
+        'find_first_or_insert')
+
+    def __init__(self):
+        # The epoch of the oldest table still good to route with, or None until
+        # the master has told us, before which we turn everything away
+        self.epoch = None
+
+    def advance(self, epoch):
+        '''Turn away requests routed with a table older than epoch. Epochs
+        only ever go forward, whatever order we hear about them in'''
+        self.epoch = max(epoch, self.epoch or 0)
+        return self.epoch
+
+    def check(self, epoch):
+        if self.epoch is None or epoch < self.epoch:
+            raise Fence.Stale('Routed with table %i, but it is now %s' % (
+                epoch, self.epoch))
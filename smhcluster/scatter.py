@@ -0,0 +1,117 @@
+#! /usr/bin/env python
+
+# Scatter-gather over a set of slaves. A bulk request is split up into one batch
+# per slave, and then all of those batches are sent at once, so a request takes
+# as long as the slowest slave involved rather than the sum over all of them.
+
+import time
+
+import gevent
+from gevent.lock import BoundedSemaphore
+
+from . import logger
+from .replication import ReplicaSet
+
+def name(target):
+    '''What to call a target in metrics. Replica sets are made anew whenever
+    their members change, and slaves come and go, so rather than keeping them
+    all around, their latencies are kept under their hostnames'''
+    if isinstance(target, ReplicaSet):
+        return '+'.join(name(slave) for slave in target)
+    return getattr(target, 'hostname', None) or repr(target)
+
+class Scatter(object):
+    # Raised when some (but not necessarily all) of the slaves failed to answer
+    # their batch. It carries both what succeeded and what went wrong, so that
+    # callers can decide whether a partial answer is good enough
+    class PartialFailure(Exception):
+        def __init__(self, failures, results):
+            Exception.__init__(self, '%i slave(s) failed: %s' % (
+                len(failures), ', '.join(repr(e) for e in failures.values())))
+            # A mapping of slave -> exception
+            self.failures = failures
+            # Whatever results we did manage to get
+            self.results  = results
+
+    def __init__(self, max_in_flight=4, metrics=None):
+        # How many requests we're willing to have outstanding to any one slave
+        # at a time. Requests beyond that wait for a slot to open up
+        self.max_in_flight = max_in_flight
+        # A mapping of slave -> semaphore that enforces max_in_flight
+        self.semaphores    = {}
+        # Where to record how long each slave takes, if anywhere
+        self.metrics       = metrics
+
+    def config(self, max_in_flight):
+        # Existing semaphores were made with the old limit, so start fresh.
+        # Requests already in flight hold on to the semaphore they acquired
+        self.max_in_flight = max_in_flight
+        self.semaphores    = {}
+
+    def semaphore(self, target):
+        sem = self.semaphores.get(target)
+        if sem is None:
+            sem = self.semaphores[target] = BoundedSemaphore(self.max_in_flight)
+        return sem
+
+    def call(self, target, method, args):
+        '''Invoke target.method(*args), respecting the in-flight limit'''
+        with self.semaphore(target):
+            if self.metrics is None or not self.metrics.enabled:
+                return getattr(target, method)(*args)
+            start = time.time()
+            result = getattr(target, method)(*args)
+            self.metrics.observe(('rpc', method, name(target)),
+                time.time() - start)
+            return result
+
+    def forget(self, slave):
+        '''Drop the semaphores for a slave that's gone, and for any replica
+        set it was in'''
+        for target in [target for target in self.semaphores
+            if target is slave or (
+                isinstance(target, ReplicaSet) and slave in target)]:
+            del self.semaphores[target]
+
+    def in_flight(self):
+        '''A mapping of target -> how many requests are outstanding to it'''
+        return dict((target, self.max_in_flight - sem.counter)
+            for target, sem in self.semaphores.items())
+
+    def gather(self, batches, method):
+        '''Given a mapping of target -> list of arguments, invoke `method` on
+        each of the targets concurrently. Returns a mapping of target -> result,
+        or raises PartialFailure if any of the targets failed'''
+        return self.gather_calls(dict(
+            (target, (method, args)) for target, args in batches.items()))
+
+    def gather_calls(self, calls):
+        '''Like gather, but with a mapping of target -> (method, arguments), for
+        when not every target should be called the same way'''
+        if len(calls) == 1:
+            # No need to spin up a greenlet for just one slave
+            target, (method, args) = next(iter(calls.items()))
+            try:
+                return {target: self.call(target, method, args)}
+            except Exception as exc:
+                logger.error('%s failed on %s: %s' % (
+                    method, repr(target), repr(exc)))
+                raise Scatter.PartialFailure({target: exc}, {})
+
+        greenlets = dict(
+            (target, gevent.spawn(self.call, target, method, args))
+            for target, (method, args) in calls.items())
+        gevent.joinall(list(greenlets.values()))
+
+        results, failures = {}, {}
+        for target, greenlet in greenlets.items():
+            if greenlet.successful():
+                results[target] = greenlet.value
+            else:
+                logger.error('%s failed on %s: %s' % (
+                    calls[target][0], repr(target), repr(greenlet.exception)))
+                failures[target] = greenlet.exception
+
+        if failures:
+            raise Scatter.PartialFailure(failures, results)
+        return results
@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+
+# A single shard served by a slave. Queries are answered by the slave's index,
+# which covers all of its shards, but each shard also keeps track of what's in
+# it so that it can be snapshotted: the hashes in the most recent snapshot (a
+# sorted, usually memory-mapped, array) and those inserted or removed since.
+
+import numpy
+
+class Shard(object):
+    def __init__(self, start, end, index, base=None):
+        self.start   = start
+        self.end     = end
+        self.index   = index
+        # The hashes from the most recent snapshot
+        if base is None:
+            base = numpy.empty(0, dtype=numpy.uint64)
+        self.base    = base
+        # What's changed since the most recent snapshot
+        self.added   = set()
+        self.removed = set()
+        # The oldest write-ahead log segment holding changes not yet in a
+        # snapshot, if there's a log at all
+        self.since   = None
+        # While this shard is being copied in from another slave, the hashes
+        # removed since the copy began (so that the copy doesn't bring them
+        # back). None when not being copied in
+        self.tombstones = None
+        # How many inserts and removes this shard has been sent
+        self.writes  = 0
+        index.insert(base)
+
+    @property
+    def dirty(self):
+        return bool(self.added or self.removed)
+
+    def __len__(self):
+        return len(self.base) + len(self.added) - len(self.removed)
+
+    def __contains__(self, h):
+        if h in self.added:
+            return True
+        if h in self.removed:
+            return False
+        i = numpy.searchsorted(self.base, numpy.uint64(h))
+        return i < len(self.base) and int(self.base[i]) == h
+
+    def snapshotted(self, hashes):
+        '''Which of an array of hashes are in the most recent snapshot'''
+        if not len(self.base):
+            return numpy.zeros(len(hashes), dtype=bool)
+        i = numpy.searchsorted(self.base, hashes)
+        return self.base[numpy.minimum(i, len(self.base) - 1)] == hashes
+
+    # Inserts and removes are idempotent, so that replaying a write that's
+    # already reflected in a snapshot is harmless. They come in batches, and
+    # since only hashes in the snapshot are ever removed, and only those that
+    # aren't are ever added, one search of the snapshot tells us which of
+    # `added` and `removed` each hash could be in
+    def insert(self, hashes):
+        hashes = numpy.unique(numpy.asarray(hashes, dtype=numpy.uint64))
+        if self.tombstones is not None:
+            self.tombstones.difference_update(hashes.tolist())
+        based = self.snapshotted(hashes)
+        # Those that are back in the snapshot, and those new since then
+        back  = self.removed.intersection(hashes[based].tolist())
+        new   = set(hashes[~based].tolist()) - self.added
+        if back or new:
+            self.index.insert(list(back) + list(new))
+            self.removed -= back
+            self.added   |= new
+
+    def remove(self, hashes):
+        hashes = numpy.unique(numpy.asarray(hashes, dtype=numpy.uint64))
+        if self.tombstones is not None:
+            self.tombstones.update(hashes.tolist())
+        based = self.snapshotted(hashes)
+        # Those gone from the snapshot, and those added since and gone again
+        gone  = set(hashes[based].tolist()) - self.removed
+        taken = self.added.intersection(hashes[~based].tolist())
+        if gone or taken:
+            self.index.remove(list(gone) + list(taken))
+            self.removed |= gone
+            self.added   -= taken
+
+    def receive(self, hashes):
+        '''Insert hashes copied from another slave, except for those that have
+        been removed since the copy began'''
+        hashes = numpy.asarray(hashes, dtype=numpy.uint64)
+        if self.tombstones:
+            hashes = hashes[~numpy.isin(hashes, numpy.fromiter(self.tombstones,
+                dtype=numpy.uint64, count=len(self.tombstones)))]
+        self.insert(hashes)
+
+    def unload(self):
+        '''Take this shard's hashes out of the index'''
+        self.index.remove(self.hashes())
+
+    def hashes(self, added=None, removed=None):
+        '''A sorted array of all the hashes in this shard'''
+        added   = self.added   if added   is None else added
+        removed = self.removed if removed is None else removed
+        hashes  = self.base
+        if removed:
+            hashes = numpy.setdiff1d(hashes,
+                numpy.fromiter(removed, dtype=numpy.uint64, count=len(removed)),
+                assume_unique=True)
+        if added:
+            hashes = numpy.union1d(hashes,
+                numpy.fromiter(added, dtype=numpy.uint64, count=len(added)))
+        return hashes
+
+    def snapshot(self, storage):
+        '''Save this shard to storage. Inserts and removes may keep arriving
+        while the snapshot is being written; they're kept as changes on top of
+        the new snapshot'''
+        added, removed = set(self.added), set(self.removed)
+        storage.save(self.start, self.end, self.hashes(added, removed))
+        # Anything that changed again while we were saving stays in the delta
+        self.added   -= added
+        self.removed -= removed
+        self.base     = storage.load(self.start, self.end)
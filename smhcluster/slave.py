@@ -2,69 +2,439 @@
 
 from . import logger
 from .util import RangeMap, klass
+from .shard import Shard
+from .index import Index
+from .wal import WAL
+from .metrics import Metrics
+from .routing import Router, Fence
+from .clusters import components, Clustering
+from . import packed
+
+import time
+import gevent
+import numpy
 
 class Slave(object):
     def __init__(self, hostname):
         self.hostname = hostname
         self.rangemap = RangeMap()
         self._config  = {}
+        # The near-duplicate index covering every shard we serve
+        self.index    = Index()
+        # Used to group batches of writes by the shard they're for
+        self.router   = Router(0)
+        # Where we keep snapshots of our shards, if anywhere
+        self.storage  = None
+        # The greenlet that periodically snapshots changed shards
+        self.snapshotter = None
+        # Our write-ahead log, if we have one, and the writes we read back from
+        # it at startup as (ops, queries, hashes) to apply to shards as they
+        # load. Each write is applied once, and then forgotten
+        self.wal      = None
+        self.replayed = None
+        # The segment the log was on when we replayed it. Everything replayed
+        # came from before it
+        self.replayed_before = None
+        # Ranges being copied to another slave, mapped to the array of hashes
+        # they had when the copy began
+        self.transfers = {}
+        # Clients for the masters we've registered with, by host
+        self.masters   = {}
+        # Which routing tables clients may still send requests straight to us
+        # with (see `direct`)
+        self.routes    = Fence()
+        # Our clusters of near-duplicates, until the master has fetched them
+        self.clustering = None
+        # Timings and counts of what we've been up to
+        self._metrics  = Metrics()
+        self._metrics.gauge('shards', lambda: dict(
+            (start, len(shard)) for start, end, shard in self.rangemap))
+        self._metrics.gauge('writes', lambda: dict(
+            (start, shard.writes) for start, end, shard in self.rangemap))
+        self._metrics.gauge(('index', 'bytes'), lambda: self.index.nbytes)
+        self._metrics.gauge(('index', 'pending'), lambda: self.index.pending)
+        self._metrics.gauge(('wal', 'unsynced'),
+            lambda: self.wal.unsynced if self.wal else 0)
+        self._metrics.gauge('transfers', lambda: len(self.transfers))
     
     # Send configuration to this node
     def config(self, config):
         logger.info('Recieved configuration %s' % (repr(config)))
         self._config  = config
+        self._metrics.config(config.get('metrics', {}))
+        blocks = config.get('blocks', self.index.blocks)
+        differing_bits = config.get('diff_bits', self.index.differing_bits)
+        compact = config.get('compact', self.index.compact) or None
+        if (blocks, differing_bits, compact) != (
+            self.index.blocks, self.index.differing_bits, self.index.compact):
+            self.reindex(Index(blocks, differing_bits, compact))
+        for name, conf in config.get('storage', {}).items():
+            self.storage = klass(name)(conf)
+            logger.info('Loaded storage %s' % name)
+        if 'wal' in config:
+            # Segments are only let go of once the shards with writes in them
+            # have been snapshotted, so without storage, the log would grow
+            # forever (and be replayed in full on every restart)
+            if not self.storage:
+                raise ValueError('A write-ahead log needs storage')
+            if self.wal:
+                self.wal.config(config['wal'])
+            else:
+                self.wal = WAL(config['wal'], self.hostname)
+                self.replayed = self.wal.replay()
+                self.replayed_before = self.wal.segment
+                logger.info('Replaying %i writes' % len(self.replayed[0]))
+        if self.storage and not self.snapshotter:
+            self.snapshotter = gevent.spawn(self.snapshots)
+    
+    def reindex(self, index):
+        '''Switch to a new index, and fill it with all of our shards'''
+        logger.info('Building index with %i blocks, %i differing bits' % (
+            index.blocks, index.differing_bits))
+        self.index = index
+        for start, end, shard in self.rangemap:
+            shard.index = index
+            index.insert(shard.hashes())
     
     def load(self, start, end):
         '''Load and start serving an interval'''
-        from simhash import Corpus
         logger.info('%s loading range [%i, %i)' % (self.hostname, start, end))
-        self.rangemap.insert(start, end, Corpus(6, 3))
+        base = self.storage.load(start, end) if self.storage else None
+        shard = Shard(start, end, self.index, base)
+        if self.replayed is not None:
+            # Apply any writes from the log that aren't in the snapshot. Since
+            # they're only in the log, we hang on to every segment until this
+            # shard is snapshotted. They're the shard's now, so they mustn't
+            # be applied again should it be loaded again later
+            ops, queries, hashes = self.replayed
+            mask = (queries >= start) & (queries <= end)
+            if mask.any():
+                # Each run of inserts or removes can be applied all at once
+                ops, hashes = ops[mask], hashes[mask]
+                runs = numpy.flatnonzero(numpy.diff(ops)) + 1
+                for op, run in zip(ops[numpy.concatenate(([0], runs))].tolist(),
+                    numpy.split(hashes, runs)):
+                    if op == WAL.INSERT:
+                        shard.insert(run)
+                    else:
+                        shard.remove(run)
+                shard.since = 0
+                self.replayed = tuple(a[~mask] for a in self.replayed)
+        self.serve(start, end, shard)
+    
+    def serve(self, start, end, shard):
+        '''Start serving an interval from this shard'''
+        # Whatever we had for this interval before is no longer in the index
+        previous = self.rangemap.remove(start, end)
+        if previous is not None:
+            previous.unload()
+        self.rangemap.insert(start, end, shard)
     
     def unload(self, start, end):
         '''Stop serving the provided interval'''
         logger.info('%s unloading range [%i, %i)' % (self.hostname, start, end))
-        self.rangemap.remove(start, end)
+        shard = self.rangemap.remove(start, end)
+        if shard is not None:
+            shard.unload()
+        self.transfers.pop(start, None)
+    
+    # Moving a range from one slave to another goes:
+    #
+    #   new.prepare(start, end)           -- the master starts double-writing
+    #   count = old.transfer(start, end)
+    #   new.receive(start, old.stream(start, offset, chunk))   -- repeatedly
+    #   new.finish(start)                 -- the master flips ownership
+    #   old.unload(start, end)
+    def prepare(self, start, end):
+        '''Start serving an empty interval, to be filled in by `receive`'''
+        logger.info('%s receiving range [%i, %i)' % (self.hostname, start, end))
+        shard = Shard(start, end, self.index)
+        shard.tombstones = set()
+        self.serve(start, end, shard)
+    
+    def transfer(self, start, end):
+        '''Take stock of an interval to copy to another slave, and return how
+        many hashes are in it'''
+        end, shard = self.rangemap[start]
+        self.transfers[start] = shard.hashes()
+        return len(self.transfers[start])
+    
+    def stream(self, start, offset, count):
+        '''Return a packed chunk of the hashes in an interval being copied'''
+        hashes = self.transfers[start]
+        if offset + count >= len(hashes):
+            del self.transfers[start]
+        return packed.pack_hashes(hashes[offset:offset + count])
+    
+    def receive(self, start, buf):
+        '''Add a packed chunk of hashes copied from another slave'''
+        end, shard = self.rangemap[start]
+        shard.receive(packed.unpack_hashes(buf))
+    
+    def finish(self, start):
+        '''Finish copying in an interval, and save it'''
+        end, shard = self.rangemap[start]
+        shard.tombstones = None
+        self.save(start, end)
     
     def save(self, start, end):
         '''Save the provided interval to permanent storage'''
-        for name, conf in self._config.get('emitters', {}).items():
-            emitter = klass(name)(conf)
-            logger.info('Loaded emitter %s' % name)
+        end, shard = self.rangemap[start]
+        if self.storage and shard.dirty:
+            # Changes made while saving land in this segment or later ones
+            segment = self.wal.segment if self.wal else None
+            shard.snapshot(self.storage)
+            shard.since = segment if shard.dirty else None
+    
+    def snapshots(self):
+        '''Periodically save each of the shards that have changed. Shards are
+        saved one at a time, in the background, so queries keep being served'''
+        while self.storage:
+            gevent.sleep(self.storage.interval)
+            # Start a new log segment, so that once these shards are saved,
+            # all the segments before it can be discarded
+            segment = self.wal.rotate() if self.wal else None
+            for start, end in [(s, e) for s, e, shard in self.rangemap
+                if shard.dirty]:
+                try:
+                    self.save(start, end)
+                except KeyError:
+                    # This shard was unloaded while we were busy
+                    pass
+                except Exception:
+                    logger.exception('Failed to save [%i, %i]' % (start, end))
+                gevent.sleep(0)
+            if self.wal:
+                oldest = min([segment] + [shard.since
+                    for s, e, shard in self.rangemap if shard.since is not None])
+                self.wal.compact(oldest)
+                if self.replayed is not None and oldest >= self.replayed_before:
+                    # What's left of the replay is for ranges we haven't
+                    # loaded, and the segments it came from are gone anyway
+                    self.replayed = None
     
     def find(self, h):
         '''Find the shard associated with the provided hash'''
-        corpus = self.rangemap.find(h)
-        if not corpus:
-            return None
-        return corpus
+        return self.rangemap.find(h)
+    
+    # Queries are answered from the index covering all of our shards, so the
+    # near-duplicates found for a query may come from any of them
+    def query(self, method, queries):
+        '''Run a batch of queries against the index, and record it'''
+        start = time.time()
+        results = getattr(self.index, method)(queries)
+        if self._metrics.enabled:
+            self._metrics.incr(('requests', method))
+            self._metrics.observe(('batch', method), len(queries))
+            self._metrics.observe(('index', method), time.time() - start)
+        return results
     
     def find_first(self, *hashes):
         '''Find the first near-duplicate of the provided hashes'''
-        return [self.find(h).find_first(h) for h in hashes]
+        return self.query('find_first', hashes).tolist()
     
     def find_all(self, *hashes):
         '''Find all near-duplicates of the provided hashes'''
-        return [self.find(h).find_all(h) for h in hashes]
+        return [r.tolist() for r in self.query('find_all', hashes)]
+    
+    def write(self, op, queries, hashes, buf=None):
+        '''Apply a batch of inserts or removes of each h to the shard for its q,
+        from arrays of queries and hashes, and log them'''
+        start = time.time()
+        queries = numpy.asarray(queries, dtype=numpy.uint64)
+        hashes  = numpy.asarray(hashes , dtype=numpy.uint64)
+        groups  = self.router.route(queries, self.rangemap)
+        if None in groups:
+            raise KeyError('No shard for %i' % queries[groups[None][0]])
+        for shard, indices in groups.items():
+            if op == WAL.INSERT:
+                shard.insert(hashes[indices])
+            else:
+                shard.remove(hashes[indices])
+            shard.writes += len(indices)
+            if self.wal and shard.since is None:
+                shard.since = self.wal.segment
+        applied = time.time()
+        
+        if self.wal:
+            if buf is None:
+                buf = packed.pack_pairs(queries, hashes)
+            self.wal.append(op, buf)
+        
+        if self._metrics.enabled:
+            method = 'insert' if op == WAL.INSERT else 'remove'
+            self._metrics.incr(('requests', method))
+            self._metrics.observe(('batch', method), len(queries))
+            self._metrics.observe(('apply', method), applied - start)
+            self._metrics.observe(('wal', method), time.time() - applied)
+    
+    def claim(self, queries, hashes):
+        '''For each q and h, find the first near-duplicate of h in the shard
+        for q, or insert h there if there isn't one. Returns an array of the
+        near-duplicates found, with 0 where h was inserted. Nothing yields while
+        we check and insert, so no other write to these shards can get between
+        the two'''
+        start = time.time()
+        shards  = [self.find(q) for q in queries.tolist()]
+        results = numpy.zeros(len(hashes), dtype=numpy.uint64)
+        fresh   = []
+        # The index covers all of our shards, but only matches in the shard for
+        # q count, so that every slave holding a variant of h makes the same
+        # call about whether to insert it
+        for i, (shard, found) in enumerate(
+            zip(shards, self.index.find_all(hashes))):
+            found = [m for m in found.tolist() if m in shard]
+            if found:
+                results[i] = min(found)
+            else:
+                fresh.append(i)
+        
+        # Hashes in this batch may be near-duplicates of each other, in which
+        # case only the first of them is inserted
+        inserted, claimed = [], {}
+        if fresh:
+            fresh = numpy.array(fresh, dtype=numpy.intp)
+            batch = Index(self.index.blocks, self.index.differing_bits)
+            batch.insert(numpy.unique(hashes[fresh]))
+            for i, found in zip(fresh.tolist(), batch.find_all(hashes[fresh])):
+                mine = claimed.setdefault(id(shards[i]), set())
+                found = [m for m in found.tolist() if m in mine]
+                if found:
+                    results[i] = min(found)
+                else:
+                    mine.add(int(hashes[i]))
+                    inserted.append(i)
+        checked = time.time()
+        
+        if inserted:
+            self.write(WAL.INSERT, queries[inserted], hashes[inserted])
+        if self._metrics.enabled:
+            self._metrics.incr(('requests', 'find_first_or_insert'))
+            self._metrics.observe(('batch', 'find_first_or_insert'),
+                len(hashes))
+            self._metrics.observe(('index', 'find_first_or_insert'),
+                checked - start)
+        return results
+    
+    def find_first_or_insert(self, *pairs):
+        '''For each (q, h), the first near-duplicate of h in the shard for q,
+        or 0 if there wasn't one and h has been inserted'''
+        pairs = numpy.array(pairs, dtype=numpy.uint64).reshape(-1, 2)
+        return self.claim(pairs[:, 0], pairs[:, 1]).tolist()
     
     def insert(self, *insertions):
         '''Insert h in to the shard for q'''
-        for q, h in insertions:
-            self.find(q).insert(h)
+        pairs = numpy.array(insertions, dtype=numpy.uint64).reshape(-1, 2)
+        self.write(WAL.INSERT, pairs[:, 0], pairs[:, 1])
     
     def remove(self, *removals):
         '''Remove h from the shard for q'''
-        for q, h in removals:
-            return self.find(q).remove(h)
+        pairs = numpy.array(removals, dtype=numpy.uint64).reshape(-1, 2)
+        self.write(WAL.REMOVE, pairs[:, 0], pairs[:, 1])
     
-    def register(self, host):
+    def capabilities(self):
+        '''The wire formats this slave understands beyond lists of ints, and
+        other things it supports (transferring ranges, reporting resources and
+        metrics)'''
+        return [packed.PACKED, 'transfer', 'resources', 'metrics', 'direct',
+            'cluster']
+    
+    def metrics(self):
+        '''Timings and counts of what we've been up to'''
+        return self._metrics.snapshot()
+    
+    def resources(self):
+        '''What this slave has to offer, as memory in GB and cores. These can be
+        overridden in the configuration, under `resources`'''
+        import os
+        import multiprocessing
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        resources = {
+            'memory': memory / float(1 << 30),
+            'cores' : multiprocessing.cpu_count()
+        }
+        resources.update(self._config.get('resources', {}))
+        return resources
+    
+    def find_first_packed(self, buf):
+        '''Packed form of find_first'''
+        return packed.pack_hashes(
+            self.query('find_first', packed.unpack_hashes(buf)))
+    
+    def find_all_packed(self, buf):
+        '''Packed form of find_all'''
+        return packed.pack_sets(
+            self.query('find_all', packed.unpack_hashes(buf)))
+    
+    def insert_packed(self, buf):
+        '''Packed form of insert, accepting a buffer of (q, h) pairs'''
+        self.write(WAL.INSERT, *packed.unpack_pairs(buf), buf=buf)
+    
+    def remove_packed(self, buf):
+        '''Packed form of remove, accepting a buffer of (q, h) pairs'''
+        self.write(WAL.REMOVE, *packed.unpack_pairs(buf), buf=buf)
+    
+    def find_first_or_insert_packed(self, buf):
+        '''Packed form of find_first_or_insert, accepting a buffer of (q, h)
+        pairs'''
+        return packed.pack_hashes(self.claim(*packed.unpack_pairs(buf)))
+    
+    # Clients that route for themselves (see smhcluster.client) send their
+    # requests straight to us, along with the epoch of the routing table they
+    # routed them with. The master fences us each time the table changes, and
+    # requests routed with an older one are turned away with Fence.Stale
+    def fence(self, epoch):
+        '''Turn away requests routed with a table older than epoch'''
+        return self.routes.advance(epoch)
+    
+    def direct(self, epoch, method, buf):
+        '''One of the packed methods, called by a client whose routing table
+        is from epoch'''
+        self.routes.check(epoch)
+        if method not in Fence.methods:
+            raise ValueError('Cannot call %s directly' % method)
+        return getattr(self, method + '_packed')(buf)
+    
+    # Finding clusters of near-duplicates over the whole corpus (see
+    # smhcluster.clusters) goes:
+    #
+    #   count = slave.cluster()
+    #   slave.clustered(offset, chunk)   -- repeatedly
+    def cluster(self):
+        '''Find every pair of near-duplicates among our shards, and group them
+        into clusters. Returns how many hashes are in one'''
+        start = time.time()
+        lefts, rights = self.index.pairs()
+        joined = time.time()
+        self.clustering = Clustering(*components(lefts, rights))
+        if self._metrics.enabled:
+            self._metrics.incr(('requests', 'cluster'))
+            self._metrics.observe(('index', 'pairs'), joined - start)
+            self._metrics.observe(('cluster', 'pairs'), len(lefts))
+            self._metrics.observe(('cluster', 'components'),
+                time.time() - joined)
+        return len(self.clustering)
+    
+    def clustered(self, offset, count):
+        '''A packed chunk of the (hash, cluster) pairs found by `cluster`'''
+        clustering = self.clustering
+        if offset + count >= len(clustering):
+            self.clustering = None
+        return clustering.chunk(offset, count)
+    
+    def master(self, host):
+        '''Our client for the master at host, made the first time we need it'''
         import zerorpc
-        c = zerorpc.Client('tcp://%s' % host)
+        client = self.masters.get(host)
+        if client is None:
+            client = self.masters[host] = zerorpc.Client('tcp://%s' % host)
+        return client
+    
+    def register(self, host):
         logger.info('Registering...')
-        logger.info('Registered: %s' % repr(c.register(self.hostname)))
-        c.close()
+        logger.info('Registered: %s' % repr(
+            self.master(host).register(self.hostname)))
     
     def deregister(self, host):
-        import zerorpc
-        c = zerorpc.Client('tcp://%s' % host)
-        c.deregister(self.hostname)
-        c.close()
+        self.master(host).deregister(self.hostname)
+        self.masters.pop(host).close()
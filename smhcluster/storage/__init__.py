@@ -0,0 +1,28 @@
+# All storage backends must implement the Storage interface. Slaves use storage
+# to keep snapshots of the shards they serve, so that a restarted slave (or one
+# that picks up a shard someone else was serving) doesn't start from scratch.
+# Snapshots are sorted arrays of the hashes in a shard.
+
+class Storage(object):
+    # Raised when a snapshot exists, but can't be trusted
+    class Corrupt(Exception):
+        def __init__(self, value):
+            Exception.__init__(self, value)
+    
+    # Accepts the configuration for this backend, raising exceptions when
+    # malconfigured
+    def __init__(self, config):
+        self.config = config
+    
+    # Save a sorted array of hashes as the snapshot of [start, end]
+    def save(self, start, end, hashes):
+        pass
+    
+    # Return the most recent snapshot of [start, end] as a sorted array of
+    # hashes, or None if there isn't one
+    def load(self, start, end):
+        pass
+    
+    # Discard the snapshot of [start, end]
+    def delete(self, start, end):
+        pass
@@ -0,0 +1,102 @@
+# Keeps shard snapshots as files on local disk. Each snapshot is a small header
+# followed by the shard's hashes as sorted little-endian uint64s:
+#
+#   magic (8 bytes) | start | end | count | crc32 of the hashes | hashes ...
+#
+# Snapshots are memory-mapped when loaded, so loading is cheap and the pages are
+# shared through the OS page cache rather than copied into each process.
+
+import os
+import zlib
+import struct
+
+import gevent
+import numpy
+
+from .. import logger
+from . import Storage
+
+class Disk(Storage):
+    magic  = b'SMHSNAP1'
+    header = struct.Struct('<8sQQQQ')
+    dtype  = numpy.dtype('<u8')
+    # How many hashes to write (or checksum) before yielding to other greenlets
+    chunk  = 1 << 20
+    
+    def __init__(self, config):
+        for key in config.keys():
+            if key not in ('path', 'interval', 'verify'):
+                raise KeyError('Unknown configuration option %s' % key)
+        
+        # The path may either be a directory, or a pattern like /path/*.snap in
+        # which the '*' is replaced with the name of each shard
+        self.path     = config['path']
+        # How often (in seconds) slaves should snapshot changed shards
+        self.interval = config.get('interval', 60)
+        # Whether to check checksums when loading
+        self.verify   = config.get('verify', True)
+    
+    def filename(self, start, end):
+        name = '%016x-%016x' % (start, end)
+        if '*' in self.path:
+            return self.path.replace('*', name)
+        return os.path.join(self.path, name + '.snap')
+    
+    def save(self, start, end, hashes):
+        path = self.filename(start, end)
+        data = numpy.ascontiguousarray(hashes, dtype=self.dtype)
+        # Write to a temporary file and then move it into place, so there's
+        # always a complete snapshot on disk
+        crc  = 0
+        with open(path + '.tmp', 'wb') as f:
+            f.write(b'\0' * self.header.size)
+            for i in range(0, len(data), self.chunk):
+                chunk = data[i:i + self.chunk]
+                crc = zlib.crc32(chunk, crc)
+                f.write(chunk.tobytes())
+                gevent.sleep(0)
+            f.seek(0)
+            f.write(self.header.pack(
+                self.magic, start, end, len(data), crc & 0xffffffff))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+        logger.info('Saved %i hashes to %s' % (len(data), path))
+    
+    def load(self, start, end):
+        path = self.filename(start, end)
+        if not os.path.exists(path):
+            return None
+        
+        with open(path, 'rb') as f:
+            header = f.read(self.header.size)
+        if len(header) != self.header.size:
+            raise Storage.Corrupt('%s has a truncated header' % path)
+        magic, s, e, count, crc = self.header.unpack(header)
+        if magic != self.magic:
+            raise Storage.Corrupt('%s is not a snapshot' % path)
+        if (s, e) != (start, end):
+            raise Storage.Corrupt('%s is for [%i, %i]' % (path, s, e))
+        if os.path.getsize(path) != self.header.size + count * 8:
+            raise Storage.Corrupt('%s is truncated' % path)
+        
+        if not count:
+            return numpy.empty(0, dtype=self.dtype)
+        data = numpy.memmap(path, dtype=self.dtype, mode='r',
+            offset=self.header.size, shape=(count,))
+        
+        if self.verify:
+            actual = 0
+            for i in range(0, count, self.chunk):
+                actual = zlib.crc32(data[i:i + self.chunk], actual)
+                gevent.sleep(0)
+            if (actual & 0xffffffff) != crc:
+                raise Storage.Corrupt('%s fails its checksum' % path)
+        
+        logger.info('Loaded %i hashes from %s' % (count, path))
+        return data
+    
+    def delete(self, start, end):
+        path = self.filename(start, end)
+        if os.path.exists(path):
+            os.remove(path)
@@ -11,69 +11,177 @@ def klass(s):
 import bisect
 
 # A map of a set of ranges to items. It assumes that no two ranges overlap, but
-# it does not enforce that constraint. This class isn't optimized for fast 
-# insertions or deletions -- for the time being, it's standing in for an 
-# interface, which may be improved upon in the future
+# it does not enforce that constraint. Ranges are kept in parallel arrays of
+# starts, ends and owners sorted by start, so lookups, insertions and deletions
+# are a bisect away. Each distinct item is stored once in an owner table, and we
+# keep a reverse index of item -> starts so that asking for all the ranges that
+# belong to a particular item doesn't require a scan of the whole map.
 class RangeMap(object):
     class RangeMatchException(Exception):
         def __init__(self, val):
             Exception.__init__(self, val)
     
     def __init__(self):
-        # These are the starts of each of the ranges this holds
+        # These are the starts and ends of each of the ranges this holds, along
+        # with the index of the owner (in self.items) of that range
         self.starts = []
-        # A map from the start range to a tuple (end, item), which corresponds 
-        # to the start of the range
-        self.items  = {}
+        self.ends   = []
+        self.owners = []
+        # The owner table, and a mapping of item -> its index in that table
+        self.items  = []
+        self.index  = {}
+        # A mapping of owner index -> set of starts of the ranges it owns
+        self.ranges = {}
+        # Slots in the owner table that no longer own anything
+        self.free   = []
+        # Bumped on every change, so that anyone caching a view of this map
+        # knows when to refresh it
+        self.version = 0
     
     def __len__(self):
         return len(self.starts)
     
+    # Iterate over (start, end, item), without making a copy of the map. The map
+    # should not be modified while iterating
     def __iter__(self):
-        results = []
-        for start in self.starts:
-            end, item = self.items[start]
-            results.append((start, end, item))
-        return iter(results)
+        starts, ends, owners, items = (
+            self.starts, self.ends, self.owners, self.items)
+        for i in range(len(starts)):
+            yield starts[i], ends[i], items[owners[i]]
+    
+    def _owner(self, item):
+        # Get the owner index for this item, allocating one if needed
+        o = self.index.get(item)
+        if o is None:
+            if self.free:
+                o = self.free.pop()
+                self.items[o] = item
+            else:
+                o = len(self.items)
+                self.items.append(item)
+            self.index[item] = o
+            self.ranges[o]   = set()
+        return o
+    
+    def _release(self, o, start):
+        # This owner no longer owns the range that starts at `start`
+        starts = self.ranges[o]
+        starts.discard(start)
+        if not starts:
+            del self.ranges[o]
+            del self.index[self.items[o]]
+            self.items[o] = None
+            self.free.append(o)
+    
+    def _position(self, start):
+        # The position of the range with this start, or None if there isn't one
+        i = bisect.bisect_left(self.starts, start)
+        if i < len(self.starts) and self.starts[i] == start:
+            return i
+        return None
     
     # Find the item responsible for this range, remove and return it
     def remove(self, start, end):
-        if start in self.items:
-            oend, item   = self.items.pop(start)
-            if oend == end:
-                self.starts = [i for i in self.starts if i != start]
-                return item
-            self.items[start] = (oend, item)
-            raise RangeMap.RangeMatchException('%i != %i' % (oend, end))
-        return None
+        i = self._position(start)
+        if i is None:
+            return None
+        if self.ends[i] != end:
+            raise RangeMap.RangeMatchException('%i != %i' % (self.ends[i], end))
+        o = self.owners[i]
+        item = self.items[o]
+        del self.starts[i], self.ends[i], self.owners[i]
+        self.version += 1
+        self._release(o, start)
+        return item
     
     # Insert a new item that is responsible for the provided range
     def insert(self, start, end, item):
-        if start not in self.items:
-            self.starts.append(start)
-            self.starts.sort()
-        self.items[start] = (end, item)
+        self.version += 1
+        o = self._owner(item)
+        i = self._position(start)
+        if i is None:
+            i = bisect.bisect_left(self.starts, start)
+            self.starts.insert(i, start)
+            self.ends.insert(i, end)
+            self.owners.insert(i, o)
+        else:
+            if self.owners[i] != o:
+                self._release(self.owners[i], start)
+            self.ends[i]   = end
+            self.owners[i] = o
+        self.ranges[o].add(start)
+    
+    # Make `item` responsible for each of the (start, end) ranges provided. Ranges
+    # that already exist just change hands; new ones are merged in all at once
+    def assign_many(self, ranges, item):
+        ranges = list(ranges)
+        if not ranges:
+            # Nothing would ever release an owner allocated for nothing
+            return
+        self.version += 1
+        o = self._owner(item)
+        new = []
+        for start, end in ranges:
+            i = self._position(start)
+            if i is None:
+                new.append((start, end))
+                continue
+            if self.owners[i] != o:
+                self._release(self.owners[i], start)
+            self.ends[i]   = end
+            self.owners[i] = o
+            self.ranges[o].add(start)
+        
+        if len(new) < 16:
+            for start, end in new:
+                self.insert(start, end, item)
+        elif new:
+            merged = sorted(
+                list(zip(self.starts, self.ends, self.owners)) +
+                [(s, e, o) for s, e in new])
+            self.starts = [s for s, e, w in merged]
+            self.ends   = [e for s, e, w in merged]
+            self.owners = [w for s, e, w in merged]
+            self.ranges[o].update(s for s, e in new)
     
     # Get the item responsible for the provided range. If no suitable item can 
     # be found, then it returns None
     def find(self, index):
-        # If we don't have any items, then we're SOL
-        i = bisect.bisect(self.starts, index)
-        if (i == 0) or (i > len(self.starts)):
+        i = bisect.bisect_right(self.starts, index)
+        # If it's before our first range, or past the end of the range whose
+        # start is just before it, then we don't have one
+        if i == 0 or self.ends[i-1] < index:
             return None
-        
-        start = self.starts[i-1]
-        # If the start we found is still greater than index, we don't have one
-        if start > index:
-            return None
-        
-        end, item = self.items[start]
-        # If it's outside of its range, then we've got a problem
-        if end < index:
-            return None
-        
-        return item
+        return self.items[self.owners[i-1]]
+    
+    # Bulk form of find
+    def owners_of(self, indices):
+        starts, ends, owners, items = (
+            self.starts, self.ends, self.owners, self.items)
+        right = bisect.bisect_right
+        results = []
+        for index in indices:
+            i = right(starts, index)
+            if i == 0 or ends[i-1] < index:
+                results.append(None)
+            else:
+                results.append(items[owners[i-1]])
+        return results
+    
+    # All the (start, end) ranges that belong to this item, in order
+    def ranges_of(self, item):
+        o = self.index.get(item)
+        if o is None:
+            return []
+        return [(s, self.ends[self._position(s)]) for s in sorted(self.ranges[o])]
+    
+    # The number of ranges each item is responsible for
+    def counts(self):
+        return dict((self.items[o], len(s)) for o, s in self.ranges.items())
     
     # Index is based off of the start range
     def __getitem__(self, index):
-        return self.items[index]
+        i = self._position(index)
+        if i is None:
+            raise KeyError(index)
+        return self.ends[i], self.items[self.owners[i]]
@@ -0,0 +1,166 @@
+#! /usr/bin/env python
+
+# A write-ahead log of the inserts and removes a slave has acknowledged, so that
+# they survive a crash between snapshots. Each batch is appended as one record:
+#
+#   length of pairs (uint32) | crc32 (uint32) | op (uint8) | packed (q, h) pairs
+#
+# Rather than syncing each record on its own, records are group-committed: one
+# fsync covers everything appended in the last `window` milliseconds (or since
+# `budget` bytes were appended, whichever comes first), and callers waiting for
+# durability are released together. The log is split into segments, which are
+# discarded once snapshots cover everything in them.
+
+import os
+import re
+import zlib
+import struct
+
+import gevent
+import numpy
+from gevent.event import Event
+from gevent.lock import RLock
+
+from . import logger
+from . import packed
+
+class WAL(object):
+    INSERT = 1
+    REMOVE = 2
+
+    header = struct.Struct('<IIB')
+
+    def __init__(self, config, name='wal'):
+        # The directory in which to keep segments
+        self.path   = config['path']
+        self.config(config)
+        # Segments are named after whoever owns this log
+        self.name   = re.sub(r'[^\w.-]', '_', name)
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        segments = self.segments()
+        self.segment = (segments[-1] + 1) if segments else 0
+        self.file    = open(self.filename(self.segment), 'ab')
+        # Bytes appended since the last commit
+        self.unsynced  = 0
+        # Set when a commit covering the records appended so far has finished
+        self.committed = Event()
+        # Set to have the committer commit right away
+        self.wakeup    = Event()
+        # Held while committing or rotating, since both yield mid-way
+        self.lock      = RLock()
+        self.committer = gevent.spawn(self.commits)
+
+    # Idempotently accept new configurations. Everything but the path can be
+    # changed on the fly
+    def config(self, config):
+        for key in config.keys():
+            if key not in ('path', 'window', 'budget', 'sync'):
+                raise KeyError('Unknown configuration option %s' % key)
+
+        # How long (in milliseconds) to wait to gather records into one commit
+        self.window = config.get('window', 10)
+        # How many bytes may be appended before committing regardless
+        self.budget = config.get('budget', 1 << 20)
+        # Whether appends wait until they're durable before returning. Without
+        # this, a crash may lose up to `window` milliseconds of writes
+        self.sync   = config.get('sync', True)
+
+    def filename(self, segment):
+        return os.path.join(self.path, '%s-%012i.wal' % (self.name, segment))
+
+    def segments(self):
+        '''The numbers of the segments on disk, in order'''
+        pattern = re.compile(r'^%s-(\d{12})\.wal$' % re.escape(self.name))
+        matches = (pattern.match(f) for f in os.listdir(self.path))
+        return sorted(int(m.group(1)) for m in matches if m)
+
+    def append(self, op, buf):
+        '''Append a packed buffer of (q, h) pairs. If configured for sync, this
+        returns once the record is durable'''
+        self.file.write(self.header.pack(
+            len(buf), zlib.crc32(buf, op) & 0xffffffff, op))
+        self.file.write(buf)
+        self.unsynced += self.header.size + len(buf)
+        committed = self.committed
+        if self.unsynced >= self.budget:
+            self.wakeup.set()
+        if self.sync:
+            committed.wait()
+
+    def commits(self):
+        '''Commit everything appended, every `window` milliseconds'''
+        while True:
+            self.wakeup.wait(self.window / 1000.0)
+            self.wakeup.clear()
+            if self.unsynced:
+                self.commit()
+
+    def commit(self, f=None):
+        with self.lock:
+            f = f or self.file
+            # Anything appended from here on waits for the next commit
+            committed, self.committed = self.committed, Event()
+            self.unsynced = 0
+            f.flush()
+            # fsync blocks, so do it off the hub so other greenlets can run
+            gevent.get_hub().threadpool.apply(os.fsync, (f.fileno(),))
+            committed.set()
+
+    def rotate(self):
+        '''Commit the current segment and start a new one, returning its
+        number. Everything appended before this is in earlier segments'''
+        with self.lock:
+            # Switch files before committing the old one, so that anything
+            # appended in the meantime goes to (and waits on) the new one
+            old = self.file
+            self.segment += 1
+            self.file = open(self.filename(self.segment), 'ab')
+            self.commit(old)
+            old.close()
+            return self.segment
+
+    def compact(self, segment):
+        '''Discard all the segments before this one'''
+        for s in self.segments():
+            if s < segment:
+                logger.info('Discarding %s' % self.filename(s))
+                os.remove(self.filename(s))
+
+    def replay(self):
+        '''Read back all the records in the log. Returns a tuple of arrays
+        (ops, queries, hashes), in the order they were appended'''
+        ops, queries, hashes = [], [], []
+        for segment in self.segments():
+            if segment == self.segment:
+                continue
+            with open(self.filename(segment), 'rb') as f:
+                data = f.read()
+            offset = 0
+            while offset + self.header.size <= len(data):
+                length, crc, op = self.header.unpack_from(data, offset)
+                start = offset + self.header.size
+                buf = data[start:start + length]
+                if len(buf) != length or (
+                    zlib.crc32(buf, op) & 0xffffffff) != crc:
+                    # A torn write from a crash. Nothing after it was acked
+                    logger.warning('Ignoring torn record in %s at %i' % (
+                        self.filename(segment), offset))
+                    break
+                q, h = packed.unpack_pairs(buf)
+                ops.append(numpy.repeat(numpy.uint8(op), len(q)))
+                queries.append(q)
+                hashes.append(h)
+                offset = start + length
+
+        if not ops:
+            empty = numpy.empty(0, dtype=numpy.uint64)
+            return numpy.empty(0, dtype=numpy.uint8), empty, empty
+        return (numpy.concatenate(ops), numpy.concatenate(queries),
+            numpy.concatenate(hashes))
+
+    def close(self):
+        self.committer.kill()
+        self.commit()
+        self.file.close()
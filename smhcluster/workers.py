@@ -0,0 +1,383 @@
+#! /usr/bin/env python
+
+# A slave that spreads its shards over a pool of worker processes, so that it
+# can make use of every core rather than just one. The front process looks just
+# like a slave to the master. It hands each range it's asked to serve to one of
+# the workers (whichever has the fewest), and splits each batch of queries and
+# writes up by range, sending each worker its part over a local zerorpc socket.
+#
+# Each worker is an ordinary Slave in its own process, with its own index over
+# just its own shards. If one dies, it's started again and told to load all of
+# the ranges it had, from storage and its write-ahead log.
+
+import os
+import re
+import sys
+import tempfile
+import multiprocessing
+
+import numpy
+import gevent
+from gevent import subprocess
+from gevent.event import Event
+
+from . import logger
+from . import packed
+from .util import RangeMap
+from .routing import Router, Fence
+from .scatter import Scatter
+from .metrics import Metrics
+from .clusters import components, Clustering, Job
+
+class Worker(object):
+    # Raised for calls to a worker that's (re)starting
+    class Unavailable(Exception):
+        def __init__(self, value):
+            Exception.__init__(self, value)
+
+    def __init__(self, number, hostname):
+        self.number   = number
+        # Each worker keeps its own log, named after it
+        self.hostname = '%s-%i' % (hostname, number)
+        self.address  = 'ipc://%s' % os.path.join(tempfile.gettempdir(),
+            'simhash-%s.sock' % re.sub(r'[^\w.-]', '_', self.hostname))
+        self.process  = None
+        self.client   = None
+        # Set while the worker is up and serving all of its ranges
+        self.up       = Event()
+        self.restarts = 0
+
+    def __repr__(self):
+        return 'worker-%i' % self.number
+
+    @property
+    def ready(self):
+        return self.up.is_set()
+
+    def __getattr__(self, method):
+        # Everything else is a call to the worker's slave
+        if not self.ready:
+            raise Worker.Unavailable('%s is not running' % repr(self))
+        return getattr(self.client, method)
+
+    def start(self):
+        import zerorpc
+        self.up.clear()
+        if self.client is not None:
+            self.client.close()
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__)))] +
+            [p for p in [env.get('PYTHONPATH')] if p])
+        self.process = subprocess.Popen([sys.executable, '-m',
+            'smhcluster.workers', self.address, self.hostname], env=env)
+        self.client  = zerorpc.Client(self.address)
+
+    def stop(self):
+        self.up.clear()
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+class Front(object):
+    # How many requests may be outstanding to a single worker at once
+    max_in_flight = 4
+    # How long to wait (in seconds) before restarting a worker that died
+    backoff       = 1
+
+    def __init__(self, hostname, workers=None):
+        self.hostname = hostname
+        self._config  = {}
+        # A mapping of range -> the worker serving it
+        self.rangemap = RangeMap()
+        self.router   = Router(0)
+        self._metrics = Metrics()
+        self.scatter  = Scatter(self.max_in_flight, self._metrics)
+        self.workers  = [Worker(i, hostname)
+            for i in range(workers or multiprocessing.cpu_count())]
+        self.running  = True
+        # Clients for the masters we've registered with, by host
+        self.masters  = {}
+        # Which routing tables clients may still send requests straight to us
+        # with. The workers are never sent requests directly
+        self.routes   = Fence()
+        # Our clusters of near-duplicates, until the master has fetched them
+        self.clustering = None
+        self.supervisors = [gevent.spawn(self.supervise, worker)
+            for worker in self.workers]
+        self._metrics.gauge('shards', lambda: self.rangemap.counts())
+        self._metrics.gauge('restarts', lambda: dict(
+            (w, w.restarts) for w in self.workers))
+        self._metrics.gauge('in_flight', self.scatter.in_flight)
+
+    def supervise(self, worker):
+        '''Run a worker, and whenever it exits, start it again with the same
+        configuration and ranges'''
+        while self.running:
+            worker.start()
+            try:
+                self.restore(worker)
+            except Exception:
+                logger.exception('Failed to start %s' % repr(worker))
+                worker.process.kill()
+            worker.process.wait()
+            worker.up.clear()
+            if not self.running:
+                break
+            worker.restarts += 1
+            logger.error('%s exited with %s; restarting' % (
+                repr(worker), worker.process.returncode))
+            gevent.sleep(self.backoff)
+
+    def restore(self, worker):
+        '''Give a freshly started worker our configuration, and have it load
+        all of its ranges'''
+        worker.client.config(self._config)
+        loaded = set()
+        # Ranges may be handed to this worker while it's loading the others
+        while True:
+            ranges = set(self.rangemap.ranges_of(worker)) - loaded
+            if not ranges:
+                break
+            for start, end in sorted(ranges):
+                worker.client.load(start, end)
+                loaded.add((start, end))
+        worker.up.set()
+        logger.info('%s serving %i ranges' % (repr(worker), len(loaded)))
+
+    def wait(self, timeout=None):
+        '''Wait for every worker to be up'''
+        for worker in self.workers:
+            worker.up.wait(timeout)
+        return all(worker.ready for worker in self.workers)
+
+    def stop(self):
+        self.running = False
+        for worker in self.workers:
+            worker.stop()
+        gevent.killall(self.supervisors)
+
+    def owner(self, start):
+        '''The worker serving the range starting at start'''
+        end, worker = self.rangemap[start]
+        return worker
+
+    def assign(self, start, end):
+        '''The worker to serve a range, giving new ranges to whichever worker
+        has the fewest'''
+        worker = self.rangemap.find(start)
+        if worker is None:
+            counts = self.rangemap.counts()
+            worker = min(self.workers, key=lambda w: counts.get(w, 0))
+            self.rangemap.insert(start, end, worker)
+        return worker
+
+    def route(self, queries):
+        '''Group an array of queries by the worker responsible for each.
+        Queries that no worker is responsible for are grouped under None'''
+        return self.router.route(queries, self.rangemap)
+
+    # Send configuration to every worker
+    def config(self, config):
+        logger.info('Recieved configuration %s' % (repr(config)))
+        self._config = config
+        self._metrics.config(config.get('metrics', {}))
+        self.scatter.gather_calls(dict((w, ('config', (config,)))
+            for w in self.workers if w.ready))
+
+    # Loading, unloading and moving ranges go to the worker that serves them
+    def load(self, start, end):
+        worker = self.assign(start, end)
+        try:
+            worker.load(start, end)
+        except Worker.Unavailable:
+            # It'll load it when it starts
+            pass
+
+    def unload(self, start, end):
+        worker = self.rangemap.remove(start, end)
+        if worker is not None and worker.ready:
+            worker.unload(start, end)
+
+    def prepare(self, start, end):
+        self.assign(start, end).prepare(start, end)
+
+    def transfer(self, start, end):
+        return self.owner(start).transfer(start, end)
+
+    def stream(self, start, offset, count):
+        return self.owner(start).stream(start, offset, count)
+
+    def receive(self, start, buf):
+        return self.owner(start).receive(start, buf)
+
+    def finish(self, start):
+        return self.owner(start).finish(start)
+
+    def save(self, start, end):
+        return self.owner(start).save(start, end)
+
+    # Queries go to the worker serving the range they fall in, and queries in
+    # ranges we don't serve find nothing
+    def find_first_packed(self, buf):
+        queries = packed.unpack_hashes(buf)
+        destinations = self.route(queries)
+        destinations.pop(None, None)
+        responses = self.scatter.gather_calls(dict((w, ('find_first_packed',
+            (packed.pack_hashes(queries[i]),)))
+            for w, i in destinations.items()))
+        results = numpy.zeros(len(queries), dtype=packed.DTYPE)
+        for worker, response in responses.items():
+            results[destinations[worker]] = packed.unpack_hashes(response)
+        return packed.pack_hashes(results)
+
+    def find_all_packed(self, buf):
+        queries = packed.unpack_hashes(buf)
+        destinations = self.route(queries)
+        destinations.pop(None, None)
+        responses = self.scatter.gather_calls(dict((w, ('find_all_packed',
+            (packed.pack_hashes(queries[i]),)))
+            for w, i in destinations.items()))
+        results = [()] * len(queries)
+        for worker, response in responses.items():
+            for i, result in zip(destinations[worker].tolist(),
+                packed.unpack_sets(response)):
+                results[i] = result
+        return packed.pack_sets(results)
+
+    def find_first(self, *hashes):
+        return packed.unpack_hashes(
+            self.find_first_packed(packed.pack_hashes(hashes))).tolist()
+
+    def find_all(self, *hashes):
+        return [r.tolist() for r in packed.unpack_sets(
+            self.find_all_packed(packed.pack_hashes(hashes)))]
+
+    # Writes of (q, h) go to the worker serving the range q falls in
+    def write(self, method, queries, hashes):
+        destinations = self.route(queries)
+        if None in destinations:
+            raise KeyError('No range for %i' % queries[destinations[None][0]])
+        responses = self.scatter.gather_calls(dict((w, (method,
+            (packed.pack_pairs(queries[i], hashes[i]),)))
+            for w, i in destinations.items()))
+        return destinations, responses
+
+    def insert_packed(self, buf):
+        self.write('insert_packed', *packed.unpack_pairs(buf))
+
+    def remove_packed(self, buf):
+        self.write('remove_packed', *packed.unpack_pairs(buf))
+
+    def find_first_or_insert_packed(self, buf):
+        queries, hashes = packed.unpack_pairs(buf)
+        destinations, responses = self.write(
+            'find_first_or_insert_packed', queries, hashes)
+        results = numpy.zeros(len(queries), dtype=packed.DTYPE)
+        for worker, response in responses.items():
+            results[destinations[worker]] = packed.unpack_hashes(response)
+        return packed.pack_hashes(results)
+
+    def pairs(self, pairs):
+        pairs = numpy.array(pairs, dtype=packed.DTYPE).reshape(-1, 2)
+        return packed.pack_pairs(pairs[:, 0], pairs[:, 1])
+
+    def insert(self, *insertions):
+        self.insert_packed(self.pairs(insertions))
+
+    def remove(self, *removals):
+        self.remove_packed(self.pairs(removals))
+
+    def find_first_or_insert(self, *pairs):
+        return packed.unpack_hashes(
+            self.find_first_or_insert_packed(self.pairs(pairs))).tolist()
+
+    # Requests sent straight to us by clients that route for themselves are
+    # checked here, and then split up between the workers like any other
+    def fence(self, epoch):
+        return self.routes.advance(epoch)
+
+    def direct(self, epoch, method, buf):
+        self.routes.check(epoch)
+        if method not in Fence.methods:
+            raise ValueError('Cannot call %s directly' % method)
+        return getattr(self, method + '_packed')(buf)
+
+    # Each worker finds the clusters among its own shards, which we then put
+    # together, since a hash may be held by more than one of them
+    def cluster(self):
+        counts = dict((worker, gevent.spawn(worker.cluster,
+            timeout=Job.timeout)) for worker in self.workers)
+        gevent.joinall(list(counts.values()), raise_error=True)
+        hashes, clusters = [], []
+        for worker, greenlet in counts.items():
+            for offset in range(0, greenlet.value, Job.chunk):
+                h, c = packed.unpack_pairs(worker.clustered(offset, Job.chunk))
+                hashes.append(h)
+                clusters.append(c)
+        empty = numpy.empty(0, dtype=packed.DTYPE)
+        self.clustering = Clustering(*components(
+            numpy.concatenate([empty] + hashes),
+            numpy.concatenate([empty] + clusters)))
+        return len(self.clustering)
+
+    def clustered(self, offset, count):
+        clustering = self.clustering
+        if offset + count >= len(clustering):
+            self.clustering = None
+        return clustering.chunk(offset, count)
+
+    def capabilities(self):
+        '''The same as any slave's'''
+        return [packed.PACKED, 'transfer', 'resources', 'metrics', 'direct',
+            'cluster']
+
+    def metrics(self):
+        '''Our own timings and counts, along with each worker's'''
+        snapshot = self._metrics.snapshot()
+        snapshot['workers'] = dict((repr(w), w.metrics())
+            for w in self.workers if w.ready)
+        return snapshot
+
+    def resources(self):
+        '''What this machine has to offer, which every worker shares'''
+        self.workers[0].up.wait()
+        return self.workers[0].resources()
+
+    def master(self, host):
+        '''Our client for the master at host, made the first time we need it'''
+        import zerorpc
+        client = self.masters.get(host)
+        if client is None:
+            client = self.masters[host] = zerorpc.Client('tcp://%s' % host)
+        return client
+
+    def register(self, host):
+        logger.info('Registering...')
+        logger.info('Registered: %s' % repr(
+            self.master(host).register(self.hostname)))
+
+    def deregister(self, host):
+        self.master(host).deregister(self.hostname)
+        self.masters.pop(host).close()
+
+def work(address, hostname):
+    '''Serve a slave as a worker for the front process that started us'''
+    import zerorpc
+    from .slave import Slave
+    parent = os.getppid()
+    server = zerorpc.Server(Slave(hostname))
+    server.bind(address)
+    def orphaned():
+        # Don't outlive the front process
+        while os.getppid() == parent:
+            gevent.sleep(1)
+        server.stop()
+    gevent.spawn(orphaned)
+    server.run()
+
+if __name__ == '__main__':
+    work(sys.argv[1], sys.argv[2])
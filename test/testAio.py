@@ -0,0 +1,134 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import random
+import asyncio
+import gevent
+from smhcluster import aio
+from smhcluster.adapters import aio as adapter
+from smhcluster.master import Master
+from smhcluster.slave import Slave
+
+class TestAio(unittest.TestCase):
+    port = 4390
+
+    def setUp(self):
+        random.seed(42)
+        # A master with a couple of slaves in this process, served over asyncio
+        self.master = Master()
+        self.master.config({})
+        self.slaves = [Slave('slave-%i' % i) for i in range(2)]
+        for i, (start, end) in enumerate(self.master.ranges()):
+            slave = self.slaves[i % len(self.slaves)]
+            slave.load(start, end)
+            self.master.packed.add(slave)
+            self.master.rangemap.insert(start, end,
+                self.master.replicas([slave]))
+        self.hashes = [random.getrandbits(64) for i in range(100)]
+        self.master.insert(*self.hashes)
+        # Count the requests that reach the cluster
+        self.requests = []
+        for method in ('find_first_packed', 'find_all_packed', 'insert_packed',
+            'remove_packed'):
+            setattr(self.master, method, self.counted(method))
+
+        TestAio.port += 1
+        self.server = adapter.Server(self.master)
+        self.server.config({'port': TestAio.port})
+        self.listener = gevent.spawn(self.server.listen)
+
+    def tearDown(self):
+        self.server.stop()
+        self.listener.join(5)
+
+    def counted(self, method):
+        original = getattr(self.master, method)
+        def call(buf):
+            self.requests.append(method)
+            return original(buf)
+        return call
+
+    def run_async(self, scenario):
+        '''Run a coroutine function with a connected client, on an asyncio loop
+        in a thread of its own (as a crawler would)'''
+        async def main():
+            client = aio.Client('127.0.0.1:%i' % TestAio.port)
+            for attempt in range(100):
+                try:
+                    await client.connect()
+                    break
+                except OSError:
+                    await asyncio.sleep(0.05)
+            try:
+                return await scenario(client)
+            finally:
+                await client.close()
+        return gevent.get_hub().threadpool.spawn(asyncio.run, main()).get()
+
+    def test_coalesce(self):
+        # Concurrent single-hash calls should go out as one request each
+        queries = [h ^ 1 for h in self.hashes]
+        async def scenario(client):
+            return await asyncio.gather(
+                *([client.find_first(q) for q in queries] +
+                  [client.find_all(q) for q in queries]))
+        results = self.run_async(scenario)
+        self.assertEqual(results[:100], self.hashes)
+        self.assertEqual(results[100:], [[h] for h in self.hashes])
+        self.assertEqual(sorted(self.requests),
+            ['find_all_packed', 'find_first_packed'])
+
+    def test_bulk(self):
+        fresh = [random.getrandbits(64) for i in range(10)]
+        async def scenario(client):
+            first = await client.find_first_bulk(fresh + self.hashes[:10])
+            claimed = await client.find_first_or_insert_bulk(fresh)
+            again = await client.find_first_or_insert(fresh[0])
+            return first.tolist(), claimed.tolist(), again
+        first, claimed, again = self.run_async(scenario)
+        self.assertEqual(first, [0] * 10 + self.hashes[:10])
+        self.assertEqual(claimed, [0] * 10)
+        self.assertEqual(again, fresh[0])
+
+    def test_order(self):
+        # Writes to the same hash are applied in the order they were made
+        h = random.getrandbits(64)
+        async def scenario(client):
+            await asyncio.gather(client.insert(h), client.remove(h),
+                client.insert(h), client.remove(h))
+            return await client.find_first(h)
+        self.assertEqual(self.run_async(scenario), 0)
+        self.assertEqual(self.requests, ['insert_packed', 'remove_packed',
+            'insert_packed', 'remove_packed', 'find_first_packed'])
+
+    def test_failure(self):
+        # Errors in the cluster are raised for every call they affect
+        def fail(buf):
+            raise ValueError('Oh noes!')
+        self.master.find_all_packed = fail
+        async def scenario(client):
+            return await asyncio.gather(client.find_all(1), client.find_all(2),
+                client.find_first(self.hashes[0]), return_exceptions=True)
+        results = self.run_async(scenario)
+        self.assertTrue(isinstance(results[0], aio.Client.Failed))
+        self.assertTrue(isinstance(results[1], aio.Client.Failed))
+        self.assertEqual(results[2], self.hashes[0])
+
+    def test_closed(self):
+        # Calls on a closed connection fail straight away
+        async def scenario(client):
+            await client.close()
+            try:
+                await client.find_first(1)
+            except aio.Client.Closed:
+                return True
+        self.assertTrue(self.run_async(scenario))
+
+if __name__ == '__main__':
+    unittest.main()
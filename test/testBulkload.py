@@ -0,0 +1,101 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import shutil
+import random
+import tempfile
+import numpy
+from smhcluster import packed
+from smhcluster.bulkload import Loader, merge, ranges, pieces, read
+from smhcluster.storage.disk import Disk
+
+class TestBulkload(unittest.TestCase):
+    def setUp(self):
+        random.seed(42)
+        self.path = tempfile.mkdtemp()
+        self.storage = Disk({'path': os.path.join(self.path, 'snapshots')})
+        os.makedirs(self.storage.path)
+        self.hashes = [random.getrandbits(64) for i in range(5000)]
+        # The same hashes, some of them more than once, split over a packed
+        # dump and a text one
+        with open(os.path.join(self.path, 'a.bin'), 'wb') as f:
+            f.write(packed.pack_hashes(self.hashes[:3000] + self.hashes[:100]))
+        with open(os.path.join(self.path, 'b.txt'), 'w') as f:
+            f.write(''.join('%i\n' % h for h in self.hashes[2900:]))
+        self.dumps = [os.path.join(self.path, p) for p in ('a.bin', 'b.txt')]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def expected(self, shards, differing_bits):
+        # Every shard that any variant of each hash falls in should have it
+        results = [set() for i in range(shards)]
+        for h in self.hashes:
+            for flip in range(1 << differing_bits):
+                q = h ^ (flip << (64 - differing_bits))
+                results[q * shards >> 64].add(h)
+        return [sorted(r) for r in results]
+
+    def check(self, loader, shards, differing_bits):
+        read, counts = loader.load(self.dumps)
+        self.assertEqual(read, 5200)
+        for (start, end), expected in zip(ranges(shards),
+            self.expected(shards, differing_bits)):
+            self.assertEqual(self.storage.load(start, end).tolist(), expected)
+        self.assertEqual(sum(counts.values()), 5000 << differing_bits)
+
+    def test_load(self):
+        self.check(Loader(self.storage, 16, 3, processes=2, tmp=self.path),
+            16, 3)
+
+    def test_external(self):
+        # With too little memory to sort any shard at once
+        self.check(Loader(self.storage, 8, 2, processes=2, memory=8 * 500,
+            tmp=self.path), 8, 2)
+        # And nothing should be left behind
+        self.assertEqual(sorted(os.listdir(self.path)),
+            ['a.bin', 'b.txt', 'snapshots'])
+
+    def test_pieces(self):
+        # Every piece starts and ends between records, and between them they
+        # have every hash, in order
+        for path in self.dumps:
+            whole = numpy.concatenate(list(read(path))).tolist()
+            split = pieces(path, size=1001)
+            self.assertTrue(len(split) > 5)
+            self.assertEqual(numpy.concatenate([h for p, fmt, start, end in
+                split for h in read(p, fmt, 100, start, end)]).tolist(), whole)
+
+    def test_split(self):
+        # With a single dump, split over all the processes
+        with open(self.dumps[0], 'ab') as f:
+            f.write(packed.pack_hashes(self.hashes[2900:]))
+        self.dumps = self.dumps[:1]
+        self.check(Loader(self.storage, 16, 3, processes=3, tmp=self.path,
+            piece=4000), 16, 3)
+
+    def test_probe(self):
+        # Each hash should only be in its own shard
+        read, counts = Loader(self.storage, 16, 3, processes=2, tmp=self.path,
+            probe=True).load(self.dumps)
+        for shard, (start, end) in enumerate(ranges(16)):
+            self.assertEqual(self.storage.load(start, end).tolist(),
+                sorted(h for h in self.hashes if h * 16 >> 64 == shard))
+        self.assertEqual(sum(counts.values()), 5000)
+
+    def test_merge(self):
+        runs = [numpy.unique(numpy.random.randint(0, 1000, size=300).astype(
+            numpy.uint64)) for i in range(4)]
+        merged = numpy.concatenate(list(merge(runs, 7)))
+        self.assertEqual(merged.tolist(),
+            numpy.unique(numpy.concatenate(runs)).tolist())
+        self.assertRaises(ValueError, Loader, self.storage, 12)
+
+if __name__ == '__main__':
+    unittest.main()
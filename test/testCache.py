@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import random
+import numpy
+from smhcluster.cache import Cache
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        random.seed(42)
+        self.cache = Cache(3)
+        self.cache.config({'enabled': True})
+        self.hashes = set(random.getrandbits(64) for i in range(200))
+
+    def flip(self, h, bits):
+        for b in random.sample(range(64), bits):
+            h ^= 1 << b
+        return h
+
+    def brute(self, query):
+        return sorted(h for h in self.hashes if bin(h ^ query).count('1') <= 3)
+
+    def query(self, queries):
+        '''Answer find_all for queries, from the cache where possible'''
+        queries = numpy.array(queries, dtype=numpy.uint64)
+        hits, cached, misses, token = self.cache.lookup('find_all', queries)
+        results = [None] * len(queries)
+        for i, result in zip(hits, cached):
+            results[i] = result
+        answers = [self.brute(q) for q in queries[misses].tolist()]
+        for i, result in zip(misses, answers):
+            results[i] = result
+        self.cache.store('find_all', queries[misses], answers, token)
+        return results, len(hits)
+
+    def write(self, hashes, insert=True):
+        for h in hashes:
+            if insert:
+                self.hashes.add(h)
+            else:
+                self.hashes.discard(h)
+        self.cache.invalidate(numpy.array(hashes, dtype=numpy.uint64))
+
+    def test_hits(self):
+        queries = [self.flip(h, 2) for h in self.hashes]
+        self.assertEqual(self.query(queries)[1], 0)
+        results, hits = self.query(queries)
+        self.assertEqual(hits, len(queries))
+        self.assertEqual(results, [self.brute(q) for q in queries])
+        self.assertEqual(self.cache.hit_rate(), 0.5)
+
+    def test_invalidate(self):
+        # Writes near cached queries should always be seen, and writes far
+        # from them shouldn't disturb them
+        queries = [self.flip(h, random.randint(0, 5)) for h in self.hashes]
+        self.query(queries)
+        for i in range(20):
+            near = [self.flip(q, random.randint(0, 4))
+                for q in random.sample(queries, 10)]
+            self.write(near, insert=bool(i % 2))
+            results, hits = self.query(queries)
+            self.assertEqual(results, [self.brute(q) for q in queries])
+            self.assertTrue(hits > 0)
+
+    def test_in_flight(self):
+        # A write landing while a query is out shouldn't let a stale answer in
+        queries = numpy.array([12345], dtype=numpy.uint64)
+        hits, cached, misses, token = self.cache.lookup('find_first', queries)
+        self.write([12344])
+        self.cache.store('find_first', queries, [0], token)
+        self.assertEqual(self.cache.lookup('find_first', queries)[0], [])
+
+    def test_negative(self):
+        queries = numpy.array([1, 2], dtype=numpy.uint64)
+        self.cache.config({'enabled': True, 'negative': False})
+        token = self.cache.lookup('find_first', queries)[3]
+        self.cache.store('find_first', queries, [0, 3], token)
+        self.assertEqual(self.cache.lookup('find_first', queries)[:2],
+            ([1], [3]))
+
+    def test_memory(self):
+        # We should stay within our budget, evicting the least recently used
+        self.cache.config({'enabled': True, 'memory': Cache.overhead * 10})
+        queries = numpy.arange(1, 21, dtype=numpy.uint64) << numpy.uint64(40)
+        token = self.cache.lookup('find_first', queries[:10])[3]
+        self.cache.store('find_first', queries[:10], [0] * 10, token)
+        self.cache.lookup('find_first', queries[:1])
+        self.cache.lookup('find_first', queries[10:15])
+        self.assertEqual(len(self.cache), 10)
+        self.assertTrue(self.cache.bytes <= self.cache.memory)
+        self.assertEqual(self.cache.lookup('find_first', queries[:2])[0], [0])
+        # Turning the cache off should empty it
+        self.cache.config({})
+        self.assertEqual((len(self.cache), self.cache.bytes, self.cache.index),
+            (0, 0, {}))
+
+if __name__ == '__main__':
+    unittest.main()
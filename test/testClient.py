@@ -0,0 +1,156 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import random
+import socket
+import gevent
+import zerorpc
+from smhcluster.client import Client
+from smhcluster.master import Master
+from smhcluster.slave import Slave
+from smhcluster.routing import Fence
+
+def address():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    host = '127.0.0.1:%i' % sock.getsockname()[1]
+    sock.close()
+    return host
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        random.seed(42)
+        # A master and a couple of slaves in this process, each served over
+        # zerorpc for the client to talk to
+        self.master = Master()
+        self.master.config({})
+        self.slaves = [Slave(address()) for i in range(2)]
+        self.servers = []
+        for slave in self.slaves:
+            self.serve(slave, slave.hostname)
+            self.master.slaves[slave.hostname] = slave
+            self.master.negotiate(slave)
+        for i, (start, end) in enumerate(self.master.ranges()):
+            slave = self.slaves[i % len(self.slaves)]
+            slave.load(start, end)
+            self.master.rangemap.insert(start, end,
+                self.master.replicas([slave]))
+        self.host = address()
+        self.serve(self.master, self.host)
+        self.hashes = [random.getrandbits(64) for i in range(100)]
+        self.client = Client(self.host)
+
+    def tearDown(self):
+        self.client.close()
+        for server in self.servers:
+            server.stop()
+
+    def serve(self, thing, host):
+        server = zerorpc.Server(thing)
+        server.bind('tcp://%s' % host)
+        gevent.spawn(server.run)
+        self.servers.append(server)
+
+    def range(self, h):
+        '''The (start, end, replicas) of the range h falls in'''
+        return [(s, e, r) for s, e, r in self.master.rangemap if s <= h <= e][0]
+
+    def test_queries(self):
+        # Answers straight from the slaves are the same as the master's
+        self.client.insert_bulk(self.hashes)
+        queries = [h ^ 1 for h in self.hashes] + [h ^ (1 << 40) for h in
+            self.hashes[:10]] + [random.getrandbits(64) for i in range(10)]
+        self.assertEqual(self.client.find_first_bulk(queries).tolist(),
+            [r for q, r in self.master.find_first(*queries)])
+        self.assertEqual([r.tolist() for r in
+            self.client.find_all_bulk(queries)],
+            [sorted(r) for q, r in self.master.find_all(*queries)])
+        self.client.remove(self.hashes[0])
+        self.assertEqual(self.client.find_first(self.hashes[0]), 0)
+        self.assertEqual(self.client.find_all(self.hashes[1] ^ 3),
+            [self.hashes[1]])
+
+    def test_claim(self):
+        fresh = [random.getrandbits(64) for i in range(10)]
+        self.client.insert_bulk(self.hashes)
+        self.assertEqual(self.client.find_first_or_insert_bulk(
+            fresh + self.hashes[:10]).tolist(), [0] * 10 + self.hashes[:10])
+        self.assertEqual(self.client.find_first_or_insert(fresh[0] ^ 1),
+            fresh[0])
+        self.assertEqual([r for q, r in self.master.find_first(*fresh)], fresh)
+
+    def test_stale(self):
+        # Once a range moves, the slave it's left turns requests for it away,
+        # and the client fetches the new table and tries again
+        self.client.insert_bulk(self.hashes)
+        epoch = self.client.epoch
+        h = self.hashes[0]
+        start, end, replicas = self.range(h)
+        old = replicas.slaves[0]
+        new = [s for s in self.slaves if s is not old][0]
+        self.master.move(start, end, old, new)
+        self.assertTrue(self.master.epoch > epoch)
+        self.assertEqual(self.client.find_first(h ^ 1), h)
+        self.assertEqual(self.client.epoch, self.master.epoch)
+        self.assertEqual(self.client.refreshes, 2)
+
+    def test_migrating(self):
+        # Writes to a range being copied go to the slave it's going to, too
+        h = self.hashes[0]
+        start, end, replicas = self.range(h)
+        new = [s for s in self.slaves if s not in replicas][0]
+        new.prepare(start, end)
+        self.master.migrating.insert(start, end, new)
+        self.master.publish()
+        self.client.insert(h)
+        self.assertEqual(self.client.refreshes, 2)
+        self.assertTrue(h in new.find(h))
+        self.assertTrue(h in replicas.slaves[0].find(h))
+
+    def test_probe(self):
+        self.master.config({'probe': True})
+        self.client.insert_bulk(self.hashes)
+        self.assertTrue(self.client.probe)
+        queries = [h ^ (1 << 63) for h in self.hashes]
+        self.assertEqual(self.client.find_first_bulk(queries).tolist(),
+            self.hashes)
+        self.assertEqual([r for q, r in self.master.find_first(*queries)],
+            self.hashes)
+
+    def test_cached(self):
+        # Writes straight to the slaves wouldn't clear the master's cached
+        # answers, so while it's caching, clients have to go through it
+        self.client.insert_bulk(self.hashes[:50])
+        self.master.config({'cache': {'enabled': True}})
+        queries = [h ^ 1 for h in self.hashes]
+        self.assertEqual([r for q, r in self.master.find_first(*queries)],
+            self.hashes[:50] + [0] * 50)
+        self.assertRaises(zerorpc.RemoteError, self.client.insert_bulk,
+            self.hashes[50:])
+        self.assertRaises(Master.Cached, Client, self.master)
+        self.master.insert(*self.hashes[50:])
+        self.assertEqual([r for q, r in self.master.find_first(*queries)],
+            self.hashes)
+        # And once it stops, they can go straight to the slaves again
+        self.master.config({})
+        self.client.remove_bulk(self.hashes[:50])
+        self.assertEqual([r for q, r in self.master.find_first(*queries)],
+            [0] * 50 + self.hashes[50:])
+
+    def test_unfenced(self):
+        # Slaves turn away anything routed with an older table than the last
+        # they heard of, and until they've heard of one, everything
+        self.assertRaises(zerorpc.RemoteError,
+            self.client.connect(self.slaves[0].hostname).direct,
+            self.client.epoch - 1, 'find_first', b'')
+        fresh = Slave('fresh')
+        self.assertRaises(Fence.Stale, fresh.direct, 1, 'find_first', b'')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import random
+import shutil
+import tempfile
+import numpy
+from smhcluster.clusters import components
+from smhcluster.master import Master
+from smhcluster.slave import Slave
+
+class TestComponents(unittest.TestCase):
+    def test_components(self):
+        # Two chains linked out of order, a pair, and a star
+        lefts  = [9, 5, 7, 100, 30, 30, 30]
+        rights = [7, 9, 5, 200, 31, 32, 33]
+        hashes, clusters = components(lefts, rights)
+        self.assertEqual(hashes.tolist(), [5, 7, 9, 30, 31, 32, 33, 100, 200])
+        self.assertEqual(clusters.tolist(), [5, 5, 5, 30, 30, 30, 30, 100, 100])
+        # A long chain takes more than one round of hooking
+        chain = numpy.arange(1000, 0, -1)
+        hashes, clusters = components(chain[1:], chain[:-1])
+        self.assertEqual(clusters.tolist(), [1] * 1000)
+        hashes, clusters = components([], [])
+        self.assertEqual((len(hashes), len(clusters)), (0, 0))
+
+class TestJob(unittest.TestCase):
+    def setUp(self):
+        random.seed(42)
+        self.path = tempfile.mkdtemp()
+        # A master with two pairs of replicas in this process
+        self.master = Master()
+        self.master.config({'replication': {'replicas': 2}})
+        self.slaves = [Slave('slave-%i' % i) for i in range(4)]
+        for slave in self.slaves:
+            self.master.slaves[slave.hostname] = slave
+            self.master.negotiate(slave)
+        for i, (start, end) in enumerate(self.master.ranges()):
+            replicas = self.slaves[2 * (i % 2):2 * (i % 2) + 2]
+            for slave in replicas:
+                slave.load(start, end)
+            self.master.rangemap.insert(start, end,
+                self.master.replicas(replicas))
+        # Groups of near-duplicates, some of which are only linked through
+        # another member, along with plenty of hashes on their own
+        self.hashes = [random.getrandbits(64) for i in range(2000)]
+        for h in self.hashes[:300]:
+            near = self.flip(h, 2)
+            self.hashes += [near, self.flip(near, 3)]
+        self.master.insert(*self.hashes)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def flip(self, h, bits):
+        # Near-duplicates that differ in the bits that pick a hash's shards
+        # might not be held together (and wouldn't be found by find_all either)
+        for b in random.sample(range(54), bits):
+            h ^= 1 << b
+        return h
+
+    def expected(self):
+        # What find_all for every hash would group together
+        lefts, rights = [], []
+        for h, matches in self.master.find_all(*self.hashes):
+            lefts  += [h] * len(matches)
+            rights += matches
+        lefts  = numpy.array(lefts , dtype=numpy.uint64)
+        rights = numpy.array(rights, dtype=numpy.uint64)
+        hashes, clusters = components(
+            lefts[lefts != rights], rights[lefts != rights])
+        self.assertEqual(len(hashes), 900)
+        return hashes.tolist(), clusters.tolist()
+
+    def test_job(self):
+        asked = []
+        for slave in self.slaves:
+            def cluster(slave=slave, original=slave.cluster):
+                asked.append(slave)
+                return original()
+            slave.cluster = cluster
+        summary = self.master.clusters(os.path.join(self.path, 'out'))
+        hashes, clusters = self.expected()
+        self.assertEqual(summary['hashes'], len(hashes))
+        self.assertEqual(summary['clusters'], len(set(clusters)))
+        self.assertTrue(summary['clusters'] >= 300)
+        pairs = numpy.concatenate([numpy.fromfile(path, dtype='<u8')
+            for path in summary['paths']]).reshape(-1, 2)
+        self.assertEqual(pairs[:, 0].tolist(), hashes)
+        self.assertEqual(pairs[:, 1].tolist(), clusters)
+        # Only one of each pair of replicas should have done any joining
+        self.assertEqual(len(asked), 2)
+        self.assertEqual(len(set(asked) & set(self.slaves[:2])), 1)
+
+    def test_text(self):
+        self.master.config({'replication': {'replicas': 2},
+            'clusters': {'part': 100}})
+        summary = self.master.clusters(self.path, 'text')
+        self.assertEqual(len(summary['paths']),
+            (summary['hashes'] + 99) // 100)
+        lines = []
+        for path in summary['paths']:
+            with open(path) as f:
+                lines += [tuple(int(v) for v in line.split()) for line in f]
+        hashes, clusters = self.expected()
+        self.assertEqual(lines, list(zip(hashes, clusters)))
+
+    def test_probe(self):
+        self.master.probe = True
+        self.assertRaises(ValueError, self.master.clusters, self.path)
+
+if __name__ == '__main__':
+    unittest.main()
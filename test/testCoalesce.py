@@ -0,0 +1,81 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import gevent
+from smhcluster.coalesce import Coalescer
+
+class TestCoalescer(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.fail = False
+        self.coalescer = Coalescer(self.send)
+        self.coalescer.config({'window': 0.01, 'count': 100})
+
+    def send(self, method, hashes):
+        gevent.sleep(0.001)
+        if self.fail:
+            raise ValueError('Oh noes!')
+        self.sent.append((method, sorted(hashes)))
+
+    def test_coalesce(self):
+        # Writes from many callers should go out together, with only the last
+        # write to each hash
+        writers = [gevent.spawn(self.coalescer.add, 'insert', [i])
+            for i in range(10)]
+        writers.append(gevent.spawn(self.coalescer.add, 'remove', [3, 11]))
+        gevent.joinall(writers, raise_error=True)
+        self.assertTrue(all(w.value for w in writers))
+        self.assertEqual(self.sent, [
+            ('insert', [0, 1, 2, 4, 5, 6, 7, 8, 9]), ('remove', [3, 11])])
+
+    def test_count(self):
+        # A full batch shouldn't wait for the window
+        self.coalescer.window = 10
+        writers = [gevent.spawn(self.coalescer.add, 'insert', range(i, i + 10))
+            for i in range(0, 200, 10)]
+        with gevent.Timeout(1):
+            gevent.joinall(writers, raise_error=True)
+        self.assertEqual(sorted(sum((h for m, h in self.sent), [])),
+            list(range(200)))
+
+    def test_nowait(self):
+        # Fire-and-forget writes should return before they're sent, and flush
+        # should wait for them
+        self.assertTrue(self.coalescer.add('insert', [1, 2], wait=False))
+        self.assertEqual(self.sent, [])
+        self.assertEqual(len(self.coalescer), 2)
+        self.coalescer.flush()
+        self.assertEqual(self.sent, [('insert', [1, 2])])
+        self.assertEqual(len(self.coalescer), 0)
+
+    def test_empty(self):
+        # Writing nothing at all shouldn't wait for someone else's write
+        with gevent.Timeout(1):
+            self.assertTrue(self.coalescer.add('insert', []))
+        self.assertEqual(self.coalescer.timer, None)
+        self.assertEqual(self.sent, [])
+
+    def test_failure(self):
+        # Everyone waiting on a failed flush should hear about it
+        self.fail = True
+        writers = [gevent.spawn(self.coalescer.add, 'insert', [i])
+            for i in range(3)]
+        gevent.joinall(writers)
+        for writer in writers:
+            self.assertTrue(isinstance(writer.exception, ValueError))
+
+    def test_disable(self):
+        # Turning coalescing off shouldn't strand anything
+        self.coalescer.add('remove', [5], wait=False)
+        self.coalescer.config({'enabled': False})
+        self.assertEqual(self.sent, [('remove', [5])])
+        self.assertRaises(KeyError, self.coalescer.config, {'windows': 1})
+
+if __name__ == '__main__':
+    unittest.main()
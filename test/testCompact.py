@@ -0,0 +1,56 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import numpy
+from smhcluster.compact import Compact, bit_length
+
+class TestCompact(unittest.TestCase):
+    def setUp(self):
+        numpy.random.seed(42)
+        self.table = numpy.sort(numpy.random.randint(0, 1 << 62, size=1000,
+            dtype=numpy.int64).astype(numpy.uint64) << numpy.uint64(2))
+        # With some duplicates, and the extremes
+        self.table = numpy.sort(numpy.concatenate((self.table,
+            self.table[:50], numpy.array([0, (1 << 64) - 1], numpy.uint64))))
+
+    def test_bit_length(self):
+        values = [0, 1, 2, 3, 255, 256, (1 << 63) - 1, 1 << 63, (1 << 64) - 1]
+        self.assertEqual(bit_length(values).tolist(),
+            [v.bit_length() for v in values])
+
+    def test_array(self):
+        # Every size of table should come back out just as it went in,
+        # including those with a short last block
+        for size in (2, 7, 64):
+            for count in (0, 1, size - 1, size, size + 1, len(self.table)):
+                table = self.table[:count]
+                compact = Compact(table, size)
+                self.assertEqual(len(compact), count)
+                self.assertEqual(compact.array().tolist(), table.tolist())
+        self.assertRaises(ValueError, Compact, self.table, 1)
+
+    def test_scan(self):
+        # We should find exactly what's between each pair of bounds
+        low = numpy.random.randint(0, 1 << 62, size=200,
+            dtype=numpy.int64).astype(numpy.uint64) << numpy.uint64(2)
+        low[0] = 0
+        high = low + numpy.uint64(1 << 56)
+        high[high < low] = (1 << 64) - 1
+        high[-1] = (1 << 64) - 1
+        owners, found = Compact(self.table, 16).scan(low, high)
+        expected = [(i, h) for i in range(len(low)) for h in
+            self.table[(self.table >= low[i]) & (self.table <= high[i])].tolist()]
+        self.assertEqual(list(zip(owners.tolist(), found.tolist())), expected)
+
+    def test_nbytes(self):
+        # Sorted hashes share their leading bits, so this should be smaller
+        self.assertTrue(Compact(self.table).nbytes < self.table.nbytes)
+
+if __name__ == '__main__':
+    unittest.main()
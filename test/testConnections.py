@@ -0,0 +1,103 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import socket
+import gevent
+import zerorpc
+from smhcluster.connections import Connection
+
+class Remote(object):
+    # A stand-in for a slave that we can make hang
+    hung = False
+
+    def wait(self):
+        while self.hung:
+            gevent.sleep(0.01)
+
+    def capabilities(self):
+        self.wait()
+        return []
+
+    def find_first(self, *hashes):
+        self.wait()
+        return list(hashes)
+
+    def load(self, start, end):
+        # Too busy to answer heartbeats for longer than the deadline
+        self.hung = True
+        gevent.sleep(0.5)
+        self.hung = False
+        return end - start
+
+    def broken(self):
+        raise ValueError('Oh noes!')
+
+class TestConnection(unittest.TestCase):
+    def setUp(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.host = '127.0.0.1:%i' % sock.getsockname()[1]
+        sock.close()
+        self.remote = Remote()
+        self.server = zerorpc.Server(self.remote)
+        self.server.bind('tcp://%s' % self.host)
+        gevent.spawn(self.server.run)
+        self.lost = []
+        self.connection = Connection(self.host, {'deadline': 0.2,
+            'heartbeat': 0.05, 'threshold': 2, 'grace': None}, self.lost.append)
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.stop()
+
+    def test_call(self):
+        self.assertEqual(self.connection.find_first(1, 2), [1, 2])
+        # Errors from the slave itself don't count against it
+        for i in range(3):
+            self.assertRaises(zerorpc.RemoteError, self.connection.broken)
+        self.assertTrue(self.connection.healthy)
+
+    def test_slow(self):
+        # Loading a shard may take longer than the deadline, and starve the
+        # heartbeats in the meantime, without the slave being cut off
+        self.assertEqual(self.connection.load(0, 10), 10)
+        self.assertTrue(self.connection.healthy)
+        # Even if it takes longer than we're prepared to wait
+        self.connection.configure({'patience': 0.1})
+        self.assertRaises(zerorpc.TimeoutExpired, self.connection.load, 0, 10)
+        self.assertTrue(self.connection.healthy)
+        self.assertEqual(self.connection.failures, 0)
+
+    def test_breaker(self):
+        # A hung slave should be cut off, and calls should then fail fast
+        self.remote.hung = True
+        self.assertRaises(zerorpc.TimeoutExpired, self.connection.find_first, 1)
+        with gevent.Timeout(2):
+            while self.connection.healthy:
+                gevent.sleep(0.01)
+        self.assertRaises(Connection.Unavailable, self.connection.find_first, 1)
+        # Once it answers heartbeats again, calls should go through
+        self.remote.hung = False
+        with gevent.Timeout(2):
+            while not self.connection.healthy:
+                gevent.sleep(0.01)
+        self.assertEqual(self.connection.find_first(1), [1])
+
+    def test_lost(self):
+        # After the grace period, we give up on the slave
+        self.connection.configure({'grace': 0.1})
+        self.remote.hung = True
+        with gevent.Timeout(2):
+            while not self.lost:
+                gevent.sleep(0.01)
+        self.assertEqual(self.lost, [self.connection])
+        self.assertRaises(KeyError, self.connection.configure, {'grease': 1})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import io
+import json
+import zlib
+from wsgiref.util import setup_testing_defaults
+from smhcluster import packed
+from smhcluster.adapters.http import Handler
+
+class Cluster(object):
+    '''Answers the handler's calls without any slaves: the near-duplicates of q
+    are q ^ 1 and q ^ 2, except for multiples of three, which have none'''
+    def __init__(self):
+        self.calls  = []
+        self.fed    = []
+        self.closed = []
+
+    def near(self, q):
+        return [] if q % 3 == 0 else [q ^ 1, q ^ 2]
+
+    def find_all(self, *queries):
+        self.calls.append(('find_all', queries))
+        return [(q, self.near(q)) for q in queries]
+
+    def find_all_packed(self, buf):
+        queries = packed.unpack_hashes(buf).tolist()
+        self.calls.append(('find_all_packed', queries))
+        return packed.pack_sets([self.near(q) for q in queries])
+
+    def find_first_packed(self, buf):
+        return packed.pack_hashes([(self.near(q) or [0])[0]
+            for q in packed.unpack_hashes(buf).tolist()])
+
+    def ingest_open(self, method):
+        return 'key'
+
+    def ingest_feed(self, key, buf):
+        hashes = packed.unpack_hashes(buf).tolist()
+        if 0 in hashes:
+            raise RuntimeError('Slaves unavailable')
+        self.fed.extend(hashes)
+
+    def ingest_finished(self, key, wait=False):
+        return [{'done': len(self.fed)}] if wait else []
+
+    def ingest_close(self, key):
+        self.closed.append(key)
+        return {'hashes': len(self.fed)}
+
+class TestHandler(unittest.TestCase):
+    def setUp(self):
+        self.cluster = Cluster()
+        self.handler = Handler(self.cluster, {'chunk': 4})
+
+    def start(self, method, path, body=b'', headers=None):
+        '''Start a request, returning (status, headers, the body iterable)'''
+        environ = {}
+        setup_testing_defaults(environ)
+        environ.update({
+            'REQUEST_METHOD': method,
+            'PATH_INFO'     : path,
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input'    : io.BytesIO(body)
+        })
+        for key, value in (headers or {}).items():
+            if key == 'Content-Type':
+                environ['CONTENT_TYPE'] = value
+            else:
+                environ['HTTP_' + key.upper().replace('-', '_')] = value
+        started = []
+        def start_response(status, headers, exc_info=None):
+            started.extend([status, dict(headers)])
+        result = self.handler.root(environ, start_response)
+        return started[0], started[1], result
+
+    def call(self, method, path, body=b'', headers=None):
+        status, headers, result = self.start(method, path, body, headers)
+        try:
+            body = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return status, headers, body
+
+    def test_all_packed(self):
+        # Each chunk's offsets carry on from the last, including those that
+        # found nothing at all
+        queries = [1, 2, 4, 5, 3, 6, 9, 12, 7, 8, 10, 11, 15, 18]
+        status, headers, body = self.call('POST', '/all',
+            packed.pack_hashes(queries), {'Content-Type': packed.CONTENT_TYPE})
+        self.assertEqual(status, '200 OK')
+        self.assertEqual([r.tolist() for r in packed.unpack_sets(body)],
+            [self.cluster.near(q) for q in queries])
+        self.assertEqual([len(q) for m, q in self.cluster.calls], [4, 4, 4, 2])
+        # And with nothing to look for
+        status, headers, body = self.call('POST', '/all', b'',
+            {'Content-Type': packed.CONTENT_TYPE})
+        self.assertEqual(packed.unpack_sets(body), [])
+
+    def test_all_json(self):
+        queries = [1, 3, 6, 9, 12, 2]
+        status, headers, body = self.call('POST', '/all',
+            json.dumps(queries).encode('utf-8'))
+        self.assertEqual(json.loads(body.decode('utf-8')),
+            [[q, self.cluster.near(q)] for q in queries])
+        self.assertEqual([len(q) for m, q in self.cluster.calls], [4, 2])
+
+    def test_gzip(self):
+        # JSON answers big enough to be worth it are gzipped, but only when
+        # the client says it can take it
+        queries = list(range(1, 200))
+        accepts = {'Accept-Encoding': 'gzip, deflate'}
+        expected = [self.cluster.near(q) for q in queries]
+        body = json.dumps(queries).encode('utf-8')
+        status, headers, plain = self.call('POST', '/all', body)
+        self.assertTrue('Content-Encoding' not in headers)
+        status, headers, gzipped = self.call('POST', '/all', body, accepts)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(gzipped, 31), plain)
+        self.assertEqual(json.loads(plain.decode('utf-8')),
+            [[q, r] for q, r in zip(queries, expected)])
+        # Small answers aren't
+        status, headers, body = self.call('GET', '/all/1', headers=accepts)
+        self.assertTrue('Content-Encoding' not in headers)
+        self.assertEqual(json.loads(body.decode('utf-8')), [[1, [0, 3]]])
+        # Nor are packed ones
+        for path in ('/first', '/all'):
+            status, headers, body = self.call('POST', path,
+                packed.pack_hashes(queries), dict(accepts,
+                **{'Content-Type': packed.CONTENT_TYPE}))
+            self.assertTrue('Content-Encoding' not in headers)
+        self.assertEqual([r.tolist() for r in packed.unpack_sets(body)],
+            expected)
+        # Nor anything at all with gzip turned off
+        self.handler.gzip = False
+        status, headers, body = self.call('POST', '/all',
+            json.dumps(queries).encode('utf-8'), accepts)
+        self.assertTrue('Content-Encoding' not in headers)
+
+    def lines(self, body):
+        return [json.loads(l) for l in body.decode('utf-8').splitlines()]
+
+    def test_stream(self):
+        status, headers, body = self.call('PUT', '/hashes/stream',
+            b'1\n2\n3\n')
+        self.assertEqual(self.lines(body), [{'done': 3}, {'hashes': 3}])
+        self.assertEqual(self.cluster.fed, [1, 2, 3])
+        self.assertEqual(self.cluster.closed, ['key'])
+
+    def test_stream_errors(self):
+        # A packed body that ends partway through a hash
+        status, headers, body = self.call('PUT', '/hashes/stream',
+            packed.pack_hashes([1, 2]) + b'\x01', {
+            'Content-Type': packed.CONTENT_TYPE})
+        lines = self.lines(body)
+        self.assertTrue('error' in lines[0])
+        self.assertEqual(lines[1:], [{'done': 2}, {'hashes': 2}])
+        self.assertEqual(self.cluster.fed, [1, 2])
+        self.assertEqual(self.cluster.closed, ['key'])
+        # And the cluster failing to take some
+        status, headers, body = self.call('PUT', '/hashes/stream',
+            b'1\n0\n')
+        lines = self.lines(body)
+        self.assertTrue('Slaves unavailable' in lines[0]['error'])
+        self.assertEqual(self.cluster.closed, ['key', 'key'])
+
+    def test_stream_abandoned(self):
+        # A client that goes away partway still has its stream closed
+        self.cluster.ingest_finished = lambda key, wait=False: [{}]
+        status, headers, result = self.start('PUT', '/hashes/stream',
+            b'1\n2\n')
+        next(iter(result))
+        self.assertEqual(self.cluster.closed, [])
+        result.close()
+        self.assertEqual(self.cluster.closed, ['key'])
+
+if __name__ == '__main__':
+    unittest.main()
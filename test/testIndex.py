@@ -0,0 +1,116 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import random
+import numpy
+from smhcluster.index import Index
+
+class TestIndex(unittest.TestCase):
+    def setUp(self):
+        random.seed(42)
+        self.index = Index(6, 3)
+        # Make sure we exercise both the delta and the main tables
+        self.index.buffer = 100
+        self.hashes = [random.getrandbits(64) for i in range(500)]
+        self.index.insert(self.hashes)
+
+    def flip(self, h, bits):
+        for b in random.sample(range(64), bits):
+            h ^= 1 << b
+        return h
+
+    def brute(self, query, hashes):
+        return sorted(set(
+            h for h in hashes if bin(h ^ query).count('1') <= 3))
+
+    def queries(self):
+        return [self.flip(h, random.randint(0, 5)) for h in self.hashes] + [0]
+
+    def test_permute(self):
+        # Permuting should be reversible for every table
+        hashes = numpy.array(self.hashes, dtype=numpy.uint64)
+        for t in range(self.index.tables):
+            self.assertEqual(self.index.unpermute(
+                self.index.permute(hashes, t), t).tolist(), self.hashes)
+        self.assertEqual(self.index.tables, 20)
+
+    def test_find_all(self):
+        # We should find exactly what a brute-force search finds
+        queries = self.queries()
+        for query, result in zip(queries, self.index.find_all(queries)):
+            self.assertEqual(result.tolist(), self.brute(query, self.hashes))
+
+    def test_find_first(self):
+        queries = self.queries()
+        for query, result in zip(queries, self.index.find_first(queries)):
+            self.assertEqual(result, (self.brute(query, self.hashes) or [0])[0])
+
+    def test_remove(self):
+        # Removed hashes shouldn't be found, whether or not they've been merged
+        self.index.insert(self.hashes[0:10])
+        self.index.remove(self.hashes[0:20])
+        remaining = self.hashes[20:] + self.hashes[0:10]
+        queries = self.queries()
+        for merge in (False, True):
+            if merge:
+                self.index.merge()
+            for query, result in zip(queries, self.index.find_all(queries)):
+                self.assertEqual(result.tolist(), self.brute(query, remaining))
+        self.assertEqual(len(self.index), 490)
+
+    def test_blocks(self):
+        # Other configurations should work as well
+        index = Index(4, 1)
+        index.insert(self.hashes)
+        queries = [self.flip(h, 1) for h in self.hashes]
+        self.assertEqual(index.find_first(queries).tolist(), self.hashes)
+        self.assertRaises(ValueError, Index, 3, 3)
+
+class TestCompactIndex(TestIndex):
+    '''The same, with the main tables kept compact'''
+    def setUp(self):
+        random.seed(42)
+        self.index = Index(6, 3, compact=8)
+        self.index.buffer = 100
+        self.hashes = [random.getrandbits(64) for i in range(500)]
+        self.index.insert(self.hashes)
+
+    def test_compact(self):
+        # With enough hashes, compact tables should take less memory
+        hashes = [random.getrandbits(64) for i in range(100000)]
+        plain, compact = Index(6, 3), Index(6, 3, compact=64)
+        for index in (plain, compact):
+            index.insert(hashes)
+            index.settle()
+            index.merge()
+        self.assertTrue(compact.nbytes < 0.9 * plain.nbytes)
+        queries = [self.flip(h, 3) for h in hashes[:100]]
+        self.assertEqual(compact.find_first(queries).tolist(),
+            plain.find_first(queries).tolist())
+
+    def test_pairs(self):
+        # Joining the tables with themselves should find every pair a brute-
+        # force search does, once, including removed and doubled-up hashes
+        hashes = self.hashes + [self.flip(h, random.randint(1, 4))
+            for h in self.hashes[:200]]
+        for compact in (None, 64):
+            index = Index(6, 3, compact)
+            index.buffer = 100
+            index.insert(hashes + hashes[:20])
+            index.remove(hashes[400:420])
+            remaining = sorted(set(hashes) - set(hashes[400:420]))
+            expected = [(a, b) for i, a in enumerate(remaining)
+                for b in remaining[i + 1:] if bin(a ^ b).count('1') <= 3]
+            lefts, rights = index.pairs()
+            self.assertTrue(len(expected) > 100)
+            self.assertEqual(list(zip(lefts.tolist(), rights.tolist())),
+                expected)
+
+if __name__ == '__main__':
+    unittest.main()
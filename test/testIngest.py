@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import io
+import gevent
+import numpy
+from smhcluster import packed
+from smhcluster.ingest import Ingest, read_lines, read_packed
+
+class Sink(object):
+    # A stand-in for the cluster that takes a while with each chunk
+    def __init__(self, delay=0, fail=()):
+        self.delay  = delay
+        self.fail   = fail
+        self.chunks = []
+        self.active = 0
+        self.peak   = 0
+
+    def __call__(self, hashes):
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        gevent.sleep(self.delay)
+        self.active -= 1
+        if len(self.chunks) in self.fail:
+            self.chunks.append(None)
+            raise ValueError('Oh noes!')
+        self.chunks.append(hashes.tolist())
+
+class TestIngest(unittest.TestCase):
+    def test_chunks(self):
+        # Hashes should be sent on in fixed-size chunks, whatever size they are
+        # fed in, with the remainder sent on close
+        sink = Sink()
+        ingest = Ingest(sink, chunk=4)
+        for hashes in ([1, 2, 3], [4, 5], [6, 7, 8, 9, 10]):
+            ingest.feed(hashes)
+        progress = ingest.close()
+        self.assertEqual(sink.chunks, [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10]])
+        self.assertEqual(progress['received'], 10)
+        self.assertEqual(progress['acked'], 10)
+        self.assertTrue(progress['done'])
+        self.assertEqual([r['offset'] for r in ingest.finished()], [0, 4, 8])
+
+    def test_backpressure(self):
+        # No more than `window` chunks should ever be in flight
+        sink = Sink(0.01)
+        ingest = Ingest(sink, chunk=2, window=3)
+        for i in range(20):
+            ingest.feed([i])
+        ingest.close()
+        self.assertEqual(sink.peak, 3)
+        self.assertEqual(sum(sink.chunks, []), list(range(20)))
+
+    def test_errors(self):
+        # Chunks that fail should be reported, and not stop the rest
+        ingest = Ingest(Sink(fail=(1,)), chunk=2)
+        ingest.feed(range(6))
+        progress = ingest.close()
+        self.assertEqual(progress['acked'], 4)
+        self.assertEqual([e['offset'] for e in progress['errors']], [2])
+        self.assertRaises(ValueError, ingest.feed, [1])
+
+class TestReaders(unittest.TestCase):
+    def test_lines(self):
+        # Lines split across reads should be put back together
+        stream = io.BytesIO(b'1\n22\n333\n4444')
+        self.assertEqual(
+            numpy.concatenate(list(read_lines(stream, 3))).tolist(),
+            [1, 22, 333, 4444])
+
+    def test_packed(self):
+        stream = io.BytesIO(packed.pack_hashes([1, 2, 3, 1 << 63]))
+        self.assertEqual(
+            numpy.concatenate(list(read_packed(stream, 5))).tolist(),
+            [1, 2, 3, 1 << 63])
+        stream = io.BytesIO(packed.pack_hashes([1])[:5])
+        self.assertRaises(ValueError, list, read_packed(stream))
+
+if __name__ == '__main__':
+    unittest.main()
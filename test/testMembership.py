@@ -0,0 +1,105 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import random
+import socket
+import gevent
+import zerorpc
+from smhcluster.master import Master
+from smhcluster.slave import Slave
+
+def address():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    host = '127.0.0.1:%i' % sock.getsockname()[1]
+    sock.close()
+    return host
+
+class TestMembership(unittest.TestCase):
+    def setUp(self):
+        random.seed(42)
+        # A master with slaves served over zerorpc in this process, which
+        # register with it just as they would from another machine
+        self.master = Master()
+        self.master.config({
+            'replication': {'replicas': 2},
+            'migration'  : {'rate': 1 << 30},
+            'connections': {'deadline': 2, 'heartbeat': 0.05, 'threshold': 2,
+                'grace': 0.3}
+        })
+        self.servers = {}
+        self.slaves  = {}
+        for i in range(3):
+            self.add()
+        self.hashes = [random.getrandbits(64) for i in range(500)]
+        self.master.insert(*self.hashes)
+
+    def tearDown(self):
+        for hostname in list(self.master.slaves):
+            self.master.slaves[hostname].close()
+        for server in self.servers.values():
+            server.stop()
+
+    def add(self):
+        hostname = address()
+        slave = self.slaves[hostname] = Slave(hostname)
+        server = self.servers[hostname] = zerorpc.Server(slave)
+        server.bind('tcp://%s' % hostname)
+        gevent.spawn(server.run)
+        self.master.register(hostname)
+        self.settle()
+        return hostname
+
+    def settle(self):
+        with gevent.Timeout(60):
+            self.master.pending.join()
+
+    def holders(self):
+        '''The hostnames of every slave holding a range'''
+        return set(slave.hostname for replicas in self.master.rangemap.counts()
+            if replicas is not None for slave in replicas)
+
+    def check(self):
+        # Every range has somewhere to be, and every hash can still be found
+        self.assertEqual(self.master.unassigned(), [])
+        self.assertEqual([r for q, r in self.master.find_first(*self.hashes)],
+            self.hashes)
+
+    def test_deregister(self):
+        self.add()
+        self.check()
+        hostname = sorted(self.holders())[1]
+        self.master.deregister(hostname)
+        self.settle()
+        self.assertTrue(hostname not in self.master.slaves)
+        self.assertTrue(hostname not in self.holders())
+        self.assertEqual(len(self.holders()), 3)
+        self.check()
+        # A slave object works as well as a hostname
+        hostname = sorted(self.holders())[0]
+        self.master.deregister(self.master.slaves[hostname])
+        self.settle()
+        self.assertEqual(len(self.holders()), 2)
+        self.check()
+
+    def test_lost(self):
+        # A slave that stops answering for longer than the grace period is
+        # given up on, and its ranges go to the others
+        hostname = sorted(self.holders())[0]
+        self.servers.pop(hostname).stop()
+        with gevent.Timeout(30):
+            while hostname in self.master.slaves:
+                gevent.sleep(0.05)
+        self.settle()
+        self.assertTrue(hostname not in self.holders())
+        self.assertEqual(len(self.holders()), 2)
+        self.check()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import random
+from smhcluster.metrics import Histogram, Metrics
+
+class TestHistogram(unittest.TestCase):
+    def test_percentiles(self):
+        # Percentiles should be within the histogram's precision
+        random.seed(42)
+        values = sorted(random.expovariate(1000) for i in range(10000))
+        histogram = Histogram()
+        for value in values:
+            histogram.record(value)
+        for p in (50, 90, 99):
+            exact = values[int(len(values) * p / 100.0) - 1]
+            self.assertAlmostEqual(histogram.percentiles([p])[0] / exact, 1,
+                delta=1.0 / histogram.buckets)
+        summary = histogram.summary()
+        self.assertEqual(summary['count'], 10000)
+        self.assertEqual(summary['min'], values[0])
+        self.assertEqual(summary['max'], values[-1])
+
+    def test_zero(self):
+        histogram = Histogram()
+        histogram.record(0)
+        histogram.record(0)
+        histogram.record(5)
+        self.assertEqual(histogram.percentiles([50, 100]), [0, 5])
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_snapshot(self):
+        # Keys should be turned into names, using the label for non-strings
+        slave = object()
+        self.metrics.incr(('requests', 'find_first'), 3)
+        self.metrics.observe(('rpc', 'find_first', slave), 0.5)
+        self.metrics.gauge('shards', lambda: {slave: 12})
+        snapshot = self.metrics.snapshot(
+            lambda thing: 'slave' if thing is slave else str(thing))
+        self.assertEqual(snapshot['counters'], {'requests.find_first': 3})
+        self.assertEqual(
+            snapshot['histograms']['rpc.find_first.slave']['count'], 1)
+        self.assertEqual(snapshot['gauges'], {'shards': {'slave': 12}})
+
+    def test_disabled(self):
+        # Nothing should be recorded when disabled
+        self.metrics.config({'enabled': False})
+        self.metrics.incr('requests')
+        self.metrics.observe('latency', 1)
+        self.assertEqual(self.metrics.snapshot()['counters'], {})
+        self.assertEqual(self.metrics.snapshot()['histograms'], {})
+        self.assertRaises(KeyError, self.metrics.config, {'enable': True})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import random
+import gevent
+from smhcluster.master import Master
+from smhcluster.slave import Slave
+
+class TestMigration(unittest.TestCase):
+    def setUp(self):
+        random.seed(42)
+        # Every range starts out on the old slave, and the new one has none
+        self.master = Master()
+        self.master.config({'migration': {'chunk': 10, 'rate': 1 << 20}})
+        self.old, self.new = Slave('old:1234'), Slave('new:1234')
+        for slave in (self.old, self.new):
+            self.master.slaves[slave.hostname] = slave
+            self.master.negotiate(slave)
+        for start, end in self.master.ranges():
+            self.old.load(start, end)
+            self.master.rangemap.insert(start, end,
+                self.master.replicas([self.old]))
+        self.start, self.end = self.master.ranges()[0]
+        self.hashes = self.fresh(200)
+        self.master.insert(*self.hashes)
+
+    def fresh(self, count):
+        '''Hashes with exactly one variant in the first range'''
+        return [random.getrandbits(53) | (random.getrandbits(3) << 61)
+            for i in range(count)]
+
+    def held(self, slave):
+        '''The hashes a slave has in the first range, if it serves it'''
+        for start, end, shard in slave.rangemap:
+            if start == self.start:
+                return set(shard.hashes().tolist())
+        return None
+
+    def copying(self):
+        '''Start moving the first range, returning once it's being copied'''
+        mover = gevent.spawn(self.master.move, self.start, self.end,
+            self.old, self.new)
+        while self.start not in self.old.transfers:
+            gevent.sleep(0)
+        self.assertEqual(self.master.migrating.find(self.start), self.new)
+        return mover
+
+    def test_move(self):
+        mover = self.copying()
+        # Remove some hashes that haven't been sent yet, and some that have,
+        # and write new ones while the copy goes on
+        pending = self.old.transfers[self.start].tolist()
+        removed = pending[-5:] + pending[:5]
+        added   = self.fresh(20)
+        self.master.remove(*removed)
+        for h in added:
+            self.master.insert(h)
+            gevent.sleep(0)
+        self.assertTrue(self.start in self.old.transfers)
+        mover.get()
+        expected = set(self.hashes + added) - set(removed)
+        # The new slave has it all, and the old one has let it go
+        self.assertEqual(self.held(self.new), expected)
+        self.assertEqual(self.held(self.old), None)
+        self.assertEqual(list(self.master.rangemap[self.start][1]), [self.new])
+        self.assertEqual(len(self.master.migrating), 0)
+        self.assertEqual(self.new.rangemap[self.start][1].tombstones, None)
+        self.assertEqual([r for q, r in self.master.find_first(*expected)],
+            list(expected))
+
+    def test_rollback(self):
+        # When the new slave fails partway, the old one keeps the range
+        receive, received = self.new.receive, []
+        def failing(start, buf):
+            if len(received) == 3:
+                raise IOError('Disk full')
+            received.append(buf)
+            return receive(start, buf)
+        self.new.receive = failing
+        epoch = self.master.epoch
+        mover = self.copying()
+        added = self.fresh(5)
+        self.master.insert(*added)
+        self.assertRaises(IOError, mover.get)
+        self.assertEqual(self.held(self.old), set(self.hashes + added))
+        self.assertEqual(self.held(self.new), None)
+        self.assertEqual(list(self.master.rangemap[self.start][1]), [self.old])
+        self.assertEqual(len(self.master.migrating), 0)
+        self.assertTrue(self.master.epoch > epoch)
+        # And writes go only to the old slave again
+        self.master.remove(*added)
+        self.assertEqual(self.held(self.old), set(self.hashes))
+        self.assertEqual(self.held(self.new), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import numpy
+from smhcluster import packed
+
+class TestPacked(unittest.TestCase):
+    def test_hashes(self):
+        # Hashes should survive a round trip, including the very large ones
+        hashes = [0, 1, (1 << 64) - 1, 1 << 63, 12345]
+        buf = packed.pack_hashes(hashes)
+        self.assertEqual(len(buf), 8 * len(hashes))
+        self.assertEqual(packed.unpack_hashes(buf).tolist(), hashes)
+
+    def test_little_endian(self):
+        # The format is little-endian regardless of the platform
+        self.assertEqual(packed.pack_hashes([1]), b'\x01' + b'\x00' * 7)
+
+    def test_pairs(self):
+        # Pairs should unpack into parallel queries and hashes
+        queries, hashes = [1, 2, 3], [4, 5, (1 << 64) - 1]
+        q, h = packed.unpack_pairs(packed.pack_pairs(queries, hashes))
+        self.assertEqual(q.tolist(), queries)
+        self.assertEqual(h.tolist(), hashes)
+
+    def test_sets(self):
+        # Sets of varying sizes, including empty ones, should survive
+        sets = [[1, 2, 3], [], [4], [], [5, 6]]
+        results = packed.unpack_sets(packed.pack_sets(sets))
+        self.assertEqual([r.tolist() for r in results], sets)
+        self.assertEqual(packed.unpack_sets(packed.pack_sets([])), [])
+        self.assertEqual([r.tolist() for r in
+            packed.unpack_sets(packed.pack_sets([[]]))], [[]])
+
+    def test_arrays(self):
+        # Packing an array should be the same as packing its list
+        hashes = numpy.arange(1000, dtype=numpy.uint64)
+        self.assertEqual(packed.pack_hashes(hashes),
+            packed.pack_hashes(hashes.tolist()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+from collections import Counter
+from smhcluster.placement import Planner
+
+class TestPlacement(unittest.TestCase):
+    def setUp(self):
+        self.planner = Planner(1024)
+        self.weights = {'a': 1, 'b': 1, 'c': 2}
+
+    def counts(self, placement):
+        return Counter(node for nodes in placement.values() for node in nodes)
+
+    def test_targets(self):
+        # Shards should be handed out in proportion to weight
+        self.assertEqual(self.planner.targets(self.weights),
+            {'a': 256, 'b': 256, 'c': 512})
+
+    def test_initial(self):
+        # Every shard should be assigned, and loaded from scratch
+        placement, moves = self.planner.plan({}, self.weights)
+        self.assertTrue(all(len(nodes) == 1 for nodes in placement.values()))
+        self.assertEqual(self.counts(placement), {'a': 256, 'b': 256, 'c': 512})
+        self.assertTrue(all(source is None for s, source, d in moves))
+
+    def test_add(self):
+        # Adding a node should only move the shards it needs
+        placement, moves = self.planner.plan({}, self.weights)
+        self.weights['d'] = 1
+        updated, moves = self.planner.plan(placement, self.weights)
+        self.assertEqual(len(moves), 205)
+        self.assertTrue(all(d == 'd' for s, source, d in moves))
+        for shard, source, destination in moves:
+            self.assertEqual(placement[shard], [source])
+        self.assertEqual(self.planner.plan(updated, self.weights)[1], [])
+
+    def test_remove(self):
+        # Removing a node should only move the shards it had
+        placement, moves = self.planner.plan({}, self.weights)
+        del self.weights['a']
+        updated, moves = self.planner.plan(placement, self.weights)
+        self.assertEqual(len(moves), 256)
+        self.assertTrue(all(source is None for s, source, d in moves))
+        self.assertEqual(self.counts(updated), {'b': 341, 'c': 683})
+
+    def test_replicas(self):
+        # Replicas of a shard should all be on different nodes, and a node can't
+        # hold more than one replica of each shard
+        planner = Planner(1024, 3)
+        self.weights['d'] = 8
+        placement, moves = planner.plan({}, self.weights)
+        self.assertTrue(all(len(set(nodes)) == 3 for nodes in placement.values()))
+        self.assertEqual(self.counts(placement)['d'], 1024)
+
+    def test_interleave(self):
+        # Moves should alternate between sources
+        moves = [(0, 'a', 'c'), (1, 'a', 'c'), (2, 'b', 'c'), (3, 'b', 'c')]
+        self.assertEqual([m[1] for m in self.planner.interleave(moves)],
+            ['a', 'b', 'a', 'b'])
+
+if __name__ == '__main__':
+    unittest.main()
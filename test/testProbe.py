@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import random
+from smhcluster import packed
+from smhcluster.master import Master
+from smhcluster.slave import Slave
+
+class TestProbe(unittest.TestCase):
+    def setUp(self):
+        random.seed(42)
+        # A master with a few slaves in this process, which each hold every
+        # third shard
+        self.master = Master()
+        self.master.config({'probe': True})
+        self.slaves = [Slave('slave-%i' % i) for i in range(3)]
+        for i, (start, end) in enumerate(self.master.ranges()):
+            slave = self.slaves[i % len(self.slaves)]
+            slave.load(start, end)
+            self.master.packed.add(slave)
+            self.master.rangemap.insert(start, end,
+                self.master.replicas([slave]))
+        self.hashes = [random.getrandbits(64) for i in range(300)]
+        self.master.insert(*self.hashes)
+
+    def flip(self, h, bits):
+        for b in random.sample(range(64), bits):
+            h ^= 1 << b
+        return h
+
+    def brute(self, query, hashes):
+        return sorted(h for h in hashes if bin(h ^ query).count('1') <= 3)
+
+    def stored(self):
+        return sum(len(shard)
+            for slave in self.slaves for start, end, shard in slave.rangemap)
+
+    def test_once(self):
+        # Each hash is only stored in its own shard
+        self.assertEqual(self.stored(), len(self.hashes))
+        self.master.remove(*self.hashes[:100])
+        self.assertEqual(self.stored(), len(self.hashes) - 100)
+
+    def test_find(self):
+        # Queries still find near-duplicates in any shard
+        queries = [self.flip(h, random.randint(0, 4)) for h in self.hashes]
+        expected = [self.brute(q, self.hashes) for q in queries]
+        self.assertEqual([r for q, r in self.master.find_all(*queries)],
+            expected)
+        self.assertEqual([r for q, r in self.master.find_first(*queries)],
+            [(e or [0])[0] for e in expected])
+        buf = packed.pack_hashes(queries)
+        self.assertEqual(packed.unpack_hashes(
+            self.master.find_first_packed(buf)).tolist(),
+            [(e or [0])[0] for e in expected])
+        self.assertEqual([r.tolist() for r in packed.unpack_sets(
+            self.master.find_all_packed(buf))], expected)
+
+    def test_claim(self):
+        # Near-duplicates in other shards are found, and the rest inserted
+        near = [h ^ (1 << 63) for h in self.hashes[:10]]
+        fresh = [random.getrandbits(64) for i in range(10)]
+        results = self.master.find_first_or_insert(*(near + fresh))
+        self.assertEqual([r for h, r in results], self.hashes[:10] + [0] * 10)
+        self.assertEqual(self.stored(), len(self.hashes) + 10)
+        self.assertEqual([r for h, r in self.master.find_first(*fresh)], fresh)
+
+    def test_cache(self):
+        # Merged answers are cached, and invalidated like any others
+        self.master.config({'probe': True, 'cache': {'enabled': True}})
+        queries = [self.flip(h, 2) for h in self.hashes[:50]]
+        first = self.master.find_all(*queries)
+        self.assertEqual(self.master.find_all(*queries), first)
+        self.assertTrue(self.master.cache.hits >= len(queries))
+        self.master.remove(*self.hashes[:50])
+        self.assertEqual([r for q, r in self.master.find_all(*queries)],
+            [self.brute(q, self.hashes[50:]) for q in queries])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -52,5 +52,63 @@ class TestRangeMap(unittest.TestCase):
         self.rm.insert(100, 200, 'testing')
         self.assertRaises(Exception, self.rm.remove, 100, 300)
 
+    def test_replace(self):
+        # Inserting over an existing start should just change its owner
+        self.rm.insert(100, 200, 'cheese')
+        self.rm.insert(100, 200, 'shop')
+        self.assertEqual(len(self.rm), 1)
+        self.assertEqual(self.rm.find(150), 'shop')
+        self.assertEqual(self.rm.ranges_of('cheese'), [])
+        self.assertEqual(self.rm.ranges_of('shop'), [(100, 200)])
+    
+    def test_iter(self):
+        # Iteration should yield ranges in order of their starts
+        self.rm.insert(500, 600, 'sketch')
+        self.rm.insert(100, 200, 'cheese')
+        self.rm.insert(300, 400, 'shop')
+        self.assertEqual(list(self.rm), [
+            (100, 200, 'cheese'), (300, 400, 'shop'), (500, 600, 'sketch')])
+    
+    def test_assign_many(self):
+        # We should be able to hand out lots of ranges at once, and then find
+        # out which ranges each item is responsible for
+        ranges = [(i * 10, i * 10 + 9) for i in range(100)]
+        self.rm.assign_many(ranges, None)
+        self.rm.assign_many(ranges[0:50], 'cheese')
+        self.rm.assign_many(ranges[50:60], 'shop')
+        self.assertEqual(len(self.rm), 100)
+        self.assertEqual(self.rm.ranges_of('cheese'), ranges[0:50])
+        self.assertEqual(self.rm.ranges_of('shop'), ranges[50:60])
+        self.assertEqual(self.rm.ranges_of(None), ranges[60:])
+        self.assertEqual(self.rm.counts(),
+            {'cheese': 50, 'shop': 10, None: 40})
+        self.assertEqual(self.rm.owners_of([5, 505, 995, 1000]),
+            ['cheese', 'shop', None, None])
+        # Handing out no ranges at all shouldn't leave anything behind
+        for i in range(3):
+            self.rm.assign_many([], 'sketch')
+        self.assertEqual(self.rm.counts(),
+            {'cheese': 50, 'shop': 10, None: 40})
+        self.assertEqual(len(self.rm.items), 3)
+    
+    def test_rebalance(self):
+        # Reassigning every range of a large map should be quick
+        import time
+        ranges = [(i << 48, ((i + 1) << 48) - 1) for i in range(1 << 16)]
+        start = time.time()
+        self.rm.assign_many(ranges, None)
+        for i in range(8):
+            self.rm.assign_many(ranges[i::8], i)
+        for i in range(8):
+            self.rm.assign_many(self.rm.ranges_of(i), 'cheese')
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(self.rm.counts(), {'cheese': 1 << 16})
+    
+    def test_getitem(self):
+        # We should be able to look up a range by its start
+        self.rm.insert(100, 200, 'testing')
+        self.assertEqual(self.rm[100], (200, 'testing'))
+        self.assertRaises(KeyError, self.rm.__getitem__, 150)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
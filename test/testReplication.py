@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import time
+import gevent
+from smhcluster.replication import Tracker, Replication
+
+class Replica(object):
+    # A stand-in slave that takes a while to respond, and may fail
+    def __init__(self, name, delay, fail=False):
+        self.name   = name
+        self.delay  = delay
+        self.fail   = fail
+        self.calls  = 0
+        self.writes = []
+
+    def find_first(self, *hashes):
+        self.calls += 1
+        gevent.sleep(self.delay)
+        if self.fail:
+            raise ValueError('Oh noes!')
+        return self.name
+
+    def insert(self, *insertions):
+        gevent.sleep(self.delay)
+        if self.fail:
+            raise ValueError('Oh noes!')
+        self.writes.extend(insertions)
+        return True
+
+class TestTracker(unittest.TestCase):
+    def setUp(self):
+        self.tracker = Tracker()
+
+    def test_average(self):
+        # The moving average should move towards recent samples
+        self.tracker.observe('a', 1.0)
+        self.tracker.observe('a', 2.0)
+        self.assertAlmostEqual(self.tracker.latency('a'), 1.2)
+        self.assertEqual(self.tracker.latency('b'), 0)
+
+    def test_percentile(self):
+        # Only the most recent samples should count towards percentiles
+        for i in range(self.tracker.samples * 2):
+            self.tracker.observe('a', float(i))
+        self.assertEqual(self.tracker.percentile('a', 0),
+            float(self.tracker.samples))
+        self.assertEqual(self.tracker.percentile('b', 95),
+            self.tracker.default)
+
+class TestReplicaSet(unittest.TestCase):
+    def setUp(self):
+        self.replication = Replication()
+
+    def test_interned(self):
+        # The same group of slaves should always give the same replica set
+        a = self.replication.replicas(['a', 'b'])
+        self.assertTrue(a is self.replication.replicas(['b', 'a']))
+        self.assertEqual(self.replication.replicas([]), None)
+        self.replication.forget('a')
+        self.assertFalse(a is self.replication.replicas(['a', 'b']))
+
+    def test_fastest(self):
+        # Reads should go to whichever replica has been fastest
+        fast, slow = Replica('fast', 0), Replica('slow', 0.01)
+        self.replication.tracker.observe(fast, 0.001)
+        self.replication.tracker.observe(slow, 0.5)
+        replicas = self.replication.replicas([slow, fast])
+        self.assertEqual(replicas.find_first(1), 'fast')
+        self.assertEqual(slow.calls, 0)
+
+    def test_hedged(self):
+        # A replica that's slower than usual should get hedged
+        slow, other = Replica('slow', 0.5), Replica('other', 0.01)
+        self.replication.tracker.observe(slow, 0.001)
+        self.replication.tracker.observe(other, 0.1)
+        replicas = self.replication.replicas([slow, other])
+        start = time.time()
+        self.assertEqual(replicas.find_first(1), 'other')
+        self.assertTrue(time.time() - start < 0.25)
+
+    def test_failover(self):
+        # A replica that fails shouldn't fail the read, but should be penalized
+        bad, good = Replica('bad', 0, True), Replica('good', 0)
+        self.replication.tracker.observe(good, 0.1)
+        replicas = self.replication.replicas([bad, good])
+        self.assertEqual(replicas.find_first(1), 'good')
+        self.assertTrue(self.replication.tracker.latency(bad) >
+            self.replication.tracker.latency(good))
+        # And when they all fail, so does the read
+        replicas = self.replication.replicas([bad, Replica('worse', 0, True)])
+        self.assertRaises(ValueError, replicas.find_first, 1)
+
+    def test_quorum(self):
+        self.assertEqual(self.replication.quorum(3), 2)
+        self.replication.config({'writes': 'all'})
+        self.assertEqual(self.replication.quorum(3), 3)
+        self.replication.config({'writes': 1})
+        self.assertEqual(self.replication.quorum(3), 1)
+        self.assertRaises(KeyError, self.replication.config, {'hedging': 1})
+
+    def test_write_quorum(self):
+        # Writes should return once a majority have them, and the rest should
+        # still get them eventually
+        slaves = [Replica('a', 0), Replica('b', 0), Replica('c', 0.1)]
+        replicas = self.replication.replicas(slaves)
+        start = time.time()
+        self.assertTrue(replicas.insert((1, 2)))
+        self.assertTrue(time.time() - start < 0.05)
+        self.assertEqual(slaves[2].writes, [])
+        gevent.sleep(0.15)
+        self.assertEqual(slaves[2].writes, [(1, 2)])
+
+    def test_write_no_quorum(self):
+        # If a quorum can't be had, the write fails
+        slaves = [Replica('a', 0), Replica('b', 0, True), Replica('c', 0, True)]
+        replicas = self.replication.replicas(slaves)
+        self.assertRaises(ValueError, replicas.insert, (1, 2))
+        self.replication.config({'writes': 1})
+        self.assertTrue(replicas.insert((1, 2)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import random
+import numpy
+from smhcluster.util import RangeMap
+from smhcluster.routing import Router
+
+class TestRouting(unittest.TestCase):
+    def setUp(self):
+        self.rm = RangeMap()
+        self.shards = 64
+        self.ranges = [(i << 58, ((i + 1) << 58) - 1) for i in range(64)]
+        for i, (start, end) in enumerate(self.ranges):
+            self.rm.insert(start, end, 'slave-%i' % (i % 5))
+        self.hashes = [random.getrandbits(64) for i in range(1000)]
+
+    def check(self, router, queries):
+        # Every query should end up grouped with the item that the rangemap
+        # would have found for it
+        groups = router.route(queries, self.rm)
+        seen = 0
+        for item, indices in groups.items():
+            for i in indices:
+                self.assertEqual(self.rm.find(int(queries[i])), item)
+            seen += len(indices)
+        self.assertEqual(seen, len(queries))
+
+    def test_variants(self):
+        # We should get each hash with each combination of its top bits flipped
+        router = Router(3)
+        queries, hashes = router.variants([0, 5])
+        self.assertEqual(hashes.tolist(), [0] * 8 + [5] * 8)
+        self.assertEqual(queries.tolist(),
+            [i << 61 for i in range(8)] + [(i << 61) ^ 5 for i in range(8)])
+
+    def test_uniform(self):
+        # With all the expected shards present, we should use the fast path
+        router = Router(3, self.shards)
+        queries, hashes = router.variants(self.hashes)
+        self.check(router, queries)
+        self.assertTrue(router.uniform)
+
+    def test_searchsorted(self):
+        # With shards missing, we should fall back to searching
+        router = Router(3, self.shards)
+        self.rm.remove(*self.ranges[3])
+        self.rm.remove(*self.ranges[40])
+        queries, hashes = router.variants(self.hashes)
+        self.check(router, queries)
+        self.assertFalse(router.uniform)
+        self.assertTrue(None in router.route(queries, self.rm))
+
+    def test_refresh(self):
+        # Changes to the rangemap should be reflected in subsequent routing
+        router = Router(3, self.shards)
+        queries = numpy.array(self.hashes, dtype=numpy.uint64)
+        self.check(router, queries)
+        self.rm.assign_many(self.ranges[0:32], 'slave-new')
+        self.check(router, queries)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import gevent
+from smhcluster.scatter import Scatter
+from smhcluster.metrics import Metrics
+from smhcluster.replication import Replication
+
+class Echo(object):
+    # A stand-in slave that takes a while to respond
+    def __init__(self, delay):
+        self.delay  = delay
+        self.active = 0
+        self.peak   = 0
+
+    def find_first(self, *hashes):
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        gevent.sleep(self.delay)
+        self.active -= 1
+        return list(hashes)
+
+    def find_all(self, *hashes):
+        raise ValueError('Oh noes!')
+
+class TestScatter(unittest.TestCase):
+    def setUp(self):
+        self.scatter = Scatter(2)
+
+    def test_concurrent(self):
+        # All the batches should go out at once, so this should only take about
+        # as long as one of them does
+        slaves = [Echo(0.1) for i in range(5)]
+        import time
+        start = time.time()
+        results = self.scatter.gather(
+            dict((s, [i]) for i, s in enumerate(slaves)), 'find_first')
+        self.assertTrue(time.time() - start < 0.3)
+        for i, s in enumerate(slaves):
+            self.assertEqual(results[s], [i])
+
+    def test_partial_failure(self):
+        # When some of the slaves fail, we should still get the other results
+        good, bad = Echo(0), Echo(0)
+        bad.find_first = bad.find_all
+        try:
+            self.scatter.gather({good: [1], bad: [2]}, 'find_first')
+            self.fail('Expected a PartialFailure')
+        except Scatter.PartialFailure as exc:
+            self.assertEqual(exc.results, {good: [1]})
+            self.assertEqual(list(exc.failures.keys()), [bad])
+
+    def test_forget(self):
+        # Latencies are kept by hostname rather than by the slaves themselves,
+        # and what we had for a slave that's gone is dropped
+        a, b = Echo(0), Echo(0)
+        a.hostname, b.hostname = 'a:1234', 'b:1234'
+        replicas = Replication().replicas([a, b])
+        self.scatter.metrics = Metrics()
+        self.scatter.gather_calls({a: ('find_first', [1]),
+            replicas: ('read', ['find_first', 2])})
+        self.assertEqual(sorted(self.scatter.metrics.histograms),
+            [('rpc', 'find_first', 'a:1234'), ('rpc', 'read', 'a:1234+b:1234')])
+        self.scatter.forget(b)
+        self.assertEqual(list(self.scatter.semaphores), [a])
+
+    def test_max_in_flight(self):
+        # We should never have more than max_in_flight requests to one slave
+        slave = Echo(0.05)
+        greenlets = [gevent.spawn(self.scatter.gather, {slave: [i]},
+            'find_first') for i in range(6)]
+        gevent.joinall(greenlets)
+        self.assertEqual(slave.peak, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import numpy
+from smhcluster import packed
+from smhcluster.slave import Slave
+from smhcluster.shard import Shard
+
+class TestFindFirstOrInsert(unittest.TestCase):
+    def setUp(self):
+        self.slave = Slave('localhost:1234')
+        self.slave.config({})
+        # Two shards, each covering half of the space
+        self.slave.load(0, (1 << 63) - 1)
+        self.slave.load(1 << 63, (1 << 64) - 1)
+        self.slave.insert((5, 0b111000))
+
+    def test_existing(self):
+        # Near-duplicates already there are found, and nothing is inserted
+        self.assertEqual(self.slave.find_first_or_insert((5, 0b111001)),
+            [0b111000])
+        self.assertEqual(self.slave.find_all(0b111001), [[0b111000]])
+
+    def test_insert(self):
+        # Anything without a near-duplicate is inserted
+        self.assertEqual(self.slave.find_first_or_insert((5, 1 << 40)), [0])
+        self.assertEqual(self.slave.find_first(1 << 40), [1 << 40])
+
+    def test_shard(self):
+        # Only matches in the shard for the query count
+        q = 1 << 63
+        self.assertEqual(self.slave.find_first_or_insert((q, 0b111001)), [0])
+        self.assertEqual(self.slave.find_first_or_insert((q, 0b111011)),
+            [0b111001])
+
+    def test_batch(self):
+        # Near-duplicates within a batch are only inserted once
+        results = self.slave.find_first_or_insert(
+            (5, 1 << 40), (6, (1 << 40) | 1), (7, 0xff << 48), (8, 1 << 40))
+        self.assertEqual(results, [0, 1 << 40, 0, 1 << 40])
+        self.assertEqual(self.slave.find_all(1 << 40), [[1 << 40]])
+
+    def test_packed(self):
+        buf = packed.pack_pairs([5, 5], [0b111001, 1 << 40])
+        self.assertEqual(packed.unpack_hashes(
+            self.slave.find_first_or_insert_packed(buf)).tolist(),
+            [0b111000, 0])
+
+    def test_compact(self):
+        # Switching to compact tables keeps everything we had
+        self.slave.config({'compact': 8})
+        self.assertEqual(self.slave.index.compact, 8)
+        self.slave.index.merge()
+        self.assertEqual(self.slave.find_first_or_insert((5, 0b111001)),
+            [0b111000])
+
+class TestWrite(unittest.TestCase):
+    def setUp(self):
+        # Two shards, the first with a snapshot of a few hashes already
+        self.slave = Slave('localhost:1234')
+        self.slave.config({})
+        self.half  = 1 << 63
+        self.slave.serve(0, self.half - 1, Shard(0, self.half - 1,
+            self.slave.index, numpy.array([10, 20, 30], dtype=numpy.uint64)))
+        self.slave.load(self.half, (1 << 64) - 1)
+        self.low   = self.slave.rangemap[0][1]
+        self.high  = self.slave.rangemap[self.half][1]
+
+    def test_batch(self):
+        # A batch may go to several shards, with hashes more than once, some
+        # of them already there
+        self.slave.insert((5, 20), (5, 40), (5, 40), (self.half, 50), (6, 60))
+        self.assertEqual(self.low.added, set([40, 60]))
+        self.assertEqual(self.high.added, set([50]))
+        self.assertEqual((self.low.writes, self.high.writes), (4, 1))
+        self.slave.remove_packed(packed.pack_pairs([5, 5, 5, 5, self.half],
+            [10, 10, 40, 70, 50]))
+        self.assertEqual(self.low.added, set([60]))
+        self.assertEqual(self.low.removed, set([10]))
+        self.assertEqual(self.high.added, set())
+        self.assertEqual(self.low.hashes().tolist(), [20, 30, 60])
+        # Hashes removed from the snapshot can come back
+        self.slave.insert((5, 10), (self.half, 10))
+        self.assertEqual(self.low.removed, set())
+        self.assertEqual(self.low.hashes().tolist(), [10, 20, 30, 60])
+        self.assertEqual(self.high.hashes().tolist(), [10])
+        self.assertEqual(len(self.slave.index), 5)
+        # Nothing is applied if any of them have nowhere to go
+        self.slave.unload(self.half, (1 << 64) - 1)
+        self.assertRaises(KeyError, self.slave.insert, (5, 80), (self.half, 90))
+        self.assertEqual(self.low.hashes().tolist(), [10, 20, 30, 60])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import shutil
+import tempfile
+
+import numpy
+from smhcluster.storage import Storage
+from smhcluster.storage.disk import Disk
+
+class TestDisk(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.disk = Disk({'path': os.path.join(self.path, '*.snap')})
+        self.hashes = numpy.sort(numpy.random.randint(
+            0, 1 << 63, size=10000, dtype=numpy.uint64))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_round_trip(self):
+        # We should get back exactly what we saved
+        self.disk.save(0, 100, self.hashes)
+        loaded = self.disk.load(0, 100)
+        self.assertTrue(isinstance(loaded, numpy.memmap))
+        self.assertTrue(numpy.array_equal(loaded, self.hashes))
+
+    def test_empty(self):
+        # Empty shards should be fine, as should shards we've never saved
+        self.assertEqual(self.disk.load(0, 100), None)
+        self.disk.save(0, 100, [])
+        self.assertEqual(len(self.disk.load(0, 100)), 0)
+
+    def test_directory(self):
+        # A path without a '*' is treated as a directory
+        disk = Disk({'path': self.path})
+        disk.save(0, 100, self.hashes)
+        self.assertTrue(numpy.array_equal(disk.load(0, 100), self.hashes))
+
+    def test_corrupt(self):
+        # Flipping a bit in the data should make it fail its checksum
+        self.disk.save(0, 100, self.hashes)
+        with open(self.disk.filename(0, 100), 'r+b') as f:
+            f.seek(-1, 2)
+            byte = f.read(1)
+            f.seek(-1, 2)
+            f.write(bytes(bytearray([ord(byte) ^ 1])))
+        self.assertRaises(Storage.Corrupt, self.disk.load, 0, 100)
+
+    def test_mismatch(self):
+        # A snapshot for one range shouldn't be loaded for another
+        self.disk.save(0, 100, self.hashes)
+        os.rename(self.disk.filename(0, 100), self.disk.filename(0, 200))
+        self.assertRaises(Storage.Corrupt, self.disk.load, 0, 200)
+
+    def test_delete(self):
+        self.disk.save(0, 100, self.hashes)
+        self.disk.delete(0, 100)
+        self.assertEqual(self.disk.load(0, 100), None)
+
+    def test_config(self):
+        # Unknown configuration options should be rejected
+        self.assertRaises(KeyError, Disk, {'path': self.path, 'foo': 1})
+
+if __name__ == '__main__':
+    unittest.main()
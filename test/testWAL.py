@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import shutil
+import tempfile
+
+import gevent
+from smhcluster import packed
+from smhcluster.wal import WAL
+from smhcluster.slave import Slave
+
+class TestWAL(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.config = {'path': self.path, 'window': 5}
+        self.wal = WAL(self.config, 'localhost:4242')
+
+    def tearDown(self):
+        self.wal.close()
+        shutil.rmtree(self.path)
+
+    def reopen(self):
+        self.wal.close()
+        self.wal = WAL(self.config, 'localhost:4242')
+        return self.wal.replay()
+
+    def test_replay(self):
+        # Everything appended should be read back in order after a restart
+        self.wal.append(WAL.INSERT, packed.pack_pairs([1, 2], [3, 4]))
+        self.wal.append(WAL.REMOVE, packed.pack_pairs([5], [6]))
+        ops, queries, hashes = self.reopen()
+        self.assertEqual(ops.tolist(), [WAL.INSERT, WAL.INSERT, WAL.REMOVE])
+        self.assertEqual(queries.tolist(), [1, 2, 5])
+        self.assertEqual(hashes.tolist(), [3, 4, 6])
+
+    def test_group_commit(self):
+        # Concurrent appends should share commits
+        commits = []
+        commit = self.wal.commit
+        def counting(*args):
+            commits.append(1)
+            return commit(*args)
+        self.wal.commit = counting
+        greenlets = [gevent.spawn(self.wal.append, WAL.INSERT,
+            packed.pack_pairs([i], [i])) for i in range(100)]
+        gevent.joinall(greenlets)
+        self.assertTrue(len(commits) < 10)
+        self.assertEqual(len(self.reopen()[0]), 100)
+
+    def test_torn(self):
+        # A partially-written record at the end should be ignored
+        self.wal.append(WAL.INSERT, packed.pack_pairs([1], [2]))
+        self.wal.append(WAL.INSERT, packed.pack_pairs([3], [4]))
+        self.wal.close()
+        filename = self.wal.filename(self.wal.segment)
+        with open(filename, 'r+b') as f:
+            f.truncate(os.path.getsize(filename) - 3)
+        self.wal = WAL(self.config, 'localhost:4242')
+        self.assertEqual(self.wal.replay()[1].tolist(), [1])
+
+    def test_compact(self):
+        # Segments before the one provided should be discarded
+        self.wal.append(WAL.INSERT, packed.pack_pairs([1], [2]))
+        segment = self.wal.rotate()
+        self.wal.append(WAL.INSERT, packed.pack_pairs([3], [4]))
+        self.wal.compact(segment)
+        self.assertEqual(self.reopen()[1].tolist(), [3])
+
+class TestRecovery(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.config = {
+            'wal': {'path': os.path.join(self.path, 'wal')},
+            'storage': {'smhcluster.storage.disk.Disk': {
+                'path': self.path, 'interval': 3600}}
+        }
+        self.slave = self.restart()
+
+    def tearDown(self):
+        self.slave.snapshotter.kill()
+        self.slave.wal.close()
+        shutil.rmtree(self.path)
+
+    def restart(self):
+        slave = Slave('localhost:4242')
+        slave.config(self.config)
+        return slave
+
+    def test_once(self):
+        # Writes from the log are applied to a range when it's first loaded,
+        # and not again when it's loaded after that
+        half = 1 << 63
+        a, b = 0x0123456789abcdef, 0x7edcba9876543210
+        self.slave.load(0, half - 1)
+        self.slave.load(half, (1 << 64) - 1)
+        self.slave.insert((a, a), (b, b), (half, half))
+        self.slave.snapshotter.kill()
+        self.slave.wal.close()
+        self.slave = self.restart()
+        self.assertEqual(len(self.slave.replayed[0]), 3)
+        self.slave.load(0, half - 1)
+        self.assertEqual(self.slave.find_first(a, b), [a, b])
+        self.slave.remove((a, a))
+        self.slave.save(0, half - 1)
+        self.slave.unload(0, half - 1)
+        self.slave.load(0, half - 1)
+        self.assertEqual(self.slave.find_first(a, b), [0, b])
+        # Only the write for the range we haven't loaded is left
+        self.assertEqual(self.slave.replayed[1].tolist(), [half])
+
+    def test_storage(self):
+        # Without storage, nothing would ever be snapshotted, so the log could
+        # never be trimmed
+        slave = Slave('localhost:4243')
+        self.assertRaises(ValueError, slave.config,
+            {'wal': self.config['wal']})
+        self.assertEqual(slave.wal, None)
+
+if __name__ == '__main__':
+    unittest.main()
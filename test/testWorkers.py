@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+
+import unittest
+
+import os
+import sys
+base, name = os.path.split(os.path.abspath(__file__))
+sys.path = [os.path.split(base)[0]] + sys.path
+
+import signal
+import random
+import shutil
+import tempfile
+import gevent
+from smhcluster import packed
+from smhcluster.routing import Fence
+from smhcluster.workers import Front
+
+class TestFront(unittest.TestCase):
+    def setUp(self):
+        self.path  = tempfile.mkdtemp()
+        self.front = Front('localhost:%i' % os.getpid(), 2)
+        self.front.backoff = 0
+        self.assertTrue(self.front.wait(30))
+        self.front.config({
+            'storage': {'smhcluster.storage.disk.Disk': {'path': self.path}},
+            'wal': {'path': os.path.join(self.path, 'wal')}
+        })
+        # Four ranges, split over the two workers
+        self.ranges = [(i << 62, ((i + 1) << 62) - 1) for i in range(4)]
+        for start, end in self.ranges:
+            self.front.load(start, end)
+        rand = random.Random(42)
+        self.hashes = [start + rand.getrandbits(62)
+            for start, end in self.ranges]
+        self.front.insert(*[(h, h) for h in self.hashes])
+
+    def tearDown(self):
+        self.front.stop()
+        shutil.rmtree(self.path)
+
+    def test_spread(self):
+        # Ranges should be split evenly, and batches should be split up by range
+        self.assertEqual(sorted(self.front.rangemap.counts().values()), [2, 2])
+        self.assertEqual(self.front.find_first(*self.hashes), self.hashes)
+        self.assertEqual(self.front.find_first_or_insert(
+            (self.hashes[0], self.hashes[0] ^ 1), (1 << 63, (1 << 63) + 7)),
+            [self.hashes[0], 0])
+        self.front.remove((1 << 63, (1 << 63) + 7))
+        self.assertEqual(self.front.find_all(1 << 63, (1 << 63) + 7), [[], []])
+
+    def test_direct(self):
+        # Requests from clients that route for themselves are checked against
+        # the last routing table we heard of, and then split up as usual
+        buf = packed.pack_hashes(self.hashes)
+        self.assertRaises(Fence.Stale, self.front.direct, 1, 'find_first', buf)
+        self.front.fence(2)
+        self.assertRaises(Fence.Stale, self.front.direct, 1, 'find_first', buf)
+        self.assertEqual(packed.unpack_hashes(
+            self.front.direct(2, 'find_first', buf)).tolist(), self.hashes)
+
+    def test_cluster(self):
+        # Each worker's clusters are put together, so a hash held by two of
+        # them joins up what's near it in both
+        a, b, c = self.hashes[0], self.hashes[0] ^ 1, self.hashes[0] ^ 3
+        self.assertNotEqual(self.front.owner(self.ranges[0][0]),
+            self.front.owner(self.ranges[1][0]))
+        self.front.insert((a, b), (self.hashes[1], b), (self.hashes[1], c))
+        self.assertEqual(self.front.cluster(), 3)
+        hashes, clusters = packed.unpack_pairs(self.front.clustered(0, 10))
+        self.assertEqual(hashes.tolist(), sorted([a, b, c]))
+        self.assertEqual(clusters.tolist(), [min(a, b, c)] * 3)
+        self.assertEqual(self.front.clustering, None)
+
+    def test_restart(self):
+        # A worker that dies should come back with all of its ranges
+        worker = self.front.workers[0]
+        os.kill(worker.process.pid, signal.SIGKILL)
+        with gevent.Timeout(30):
+            while worker.restarts == 0 or not worker.ready:
+                gevent.sleep(0.1)
+        self.assertEqual(self.front.find_first(*self.hashes), self.hashes)
+        self.assertEqual(len(self.front.rangemap.ranges_of(worker)), 2)
+
+if __name__ == '__main__':
+    unittest.main()